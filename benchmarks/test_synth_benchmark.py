@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+'''
+    Synth benchmark for the backstage cdk app.
+
+    Builds the app from benchmarks/fixture-config.yaml with N copies of its stage and synthesizes it
+    fully offline, the hosted zone and availability zone lookups are answered from a context generated 
+    from the config. Each run happens in a fresh process so jsii startup and peak memory are measured per run.
+
+    Records per stage count:
+        - wall time of the whole process and of building + synthesizing the app
+        - peak resident memory of the python and jsii node processes
+        - template size of each stack
+
+    usage:
+        python benchmarks/test_synth_benchmark.py --stages 1 2 4 8 --output bench.json
+        python -m pytest benchmarks
+
+    the benchmark isnt collected by a plain `python -m pytest`, which only runs tests/
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from tests.synth_fixture import fixture_config, lookup_context
+
+# cloudformation rejects templates above 1MB, even from s3
+TEMPLATE_LIMIT = 1024 * 1024
+
+
+def synth(stage_count: int) -> dict:
+    # runs in the worker process, cdk and the app are only imported here so their import cost is measured
+    start = time.perf_counter()
+    from aws_cdk import core
+    from infra.app_builder import build_app
+
+    config = fixture_config(stage_count)
+    with open(os.path.join(REPO_ROOT, 'cdk.json')) as cdk_file:
+        context = json.load(cdk_file).get('context', {})
+    context.update(lookup_context(config))
+
+    with tempfile.TemporaryDirectory() as outdir:
+        imported = time.perf_counter()
+        app = build_app(config, core.App(outdir=outdir, context=context))
+        assembly = app.synth()
+        synthesized = time.perf_counter()
+
+        # jsii cant hand back the parsed manifest, so the missing lookups are read from the file
+        with open(os.path.join(outdir, 'manifest.json')) as manifest_file:
+            missing = json.load(manifest_file).get('missing', [])
+        if missing:
+            raise RuntimeError(f"synth needed lookups missing from the generated context: {[m['key'] for m in missing]}")
+
+        templates = {
+            stack.stack_name: os.path.getsize(stack.template_full_path)
+            for stack in assembly.stacks
+        }
+
+    return {
+        'import_seconds': round(imported - start, 3),
+        'synth_seconds': round(synthesized - imported, 3),
+        'template_bytes': templates,
+    }
+
+
+def run(stage_count: int) -> dict:
+    # a fresh process per run, wait4 gives us the peak rss of that process 
+    # and the jsii node process it waited on before exiting
+    with tempfile.TemporaryFile('w+') as stdout, tempfile.TemporaryFile('w+') as stderr:
+        start = time.perf_counter()
+        worker = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--worker', str(stage_count)],
+            cwd=REPO_ROOT, stdout=stdout, stderr=stderr, text=True,
+        )
+        _, status, usage = os.wait4(worker.pid, 0)
+        wall = time.perf_counter() - start
+        worker.returncode = os.waitstatus_to_exitcode(status)
+        stdout.seek(0)
+        stderr.seek(0)
+        if worker.returncode != 0:
+            raise RuntimeError(f"synth with {stage_count} stages failed:\n{stderr.read()}")
+        result = json.loads(stdout.read().strip().splitlines()[-1])
+
+    result['stages'] = stage_count
+    result['wall_seconds'] = round(wall, 3)
+    # ru_maxrss is in KiB on linux
+    result['peak_rss_mib'] = round(usage.ru_maxrss / 1024, 1)
+    return result
+
+
+@pytest.mark.parametrize('stage_count', [1, 2])
+def test_synth(stage_count):
+    result = run(stage_count)
+    stack_name = fixture_config(stage_count)['common']['TAG_STACK_NAME']
+    assert set(result['template_bytes']) == {stack_name, f"{stack_name}-pipeline"}
+    assert all(size < TEMPLATE_LIMIT for size in result['template_bytes'].values())
+
+
+def test_stage_templates_grow_linearly():
+    # every stage copy adds the same resources, nothing is duplicated per stage pair
+    sizes = [run(stage_count)['template_bytes'] for stage_count in (1, 2, 3)]
+    stack_name = fixture_config(1)['common']['TAG_STACK_NAME']
+    stage_sizes = [size[stack_name] for size in sizes]
+    first, second = stage_sizes[1] - stage_sizes[0], stage_sizes[2] - stage_sizes[1]
+    assert abs(second - first) < first * 0.05
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stages', type=int, nargs='+', default=[1, 2, 4], help='stage counts to synth')
+    parser.add_argument('--output', help='write the results as json to this file')
+    parser.add_argument('--worker', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        # the app reads the buildspecs relative to the repo root
+        os.chdir(REPO_ROOT)
+        print(json.dumps(synth(args.worker)))
+        return
+
+    results = []
+    for stage_count in args.stages:
+        result = run(stage_count)
+        results.append(result)
+        total = sum(result['template_bytes'].values())
+        print(f"{stage_count:>3} stages: {result['wall_seconds']:>7.2f}s wall, {result['synth_seconds']:>7.2f}s synth, "
+              f"{result['peak_rss_mib']:>7.1f} MiB peak, {total / 1024:>8.1f} KiB of templates")
+
+    if args.output:
+        with open(args.output, 'w') as out_file:
+            json.dump(results, out_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+from aws_cdk import core
+from .backstage import BackstageStack
+from .infra_pipeline import InfraPipelineStack
+
+
+def build_app(config: dict, app: core.App = None) -> core.App:
+    '''
+        build the infra pipeline and backstage stacks from a loaded env-config into app, 
+        a new core.App is created if app isnt given.
+    '''
+    # we want to fail here if these keys are not there
+    props = config['common']
+    stages = config['stages']
+
+    # start the naming circus
+    stack_name = props.get('TAG_STACK_NAME', 'backstage')
+
+    stacks = [
+        f"{stack_name}-pipeline",
+        stack_name
+    ]
+
+    # Using a hosted dns zone requires specifying account and region, 
+    # you will need active credentials for this account to synth/deploy
+    env =core.Environment(account=props.get('AWS_ACCOUNT'), region=props.get('AWS_REGION', 'us-east-1'))
+
+    if app is None:
+        app = core.App()
+    backstage_infra = BackstageStack(app, stacks[1], props=props, stages=stages, env=env)
+
+    # multi-region stages add artifact bucket stacks, which deploy before the backstage stack,
+    # and stacks for their other regions, which deploy after it.
+    artifact_stacks = list(backstage_infra.artifact_stacks.values())
+    region_stacks = list(backstage_infra.region_stacks.values())
+    stack_regions = {stack.stack_name: stack.region for stack in artifact_stacks + region_stacks}
+    # templates for the region stacks go to the artifact bucket in their region
+    template_buckets = {
+        stack.stack_name: backstage_infra.artifact_stacks[region].bucket.bucket_name 
+        for region, stack in backstage_infra.region_stacks.items()
+    }
+
+    # the pipeline updates itself first, then the rest of the stacks deploy in parallel
+    groups = [
+        stacks[0], 
+        [stack.stack_name for stack in artifact_stacks], 
+        stacks[1:], 
+        [stack.stack_name for stack in region_stacks],
+    ]
+    InfraPipelineStack(app, stacks[0], 
+        stacks=[group for group in groups if group], 
+        props=props, 
+        stack_regions=stack_regions, 
+        template_buckets=template_buckets, 
+        env=env,
+    )
+
+    # be nice and tag all these resources so their are attributable
+    core.Tags.of(app).add("Name",stack_name)
+    core.Tags.of(app).add("Product",props.get('TAG_STACK_PRODUCT', 'dev-portal'))
+
+    return app
@@ -1,7 +1,7 @@
+import json
 import yaml
 from aws_cdk import (
     core, 
-    aws_ecs as ecs,
     aws_iam as iam,
     aws_secretsmanager as secrets,
     aws_codebuild as codebuild,
@@ -10,11 +10,12 @@ from aws_cdk import (
     aws_chatbot as chatbot
 )
 from .common_resources import CommonResourceStack
+from .stage_resources import StageResourceStack
 
 
 class AppPipelineStack(core.Construct):
 
-    def __init__(self, scope: core.Construct, id: str, props: dict, crs: CommonResourceStack) -> None:
+    def __init__(self, scope: core.Construct, id: str, props: dict, crs: CommonResourceStack, replication_buckets: dict = None) -> None:
         super().__init__(scope, id)
         # github info for codepipeline
         github_repo = props.get("GITHUB_APP_REPO")
@@ -23,6 +24,34 @@ class AppPipelineStack(core.Construct):
         codestar_connection_arn = props.get("CODESTAR_CONN_ARN")
         github_app_arn = props.get("GITHUB_APP_ARN")
         codestar_notify_arn = props.get("CODESTAR_NOTIFY_ARN")
+        techdocs_publish = props.pop("TECHDOCS_PUBLISH_ENABLED", False)
+        # the load tests live in the infra repo
+        self.codestar_connection_arn = codestar_connection_arn
+        self.github_org = github_org
+        self.github_infra_repo = props.get("GITHUB_INFRA_REPO")
+        self.github_infra_branch = props.get("GITHUB_INFRA_BRANCH", "main")
+        # docker build performance
+        build_image = props.pop("APP_BUILD_IMAGE", "STANDARD_5_0")
+        build_compute = props.pop("APP_BUILD_COMPUTE", "SMALL")
+        build_cache_mode = props.pop("APP_BUILD_CACHE_MODE", "pull")
+        build_cache_tag = props.pop("APP_BUILD_CACHE_TAG", "buildcache")
+        build_local_cache = props.pop("APP_BUILD_LOCAL_CACHE", False)
+        # multi-arch images, the stages read this too to pick their image so it stays in props for them
+        build_archs = props.get("APP_BUILD_ARCHITECTURES", ["amd64"])
+        build_images = {
+            "amd64": build_image,
+            "arm64": props.pop("APP_BUILD_ARM_IMAGE", "aws/codebuild/amazonlinux2-aarch64-standard:3.0"),
+        }
+        # seekable oci index so fargate can lazy load the image
+        build_soci_index = props.pop("APP_BUILD_SOCI_INDEX", False)
+        soci_version = props.pop("APP_BUILD_SOCI_VERSION", "0.4.1")
+        # multi-region stages deploy from the ecr replica in their region,
+        # the pipeline copies its artifacts to a bucket per region for those deploys.
+        replica_regions = sorted(replication_buckets or {})
+        if build_cache_mode not in ("pull", "buildkit", "none"):
+            raise ValueError(f"APP_BUILD_CACHE_MODE must be one of pull, buildkit or none, got {build_cache_mode!r}")
+        if not build_archs or set(build_archs) - set(build_images):
+            raise ValueError(f"APP_BUILD_ARCHITECTURES must be a list of {sorted(build_images)}, got {build_archs!r}")
         ### build a codepipeline for building new images and re-deploying to ecs
         ### this will use the backstage app repo as source to catch canges there
         ### execute a docker build and push image to ECR
@@ -36,6 +65,11 @@ class AppPipelineStack(core.Construct):
         with open(r'./app-buildspec.yml') as file:
             build_spec = yaml.full_load(file)
 
+        # created when the first blue/green or load tested stage is added
+        self._blue_green_project = None
+        self._load_test_project = None
+        self._infra_output = None
+
         # create the output artifact space for the pipeline
         self.source_output = codepipeline.Artifact()
         self.build_output = codepipeline.Artifact()
@@ -53,56 +87,199 @@ class AppPipelineStack(core.Construct):
         # make codebuild action to use buildspec.yml and feed in env vars from .env
         # this will build and push new image to ECR repo
 
-        build_project = codebuild.PipelineProject(
-            self, 
-            "CodebuildProject", 
-            project_name="backstage-app-pipeline",
-            build_spec=codebuild.BuildSpec.from_object(build_spec), # has to be compiled at deploy time rather than execution time.
-            environment=codebuild.BuildEnvironment(build_image=codebuild.LinuxBuildImage.STANDARD_4_0, privileged=True),
-        )
+        # codebuild local caching keeps docker layers and the source on the build host between builds
+        # it is best effort, builds that land on a fresh host fall back to the registry cache.
+        # the docker layer cache is only used by the docker daemon, buildkit builds run in a buildx container
+        # and keep their layers in the custom cache path of the buildspec instead
+        if build_local_cache:
+            cache = codebuild.Cache.local(codebuild.LocalCacheMode.DOCKER_LAYER, codebuild.LocalCacheMode.SOURCE, codebuild.LocalCacheMode.CUSTOM)
+        else:
+            cache = None
+
         # add policy to update push to ECR
         policy =  iam.ManagedPolicy.from_aws_managed_policy_name("AmazonEC2ContainerRegistryPowerUser")
-        build_project.role.add_managed_policy(policy)
         # add policy to access secret in build
         secrets_policy=iam.PolicyStatement(
             resources=[github_app_arn],
             actions=['secretsmanager:GetSecretValue'],
         )
-        build_project.add_to_role_policy(secrets_policy)
 
         # code build action will use docker to build new image and push to ECR
         # the buildspec.yaml is in the backstage app repo
         repo_uri = crs.image_repo.repository_uri
         base_repo_uri = f"{props.get('AWS_ACCOUNT')}.dkr.ecr.{props.get('AWS_REGION')}.amazonaws.com"
 
-        build_action = actions.CodeBuildAction(
-            action_name="Docker-Build",
-            project=build_project,
-            input=self.source_output,
-            outputs=[self.build_output],
-            environment_variables={
+        # one docker build per architecture, run in parallel on native build hosts.
+        # a single architecture keeps the original project and tags, 
+        # with more than one each build pushes an arch suffixed tag and a manifest step merges them.
+        multi_arch = len(build_archs) > 1
+        build_actions = []
+        for arch in build_archs:
+            suffix = f"-{arch}" if multi_arch else ""
+
+            build_project = codebuild.PipelineProject(
+                self, 
+                f"CodebuildProject{suffix}", 
+                project_name=f"backstage-app-pipeline{suffix}",
+                build_spec=codebuild.BuildSpec.from_object(build_spec), # has to be compiled at deploy time rather than execution time.
+                environment=codebuild.BuildEnvironment(
+                    build_image=self.build_image(build_images[arch]),
+                    compute_type=getattr(codebuild.ComputeType, build_compute),
+                    privileged=True
+                ),
+                cache=cache,
+            )
+            build_project.role.add_managed_policy(policy)
+            build_project.add_to_role_policy(secrets_policy)
+
+            environment_variables = {
                 "BASE_REPO_URI" : codebuild.BuildEnvironmentVariable(value=base_repo_uri),
                 "GITHUB_APP_ARN": codebuild.BuildEnvironmentVariable(value=github_app_arn),
                 "REPOSITORY_URI": codebuild.BuildEnvironmentVariable(value=repo_uri),
                 "AWS_REGION": codebuild.BuildEnvironmentVariable(value=props.get("AWS_REGION")),
                 "CONTAINER_NAME": codebuild.BuildEnvironmentVariable(value=props.get("CONTAINER_NAME")),
                 "DOCKERFILE": codebuild.BuildEnvironmentVariable(value=props.get("DOCKERFILE", "dockerfile")),
-            },
-        )
+                "BUILD_CACHE_MODE": codebuild.BuildEnvironmentVariable(value=build_cache_mode),
+                "CACHE_TAG": codebuild.BuildEnvironmentVariable(value=build_cache_tag),
+                "IMAGE_SUFFIX": codebuild.BuildEnvironmentVariable(value=suffix),
+                "BUILD_ARCH": codebuild.BuildEnvironmentVariable(value=arch),
+                "LOCAL_CACHE": codebuild.BuildEnvironmentVariable(value="1" if build_local_cache else ""),
+            }
+            # the step writing the final image also writes the image files for the other regions
+            if replica_regions and not multi_arch:
+                environment_variables["REPLICA_REGIONS"] = codebuild.BuildEnvironmentVariable(value=" ".join(replica_regions))
+
+            build_actions.append(
+                actions.CodeBuildAction(
+                    action_name=f"Docker-Build{suffix}",
+                    project=build_project,
+                    input=self.source_output,
+                    outputs=[] if multi_arch else [self.build_output],
+                    environment_variables=environment_variables,
+                )
+            )
+
+        # merge the per arch images into one multi-arch manifest and write the imagedefinitions.json from it
+        manifest_action = None
+        if multi_arch:
+            with open(r'./manifest-buildspec.yml') as file:
+                manifest_spec = yaml.full_load(file)
+
+            manifest_project = codebuild.PipelineProject(
+                self,
+                "ManifestProject",
+                project_name="backstage-app-manifest",
+                build_spec=codebuild.BuildSpec.from_object(manifest_spec),
+                environment=codebuild.BuildEnvironment(build_image=codebuild.LinuxBuildImage.STANDARD_5_0, privileged=True),
+            )
+            manifest_project.role.add_managed_policy(policy)
+
+            environment_variables = {
+                "BASE_REPO_URI" : codebuild.BuildEnvironmentVariable(value=base_repo_uri),
+                "REPOSITORY_URI": codebuild.BuildEnvironmentVariable(value=repo_uri),
+                "AWS_REGION": codebuild.BuildEnvironmentVariable(value=props.get("AWS_REGION")),
+                "CONTAINER_NAME": codebuild.BuildEnvironmentVariable(value=props.get("CONTAINER_NAME")),
+                "ARCHITECTURES": codebuild.BuildEnvironmentVariable(value=" ".join(build_archs)),
+            }
+            if replica_regions:
+                environment_variables["REPLICA_REGIONS"] = codebuild.BuildEnvironmentVariable(value=" ".join(replica_regions))
+
+            manifest_action = actions.CodeBuildAction(
+                action_name="Docker-Manifest",
+                project=manifest_project,
+                input=self.source_output,
+                outputs=[self.build_output],
+                environment_variables=environment_variables,
+            )
+
+        # the index is built from the final image, so it runs after the build or manifest stage
+        # and before any deploy so new tasks can lazy load the image they start with.
+        soci_action = None
+        if build_soci_index:
+            with open(r'./soci-buildspec.yml') as file:
+                soci_spec = yaml.full_load(file)
+
+            soci_project = codebuild.PipelineProject(
+                self,
+                "SociProject",
+                project_name="backstage-app-soci-index",
+                build_spec=codebuild.BuildSpec.from_object(soci_spec),
+                environment=codebuild.BuildEnvironment(
+                    build_image=codebuild.LinuxBuildImage.STANDARD_5_0, 
+                    compute_type=getattr(codebuild.ComputeType, build_compute),
+                    privileged=True
+                ),
+            )
+            soci_project.role.add_managed_policy(policy)
+
+            soci_action = actions.CodeBuildAction(
+                action_name="Soci-Index",
+                project=soci_project,
+                input=self.build_output,
+                environment_variables={
+                    "AWS_REGION": codebuild.BuildEnvironmentVariable(value=props.get("AWS_REGION")),
+                    "ARCHITECTURES": codebuild.BuildEnvironmentVariable(value=" ".join(build_archs)),
+                    "SOCI_VERSION": codebuild.BuildEnvironmentVariable(value=soci_version),
+                },
+            )
+
+        # prebuild techdocs for changed entities and publish them to the techdocs bucket
+        # so backstage doesnt have to build them in the container on request
+        if techdocs_publish and crs.techdocs_bucket is not None:
+            with open(r'./techdocs-buildspec.yml') as file:
+                techdocs_spec = yaml.full_load(file)
+
+            techdocs_project = codebuild.PipelineProject(
+                self,
+                "TechdocsProject",
+                project_name="backstage-techdocs-publish",
+                build_spec=codebuild.BuildSpec.from_object(techdocs_spec),
+                environment=codebuild.BuildEnvironment(build_image=codebuild.LinuxBuildImage.STANDARD_5_0),
+            )
+            crs.techdocs_bucket.grant_read_write(techdocs_project)
+
+            # runs alongside the docker build
+            build_actions.append(
+                actions.CodeBuildAction(
+                    action_name="Techdocs-Publish",
+                    project=techdocs_project,
+                    input=self.source_output,
+                    environment_variables={
+                        "TECHDOCS_S3_BUCKET_NAME": codebuild.BuildEnvironmentVariable(value=crs.techdocs_bucket.bucket_name),
+                        "TECHDOCS_S3_ROOT_PATH": codebuild.BuildEnvironmentVariable(value=crs.techdocs_root_path),
+                        "AWS_REGION": codebuild.BuildEnvironmentVariable(value=props.get("AWS_REGION")),
+                    },
+                )
+            )
 
         # ECS deploy actions will take file made in build stage and update the service with new image
 
-        self.pipeline = codepipeline.Pipeline(self, "backstagepipeline", cross_account_keys=False, pipeline_name="backstage-app-pipeline")
+        self.pipeline = codepipeline.Pipeline(self, "backstagepipeline", 
+            cross_account_keys=False, 
+            pipeline_name="backstage-app-pipeline",
+            cross_region_replication_buckets=replication_buckets or None,
+        )
 
-        self.pipeline.add_stage(
+        self.source_stage = self.pipeline.add_stage(
             stage_name="Source",
             actions=[source_action]
         )
 
         self.pipeline.add_stage(
             stage_name="Build",
-            actions=[build_action]
+            actions=build_actions
         )
+
+        if manifest_action is not None:
+            self.pipeline.add_stage(
+                stage_name="Manifest",
+                actions=[manifest_action]
+            )
+        if soci_action is not None:
+            self.pipeline.add_stage(
+                stage_name="Index",
+                actions=[soci_action]
+            )
         if codestar_notify_arn is not None:
             # pull in existing slackbot channel integration
             slack_channel = chatbot.SlackChannelConfiguration.from_slack_channel_configuration_arn(self, 
@@ -112,7 +289,28 @@ class AppPipelineStack(core.Construct):
             pipe_exec_notify = self.pipeline.notify_on_execution_state_change("pipelinenotification", slack_channel)
             pipe_approval_notify = self.pipeline.notify_on_any_manual_approval_state_change("pipelineapproval", slack_channel)
 
-    def add_deploy_stage( self, name: str, fargate_service: ecs.IBaseService, approval: bool = False, emails: list = []):
+    @staticmethod
+    def build_image(name: str) -> codebuild.IBuildImage:
+        '''
+            resolve a build image from config, either the name of a cdk image constant 
+            eg. 'STANDARD_5_0' or 'AMAZON_LINUX_2_ARM_2', or a codebuild image id 
+            eg. 'aws/codebuild/standard:7.0' or 'aws/codebuild/amazonlinux2-aarch64-standard:3.0'
+        '''
+        if hasattr(codebuild.LinuxBuildImage, name):
+            return getattr(codebuild.LinuxBuildImage, name)
+        if 'aarch64' in name:
+            return codebuild.LinuxArmBuildImage.from_code_build_image_id(name)
+        return codebuild.LinuxBuildImage.from_code_build_image_id(name)
+
+    def add_deploy_stage( self, name: str, stage: StageResourceStack, approval: bool = False, emails: list = []):
+        self.add_deploy_wave(name, {name: stage}, approval, emails)
+
+    def add_deploy_wave( self, name: str, stages: dict, approval: bool = False, emails: list = []):
+        '''
+            add a pipeline stage which deploys every stage in stages, a dict of stage name to StageResourceStack,
+            as parallel actions behind a single optional approval action. 
+            stages in other regions deploy once the primary regions are done.
+        '''
         dps = self.pipeline.add_stage(
             stage_name=name+"-deploy"
         )
@@ -122,11 +320,157 @@ class AppPipelineStack(core.Construct):
                 actions.ManualApprovalAction(action_name=name+"-stage-approval",notify_emails=emails, run_order=runorder)
             )
             runorder+=1
-        dps.add_action(
-            actions.EcsDeployAction(
-                    service=fargate_service,
+        # write forwarding doesnt forward DDL, so the secondary regions wait for the new tasks
+        # in the primary region to run the backstage migrations before they roll theirs.
+        next_runorder = runorder
+        for stage_name, stage in stages.items():
+            if stage.primary:
+                for action in self.deploy_actions(stage_name, stage, runorder):
+                    dps.add_action(action)
+                    next_runorder = max(next_runorder, action.action_properties.run_order + 1)
+        for stage_name, stage in stages.items():
+            if not stage.primary:
+                for action in self.deploy_actions(stage_name, stage, next_runorder):
+                    dps.add_action(action)
+
+    def deploy_actions(self, name: str, stage: StageResourceStack, runorder: int) -> list:
+        # a stage in another region deploys the image from its regional repo,
+        # codepipeline runs its deploy actions in the region of the service.
+        stage_region = core.Stack.of(stage).region
+        if stage.deploy_mode != 'blue_green':
+            deploy_actions = [
+                actions.EcsDeployAction(
+                    service=stage.ecs_stack.service,
                     action_name=name+"-deploy",
-                    input=self.build_output,
+                    input=self.build_output if stage.primary else None,
+                    image_file=None if stage.primary else self.build_output.at_path(f"imagedefinitions-{stage_region}.json"),
                     run_order=runorder
                 )
-        )
+            ]
+        else:
+            # codedeploy needs a task definition template and an appspec on top of the image,
+            # we build those from the task definition cloudformation registered for the stage.
+            deploy_input = codepipeline.Artifact(f"{name}_bluegreen")
+            environment_variables = {
+                "TASK_FAMILY": codebuild.BuildEnvironmentVariable(value=stage.ecs_stack.task_definition.family),
+                "CONTAINER_NAME": codebuild.BuildEnvironmentVariable(value=stage.container_name),
+                "CONTAINER_PORT": codebuild.BuildEnvironmentVariable(value=str(stage.container_port)),
+            }
+            if stage.capacity_strategy:
+                environment_variables["CAPACITY_PROVIDER_STRATEGY"] = codebuild.BuildEnvironmentVariable(value=json.dumps([
+                    {
+                        "CapacityProvider": strategy['CAPACITY_PROVIDER'],
+                        "Base": int(strategy.get('BASE', 0)),
+                        "Weight": int(strategy.get('WEIGHT', 1)),
+                    }
+                    for strategy in stage.capacity_strategy
+                ]))
+            if not stage.primary:
+                environment_variables["TASK_REGION"] = codebuild.BuildEnvironmentVariable(value=stage_region)
+                environment_variables["IMAGE_DETAIL"] = codebuild.BuildEnvironmentVariable(value=f"imageDetail-{stage_region}.json")
+            deploy_actions = [
+                actions.CodeBuildAction(
+                    action_name=name+"-prepare",
+                    project=self.blue_green_project(),
+                    input=self.build_output,
+                    outputs=[deploy_input],
+                    run_order=runorder,
+                    environment_variables=environment_variables,
+                ),
+                actions.CodeDeployEcsDeployAction(
+                    action_name=name+"-deploy",
+                    deployment_group=stage.deployment_group,
+                    task_definition_template_input=deploy_input,
+                    app_spec_template_input=deploy_input,
+                    container_image_inputs=[
+                        actions.CodeDeployEcsContainerImageInput(input=deploy_input, task_definition_placeholder="IMAGE1_NAME")
+                    ],
+                    run_order=runorder+1
+                ),
+            ]
+
+        # load test the stage once its deployed, a failed test stops the pipeline before the next wave
+        if stage.load_test_args is not None:
+            environment_variables = {
+                "TARGET_FQDN": codebuild.BuildEnvironmentVariable(value=stage.fqdn),
+                "STAGE_NAME": codebuild.BuildEnvironmentVariable(value=name),
+                "LOAD_TEST_ARGS": codebuild.BuildEnvironmentVariable(value=stage.load_test_args),
+                "AWS_REGION": codebuild.BuildEnvironmentVariable(value=core.Stack.of(self).region),
+            }
+            if stage.load_test_token_arn is not None:
+                environment_variables["LOAD_TEST_TOKEN"] = codebuild.BuildEnvironmentVariable(
+                    type=codebuild.BuildEnvironmentVariableType.SECRETS_MANAGER,
+                    value=stage.load_test_token_arn,
+                )
+                self.load_test_project().add_to_role_policy(iam.PolicyStatement(
+                    resources=[stage.load_test_token_arn],
+                    actions=['secretsmanager:GetSecretValue'],
+                ))
+            deploy_actions.append(
+                actions.CodeBuildAction(
+                    action_name=name+"-load-test",
+                    project=self.load_test_project(),
+                    input=self.infra_output(),
+                    outputs=[codepipeline.Artifact(f"{name}_loadtest")],
+                    run_order=runorder+len(deploy_actions),
+                    environment_variables=environment_variables,
+                )
+            )
+        return deploy_actions
+
+    def blue_green_project(self) -> codebuild.PipelineProject:
+        # one project shared by all the blue/green stages
+        if self._blue_green_project is None:
+            with open(r'./bluegreen-buildspec.yml') as file:
+                blue_green_spec = yaml.full_load(file)
+
+            self._blue_green_project = codebuild.PipelineProject(
+                self,
+                "BlueGreenProject",
+                project_name="backstage-app-bluegreen-prepare",
+                build_spec=codebuild.BuildSpec.from_object(blue_green_spec),
+                environment=codebuild.BuildEnvironment(build_image=codebuild.LinuxBuildImage.STANDARD_5_0),
+            )
+            self._blue_green_project.add_to_role_policy(iam.PolicyStatement(
+                resources=["*"],
+                actions=['ecs:DescribeTaskDefinition'],
+            ))
+        return self._blue_green_project
+
+    def infra_output(self) -> codepipeline.Artifact:
+        # the infra repo is only a source of the load tests, so it doesnt trigger the app pipeline
+        if self._infra_output is None:
+            self._infra_output = codepipeline.Artifact("infra_source")
+            self.source_stage.add_action(
+                actions.CodeStarConnectionsSourceAction(
+                    action_name="Github-Infra-Source",
+                    connection_arn=self.codestar_connection_arn,
+                    repo=self.github_infra_repo,
+                    owner=self.github_org,
+                    branch=self.github_infra_branch,
+                    output=self._infra_output,
+                    trigger_on_push=False,
+                )
+            )
+        return self._infra_output
+
+    def load_test_project(self) -> codebuild.PipelineProject:
+        # one project shared by all the load tested stages
+        if self._load_test_project is None:
+            with open(r'./loadtest-buildspec.yml') as file:
+                load_test_spec = yaml.full_load(file)
+
+            self._load_test_project = codebuild.PipelineProject(
+                self,
+                "LoadTestProject",
+                project_name="backstage-app-load-test",
+                build_spec=codebuild.BuildSpec.from_object(load_test_spec),
+                environment=codebuild.BuildEnvironment(build_image=codebuild.LinuxBuildImage.STANDARD_5_0),
+                timeout=core.Duration.minutes(30),
+            )
+            self._load_test_project.add_to_role_policy(iam.PolicyStatement(
+                resources=["*"],
+                actions=['cloudwatch:PutMetricData'],
+                conditions={"StringEquals": {"cloudwatch:namespace": "Backstage/LoadTest"}},
+            ))
+        return self._load_test_project
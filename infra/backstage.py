@@ -7,14 +7,43 @@ from aws_cdk import (
 from .common_resources import CommonResourceStack
 from .stage_resources import StageResourceStack
 from .app_pipeline import AppPipelineStack
+from .region_stack import BackstageRegionStack, RegionArtifactStack
 
 class BackstageStack(core.Stack):
 
     def __init__(self, scope: core.Construct, construct_id: str, props: dict, stages: dict, **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
-        crs = CommonResourceStack( self, "infra-common-resources", props)
-        pipeline = AppPipelineStack(self, 'backstage-app-pipeline', props, crs)
+        # multi-region stages run in every one of their REGIONS, this stack holds the primary region 
+        # and a stack per other region holds the rest. the pipeline needs an artifact bucket in each
+        # of those regions before it can deploy there, so they get stacks which deploy first.
+        replica_regions = []
+        for stage in stages.values():
+            regions = stage.get('REGIONS', props.get('REGIONS', []))
+            replica_regions += [region for region in regions if region != self.region and region not in replica_regions]
+        self.artifact_stacks = dict()
+        self.region_stacks = dict()
+        for region in replica_regions:
+            artifact_stack = RegionArtifactStack(scope, f"{construct_id}-artifacts-{region}", 
+                env=core.Environment(account=self.account, region=region),
+            )
+            self.add_dependency(artifact_stack)
+            self.artifact_stacks[region] = artifact_stack
+
+        # the common resources and the app pipeline pop the settings they read, the stages start 
+        # from what is left so those dont go into the ECS container env either.
+        # the other regions build their own common resources from the full settings.
+        region_props = dict(props)
+        props = dict(props)
+        crs = CommonResourceStack( self, "infra-common-resources", props, replica_regions=replica_regions)
+        pipeline = AppPipelineStack(self, 'backstage-app-pipeline', props, crs, 
+            replication_buckets={region: artifact_stack.bucket for region, artifact_stack in self.artifact_stacks.items()},
+        )
+
+        # stages are grouped into deploy waves, stages in the same wave deploy in parallel 
+        # and waves run in the order they first appear in the stages dict.
+        # a stage without a wave is a wave of its own, so by default stages deploy one after the other.
+        waves = dict()
 
         # we add deploy stages to the pipeline based on stages dict.
         for name,stage in stages.items():
@@ -22,13 +51,37 @@ class BackstageStack(core.Stack):
             # dont pass these into the ECS container env.
             approval = stage.pop('STAGE_APPROVAL', False)
             emails = stage.pop('APPROVAL_EMAILS', None)
-            # overload the shared env vars with those for the stage specifics if required. 
-            props = {
+            wave = stage.pop('STAGE_WAVE', None)
+            # overload the shared env vars with those for the stage specifics if required.
+            # each stage gets its own copy so settings from one stage dont leak into the next.
+            stage_props = {
                 **props,
                 **stage
             }
-            srs = StageResourceStack(self, name, props, crs)
+            StageResourceStack.validate(name, stage_props)
+            srs = StageResourceStack(self, name, stage_props, crs)
+
+            wave_name = name if wave is None else f"wave-{wave}"
+            deploy_wave = waves.setdefault(wave_name, {'stages': dict(), 'approval': False, 'emails': []})
+            deploy_wave['stages'][name] = srs
 
-            # add a ECS deploy stage with the stage specific service, and an approval stage if requested.
-            pipeline.add_deploy_stage(name, srs.ecs_stack.service, approval, emails)
+            # the stage in its other regions deploys in the same wave as the primary.
+            for region in stage_props.get('REGIONS', []):
+                if region == self.region:
+                    continue
+                if region not in self.region_stacks:
+                    region_stack = BackstageRegionStack(scope, f"{construct_id}-{region}", region_props, 
+                        primary_region=self.region, 
+                        env=core.Environment(account=self.account, region=region),
+                    )
+                    # the secondary databases join the global databases of the primary
+                    region_stack.add_dependency(self)
+                    self.region_stacks[region] = region_stack
+                deploy_wave['stages'][f"{name}-{region}"] = self.region_stacks[region].add_stage(name, {**props, **stage})
+            # any stage asking for approval gates the whole wave
+            deploy_wave['approval'] = deploy_wave['approval'] or approval
+            deploy_wave['emails'] += [email for email in emails or [] if email not in deploy_wave['emails']]
 
+        # add a deploy stage per wave with the stage specific services, and an approval action if requested.
+        for wave_name, deploy_wave in waves.items():
+            pipeline.add_deploy_wave(wave_name, deploy_wave['stages'], deploy_wave['approval'], deploy_wave['emails'] or None)
@@ -0,0 +1,179 @@
+
+from aws_cdk import (
+    core,
+    aws_ecs as ecs,
+    aws_ecs_patterns as ecs_patterns,
+    aws_elasticloadbalancingv2 as elbv2,
+    aws_codedeploy as codedeploy,
+    aws_cloudwatch as cloudwatch,
+    aws_iam as iam,
+    aws_certificatemanager as acm,
+)
+from .common_resources import CommonResourceStack
+from .validation import as_int
+
+
+class BlueGreenStack(core.Construct):
+    '''
+        codedeploy blue/green deployments for a stage with DEPLOY_MODE 'blue_green', canary traffic
+        shifting with a rollback on alarms. the service needs the codedeploy deployment controller
+        when it is created, so the stage creates this construct first and calls attach() once its service exists.
+
+        deploy_mode
+        enabled
+        deployment_controller
+        green_target_group
+        test_listener
+        latency_alarm
+        error_alarm
+        codedeploy_app
+        deployment_group
+    '''
+    def __init__(self, scope: core.Construct, id: str, props: dict) -> None:
+        super().__init__(scope, id)
+
+        # rolling ecs deploys or codedeploy blue/green
+        self.deploy_mode = props.pop("DEPLOY_MODE", 'rolling')
+        self.enabled = self.deploy_mode == 'blue_green'
+        self.deploy_config = props.pop("BLUE_GREEN_DEPLOY_CONFIG", 'CodeDeployDefault.ECSCanary10Percent5Minutes')
+        self.test_port = int(props.pop("BLUE_GREEN_TEST_PORT", 9443))
+        self.termination_wait = int(props.pop("BLUE_GREEN_TERMINATION_WAIT", 5))
+        self.p95_latency = float(props.pop("BLUE_GREEN_P95_LATENCY", 2))
+        self.error_count = int(props.pop("BLUE_GREEN_5XX_COUNT", 10))
+
+        self.name = scope.node.id
+        self.deployment_controller = ecs.DeploymentController(type=ecs.DeploymentControllerType.CODE_DEPLOY) if self.enabled else None
+        self.green_target_group = None
+        self.test_listener = None
+        self.latency_alarm = None
+        self.error_alarm = None
+        self.codedeploy_app = None
+        self.deployment_group = None
+
+    def attach(self, ecs_stack: ecs_patterns.ApplicationLoadBalancedFargateService, crs: CommonResourceStack,
+               certificate: acm.ICertificate, container_port: int, open_listener: bool = True) -> None:
+        if not self.enabled:
+            return
+
+        # cloudformation cant change the task definition or capacity provider strategy of a service
+        # controlled by codedeploy. the service runs the latest revision of the family, so new revisions
+        # stay out of its diff and are rolled out by the next blue/green deployment, which also
+        # applies the strategy (see app_pipeline). the service starts on on demand FARGATE until then.
+        cfn_service = ecs_stack.service.node.default_child
+        cfn_service.add_property_override("TaskDefinition", ecs_stack.task_definition.family)
+        ecs_stack.service.node.add_dependency(ecs_stack.task_definition)
+
+        # a second target group and a test listener for codedeploy to shift traffic between,
+        # and alarms on the live traffic to roll back on.
+        self.green_target_group = elbv2.ApplicationTargetGroup(self, "GreenTargetGroup",
+            vpc=crs.vpc,
+            port=container_port,
+            protocol=elbv2.ApplicationProtocol.HTTP,
+            target_type=elbv2.TargetType.IP,
+        )
+        self.test_listener = ecs_stack.load_balancer.add_listener("TestListener",
+            port=self.test_port,
+            protocol=elbv2.ApplicationProtocol.HTTPS,
+            certificates=[elbv2.ListenerCertificate.from_certificate_manager(certificate)],
+            default_target_groups=[self.green_target_group],
+            open=open_listener,
+        )
+
+        self.latency_alarm = cloudwatch.Alarm(self, "DeployLatencyAlarm",
+            alarm_description=f"{self.name} backstage p95 latency during deployment",
+            metric=ecs_stack.load_balancer.metric_target_response_time(statistic='p95', period=core.Duration.minutes(1)),
+            threshold=self.p95_latency,
+            evaluation_periods=2,
+            treat_missing_data=cloudwatch.TreatMissingData.NOT_BREACHING,
+        )
+        self.error_alarm = cloudwatch.Alarm(self, "DeployErrorAlarm",
+            alarm_description=f"{self.name} backstage 5xx responses during deployment",
+            metric=ecs_stack.load_balancer.metric_http_code_target(
+                elbv2.HttpCodeTarget.TARGET_5XX_COUNT, statistic='Sum', period=core.Duration.minutes(1)
+            ),
+            threshold=self.error_count,
+            evaluation_periods=1,
+            treat_missing_data=cloudwatch.TreatMissingData.NOT_BREACHING,
+        )
+
+        codedeploy_role = iam.Role(self, "CodeDeployRole",
+            assumed_by=iam.ServicePrincipal("codedeploy.amazonaws.com"),
+            managed_policies=[iam.ManagedPolicy.from_aws_managed_policy_name("AWSCodeDeployRoleForECS")],
+        )
+
+        # the pipeline deploys by name, so these are fixed rather than generated
+        deploy_name = f"{core.Stack.of(self).stack_name}-{self.name}"
+        self.codedeploy_app = codedeploy.EcsApplication(self, "CodeDeployApp", application_name=deploy_name)
+
+        # cdk v1 has no L2 ecs deployment group so we use the cfn resource
+        deployment_group = codedeploy.CfnDeploymentGroup(self, "DeploymentGroup",
+            application_name=self.codedeploy_app.application_name,
+            deployment_group_name=deploy_name,
+            service_role_arn=codedeploy_role.role_arn,
+            deployment_config_name=self.deploy_config,
+            deployment_style=codedeploy.CfnDeploymentGroup.DeploymentStyleProperty(
+                deployment_type="BLUE_GREEN",
+                deployment_option="WITH_TRAFFIC_CONTROL",
+            ),
+            blue_green_deployment_configuration=codedeploy.CfnDeploymentGroup.BlueGreenDeploymentConfigurationProperty(
+                deployment_ready_option=codedeploy.CfnDeploymentGroup.DeploymentReadyOptionProperty(
+                    action_on_timeout="CONTINUE_DEPLOYMENT",
+                ),
+                terminate_blue_instances_on_deployment_success=codedeploy.CfnDeploymentGroup.BlueInstanceTerminationOptionProperty(
+                    action="TERMINATE",
+                    termination_wait_time_in_minutes=self.termination_wait,
+                ),
+            ),
+            ecs_services=[codedeploy.CfnDeploymentGroup.ECSServiceProperty(
+                cluster_name=crs.ecs_cluster.cluster_name,
+                service_name=ecs_stack.service.service_name,
+            )],
+            load_balancer_info=codedeploy.CfnDeploymentGroup.LoadBalancerInfoProperty(
+                target_group_pair_info_list=[codedeploy.CfnDeploymentGroup.TargetGroupPairInfoProperty(
+                    target_groups=[
+                        codedeploy.CfnDeploymentGroup.TargetGroupInfoProperty(name=ecs_stack.target_group.target_group_name),
+                        codedeploy.CfnDeploymentGroup.TargetGroupInfoProperty(name=self.green_target_group.target_group_name),
+                    ],
+                    prod_traffic_route=codedeploy.CfnDeploymentGroup.TrafficRouteProperty(
+                        listener_arns=[ecs_stack.listener.listener_arn],
+                    ),
+                    test_traffic_route=codedeploy.CfnDeploymentGroup.TrafficRouteProperty(
+                        listener_arns=[self.test_listener.listener_arn],
+                    ),
+                )],
+            ),
+            auto_rollback_configuration=codedeploy.CfnDeploymentGroup.AutoRollbackConfigurationProperty(
+                enabled=True,
+                events=["DEPLOYMENT_FAILURE", "DEPLOYMENT_STOP_ON_ALARM"],
+            ),
+            alarm_configuration=codedeploy.CfnDeploymentGroup.AlarmConfigurationProperty(
+                enabled=True,
+                alarms=[
+                    codedeploy.CfnDeploymentGroup.AlarmProperty(name=self.latency_alarm.alarm_name),
+                    codedeploy.CfnDeploymentGroup.AlarmProperty(name=self.error_alarm.alarm_name),
+                ],
+            ),
+        )
+        deployment_group.add_depends_on(self.codedeploy_app.node.default_child)
+
+        self.deployment_group = codedeploy.EcsDeploymentGroup.from_ecs_deployment_group_attributes(self, "DeploymentGroupRef",
+            application=self.codedeploy_app,
+            deployment_group_name=deploy_name,
+        )
+
+    @staticmethod
+    def validate(name: str, props: dict) -> None:
+        deploy_mode = props.get("DEPLOY_MODE", 'rolling')
+        if deploy_mode not in ('rolling', 'blue_green'):
+            raise ValueError(f"stage '{name}': DEPLOY_MODE must be 'rolling' or 'blue_green', got {deploy_mode!r}")
+        if deploy_mode != 'blue_green':
+            return
+
+        test_port = as_int(name, props, "BLUE_GREEN_TEST_PORT", 9443)
+        if test_port in (80, 443) or not 1 <= test_port <= 65535:
+            raise ValueError(f"stage '{name}': BLUE_GREEN_TEST_PORT must be a free port other than 80 and 443")
+        if not 0 <= as_int(name, props, "BLUE_GREEN_TERMINATION_WAIT", 5) <= 2880:
+            raise ValueError(f"stage '{name}': BLUE_GREEN_TERMINATION_WAIT must be between 0 and 2880 minutes")
+        # request count scaling follows one target group, which is only live until the next swap
+        if props.get("SCALING_TARGET_REQUESTS") is not None:
+            raise ValueError(f"stage '{name}': SCALING_TARGET_REQUESTS can't be used with blue_green deploys, use SCALING_TARGET_CPU")
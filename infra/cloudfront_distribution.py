@@ -0,0 +1,146 @@
+
+from aws_cdk import (
+    core,
+    aws_ec2 as ec2,
+    aws_ecs_patterns as ecs_patterns,
+    aws_certificatemanager as acm,
+    aws_route53 as route53,
+    aws_route53_targets as targets,
+    aws_cloudfront as cloudfront,
+    aws_cloudfront_origins as origins,
+)
+from .validation import as_int
+
+
+class CloudFrontStack(core.Construct):
+    '''
+        cloudfront in front of a stage's ALB, the static bundles are cached at the edge and the rest
+        passes through to backstage. the stage fqdn points at the distribution and the ALB moves to
+        its own origin name, which the stage needs before it creates its cert and service,
+        so the stage creates this construct first and calls distribute() once its service exists.
+
+        enabled
+        origin_fqdn
+        cloudfront_cert
+        distribution
+    '''
+    def __init__(self, scope: core.Construct, id: str, props: dict) -> None:
+        super().__init__(scope, id)
+
+        host_name = props.get("HOST_NAME", 'backstage')
+        domain_name = props.get("DOMAIN_NAME", 'example.com')
+        self.enabled = props.pop("CLOUDFRONT_ENABLED", False)
+        self.acm_arn = props.pop("CLOUDFRONT_ACM_ARN", None)
+        self.prefix_list = props.pop("CLOUDFRONT_PREFIX_LIST_ID", None)
+        # the cloudfront prefix list id differs per region
+        if isinstance(self.prefix_list, dict):
+            self.prefix_list = self.prefix_list.get(core.Stack.of(self).region)
+        self.static_paths = props.pop("CLOUDFRONT_STATIC_PATHS", ['/static/*'])
+        self.static_ttl = int(props.pop("CLOUDFRONT_STATIC_TTL_DAYS", 365))
+        self.price_class = props.pop("CLOUDFRONT_PRICE_CLASS", 'PRICE_CLASS_100')
+
+        self.name = scope.node.id
+        self.fqdn = f"{host_name}.{domain_name}"
+        self.origin_fqdn = f"{host_name}-origin.{domain_name}"
+        self.cloudfront_cert = None
+        self.distribution = None
+
+    def distribute(self, ecs_stack: ecs_patterns.ApplicationLoadBalancedFargateService, hosted_zone: route53.IHostedZone, 
+                   certificate: acm.ICertificate, primary: bool = True) -> None:
+        if not self.enabled:
+            return
+
+        # only cloudfront origin facing addresses can reach the ALB
+        ecs_stack.load_balancer.connections.allow_from(
+            ec2.Peer.prefix_list(self.prefix_list), ec2.Port.tcp(443)
+        )
+
+        # one distribution in the primary region, its origin name resolves to the closest region
+        if not primary:
+            return
+
+        # cloudfront certs have to live in us-east-1, outside it CLOUDFRONT_ACM_ARN is required.
+        # a cross region DnsValidatedCertificate would need a lambda asset the pipeline doesnt publish.
+        if self.acm_arn is not None:
+            self.cloudfront_cert = acm.Certificate.from_certificate_arn(self, 'CloudfrontCertificate', self.acm_arn)
+        else:
+            self.cloudfront_cert = certificate
+
+        alb_origin = origins.HttpOrigin(self.origin_fqdn, protocol_policy=cloudfront.OriginProtocolPolicy.HTTPS_ONLY)
+
+        # everything dynamic goes straight through to backstage
+        passthrough = cloudfront.BehaviorOptions(
+            origin=alb_origin,
+            cache_policy=cloudfront.CachePolicy.CACHING_DISABLED,
+            origin_request_policy=cloudfront.OriginRequestPolicy.ALL_VIEWER,
+            allowed_methods=cloudfront.AllowedMethods.ALLOW_ALL,
+            viewer_protocol_policy=cloudfront.ViewerProtocolPolicy.REDIRECT_TO_HTTPS,
+            compress=True,
+        )
+
+        # bundles are content hashed so they can be cached for a long time
+        static_cache_policy = cloudfront.CachePolicy(self, "StaticCachePolicy",
+            comment=f"{self.name} backstage static assets",
+            default_ttl=core.Duration.days(self.static_ttl),
+            max_ttl=core.Duration.days(self.static_ttl),
+            min_ttl=core.Duration.days(1),
+            enable_accept_encoding_gzip=True,
+            enable_accept_encoding_brotli=True,
+        )
+        static = cloudfront.BehaviorOptions(
+            origin=alb_origin,
+            cache_policy=static_cache_policy,
+            allowed_methods=cloudfront.AllowedMethods.ALLOW_GET_HEAD,
+            viewer_protocol_policy=cloudfront.ViewerProtocolPolicy.REDIRECT_TO_HTTPS,
+            compress=True,
+        )
+
+        # behaviors are matched in order, so static paths win over the api passthrough
+        behaviors = {path: static for path in self.static_paths}
+        behaviors['/api/*'] = passthrough
+
+        self.distribution = cloudfront.Distribution(self, "Distribution",
+            comment=f"{self.name} backstage",
+            default_behavior=passthrough,
+            additional_behaviors=behaviors,
+            domain_names=[self.fqdn],
+            certificate=self.cloudfront_cert,
+            price_class=getattr(cloudfront.PriceClass, self.price_class),
+        )
+
+        cloudfront_target = route53.RecordTarget.from_alias(targets.CloudFrontTarget(self.distribution))
+        route53.ARecord(self, "CloudfrontAliasRecord",
+            zone=hosted_zone,
+            record_name=self.fqdn,
+            target=cloudfront_target,
+        )
+        route53.AaaaRecord(self, "CloudfrontAliasRecordIpv6",
+            zone=hosted_zone,
+            record_name=self.fqdn,
+            target=cloudfront_target,
+        )
+
+    @staticmethod
+    def validate(name: str, props: dict) -> None:
+        if not props.get("CLOUDFRONT_ENABLED", False):
+            return
+
+        if not props.get("CLOUDFRONT_PREFIX_LIST_ID"):
+            raise ValueError(f"stage '{name}': CLOUDFRONT_PREFIX_LIST_ID is required to lock the ALB down to cloudfront")
+        # every region locks its ALB down with the prefix list id of that region
+        regions = props.get("REGIONS", [])
+        prefix_lists = props["CLOUDFRONT_PREFIX_LIST_ID"]
+        if len(regions) > 1 and not (isinstance(prefix_lists, dict) and set(regions) <= set(prefix_lists)):
+            raise ValueError(f"stage '{name}': CLOUDFRONT_PREFIX_LIST_ID must map every one of REGIONS to its cloudfront prefix list id")
+        # cloudfront only takes certs from us-east-1, without CLOUDFRONT_ACM_ARN the stage cert is reused there
+        cloudfront_acm_arn = props.get("CLOUDFRONT_ACM_ARN") or props.get("ACM_ARN")
+        if cloudfront_acm_arn is not None and str(cloudfront_acm_arn).split(':')[3:4] != ['us-east-1']:
+            key = "CLOUDFRONT_ACM_ARN" if props.get("CLOUDFRONT_ACM_ARN") else "ACM_ARN"
+            raise ValueError(f"stage '{name}': CloudFront needs a us-east-1 cert, {key} {cloudfront_acm_arn!r} isn't one")
+        if props.get("CLOUDFRONT_ACM_ARN") is None and props.get("AWS_REGION", 'us-east-1') != 'us-east-1':
+            raise ValueError(f"stage '{name}': CLOUDFRONT_ACM_ARN is required for CloudFront outside us-east-1")
+        if as_int(name, props, "CLOUDFRONT_STATIC_TTL_DAYS", 365) < 1:
+            raise ValueError(f"stage '{name}': CLOUDFRONT_STATIC_TTL_DAYS must be at least 1")
+        price_classes = ['PRICE_CLASS_100', 'PRICE_CLASS_200', 'PRICE_CLASS_ALL']
+        if props.get("CLOUDFRONT_PRICE_CLASS", 'PRICE_CLASS_100') not in price_classes:
+            raise ValueError(f"stage '{name}': CLOUDFRONT_PRICE_CLASS must be one of {price_classes}")
@@ -7,6 +7,8 @@ from aws_cdk import (
     aws_ecr as ecr,
     aws_iam as iam,
     aws_rds as rds,
+    aws_s3 as s3,
+    aws_sns as sns,
     aws_secretsmanager as secrets,
 )
 
@@ -17,24 +19,68 @@ class CommonResourceStack(core.Construct):
         vpc
         db_subnet_group
         fargate_sg
+        endpoint_sg
         aurora_sg
         aurora_instance
         docker_asset
         task_role
         ecs_cluster
         ecs_task_options
+        techdocs_bucket
+        techdocs_root_path
+        alarm_topic
+
+        the primary region owns the image repo and techdocs bucket and replicates images to replica_regions.
+        in the other regions of a multi-region deployment primary_region is set, 
+        and the repo and bucket are imported from it by name.
     '''
-    def __init__(self, scope: core.Construct, id: str, props: dict) -> None:
+    def __init__(self, scope: core.Construct, id: str, props: dict, primary_region: str = None, replica_regions: list = None) -> None:
         super().__init__(scope, id)
+        region = core.Stack.of(self).region
 
         db_port = int(props.get("POSTGRES_PORT", 5432))
         container_name = props.get("CONTAINER_NAME", 'backstage')
         ecr_repo_name = props.get("ECR_REPO_NAME", "aws-cdk/assets")
+        techdocs_enabled = props.pop("TECHDOCS_BUCKET_ENABLED", False)
+        techdocs_bucket_name = props.pop("TECHDOCS_BUCKET_NAME", None)
+        container_insights = props.pop("CONTAINER_INSIGHTS", False)
+        alarm_topic_arn = props.pop("ALARM_TOPIC_ARN", None)
+        codestar_notify_arn = props.get("CODESTAR_NOTIFY_ARN", None)
+        # vpc layout, changing these on a deployed vpc replaces its subnets and everything in them
+        vpc_max_azs = int(props.pop("VPC_MAX_AZS", 2))
+        vpc_cidr = props.pop("VPC_CIDR", None)
+        nat_gateways = props.pop("NAT_GATEWAYS", None)
+        public_subnet_mask = props.pop("VPC_PUBLIC_SUBNET_MASK", None)
+        private_subnet_mask = props.pop("VPC_PRIVATE_SUBNET_MASK", None)
+        vpc_endpoints = props.pop("VPC_ENDPOINTS", False)
+        # aurora, redis, efs and the endpoints go in the private subnets, which route out through a nat gateway
+        if nat_gateways is not None and int(nat_gateways) < 1:
+            raise ValueError(f"NAT_GATEWAYS must be at least 1, the private subnets need a nat gateway, got {nat_gateways!r}")
+
+        # without masks we keep the default public/private subnet pair per az
+        if public_subnet_mask is not None or private_subnet_mask is not None:
+            subnet_configuration = [
+                ec2.SubnetConfiguration(
+                    name="Public", 
+                    subnet_type=ec2.SubnetType.PUBLIC, 
+                    cidr_mask=int(public_subnet_mask) if public_subnet_mask is not None else None,
+                ),
+                ec2.SubnetConfiguration(
+                    name="Private", 
+                    subnet_type=ec2.SubnetType.PRIVATE, 
+                    cidr_mask=int(private_subnet_mask) if private_subnet_mask is not None else None,
+                ),
+            ]
+        else:
+            subnet_configuration = None
 
         self.vpc = ec2.Vpc(
             self, 
             "ECS-VPC",
-            max_azs=2,
+            max_azs=vpc_max_azs,
+            cidr=vpc_cidr,
+            nat_gateways=int(nat_gateways) if nat_gateways is not None else None, # Default is one per az
+            subnet_configuration=subnet_configuration,
         )
 
         # Define SGs so Fargate and no-one else can talk to aurora securly
@@ -55,30 +101,141 @@ class CommonResourceStack(core.Construct):
         # default egress rules are for any, so we just need an ingress rule
         # to allow fargate to reach the aurora cluster and protect its access from elsewhere
         self.aurora_sg.add_ingress_rule(peer=self.fargate_sg, connection=ec2.Port.tcp(db_port))
+        # an rds proxy sits in the aurora group, so members of the group need to reach each other
+        self.aurora_sg.add_ingress_rule(peer=self.aurora_sg, connection=ec2.Port.tcp(db_port))
 
-        self.aurora_instance = rds.InstanceProps(
-            vpc=self.vpc,
-            instance_type= ec2.InstanceType.of(ec2.InstanceClass.BURSTABLE3, ec2.InstanceSize.MEDIUM),
-            vpc_subnets= ec2.SubnetSelection(subnet_type=ec2.SubnetType.PRIVATE),
-            security_groups=[self.aurora_sg],   
-        )
+        self.aurora_instance = self.instance_props()
+
+        # endpoints keep image pulls, secret fetches and log writes from the tasks off the nat gateways
+        if vpc_endpoints:
+            self.endpoint_sg = ec2.SecurityGroup(
+                self, "endpoint-sec-group",
+                security_group_name="EndpointSecGroup",
+                description='Security group for VPC interface endpoints',
+                vpc=self.vpc
+            )
+            self.endpoint_sg.add_ingress_rule(peer=self.fargate_sg, connection=ec2.Port.tcp(443))
+
+            # ecr stores the image layers in s3, so the gateway endpoint carries most of a pull
+            self.vpc.add_gateway_endpoint("S3Endpoint", service=ec2.GatewayVpcEndpointAwsService.S3)
+            interface_endpoints = {
+                "EcrApiEndpoint": ec2.InterfaceVpcEndpointAwsService.ECR,
+                "EcrDockerEndpoint": ec2.InterfaceVpcEndpointAwsService.ECR_DOCKER,
+                "SecretsManagerEndpoint": ec2.InterfaceVpcEndpointAwsService.SECRETS_MANAGER,
+                "LogsEndpoint": ec2.InterfaceVpcEndpointAwsService.CLOUDWATCH_LOGS,
+                "StsEndpoint": ec2.InterfaceVpcEndpointAwsService.STS,
+            }
+            for endpoint_id, service in interface_endpoints.items():
+                self.vpc.add_interface_endpoint(endpoint_id,
+                    service=service,
+                    private_dns_enabled=True,
+                    open=False,
+                    security_groups=[self.endpoint_sg],
+                    subnets=ec2.SubnetSelection(subnet_type=ec2.SubnetType.PRIVATE),
+                )
+        else:
+            self.endpoint_sg = None
 
         # We either create or pull in an ECR repo for the app pipeline and ECS to use. 
         # on inital deploy of ECS no image will be found, but the app pipeline should build and push a new image
-        if ecr_repo_name is None:
+        if primary_region is not None:
+            # ecr replication keeps a copy of the primary repo under the same name in this region
+            self.image_repo = ecr.Repository.from_repository_name(self, "repo", ecr_repo_name or container_name)
+        elif ecr_repo_name is None:
             self.image_repo = ecr.Repository(self, "repo", repository_name=container_name, image_scan_on_push=True)
         else:
             self.image_repo = ecr.Repository.from_repository_name(self, "repo", ecr_repo_name)
 
+        # copy every image pushed to the backstage repo to the other regions so their tasks pull from a local repo.
+        # the replication configuration is account wide for the region's registry, this stack owns it
+        # and a deploy replaces any rules set outside it. the filter keeps other repos from being replicated.
+        if replica_regions:
+            ecr.CfnReplicationConfiguration(self, "ImageReplication",
+                replication_configuration=ecr.CfnReplicationConfiguration.ReplicationConfigurationProperty(
+                    rules=[ecr.CfnReplicationConfiguration.ReplicationRuleProperty(
+                        repository_filters=[ecr.CfnReplicationConfiguration.RepositoryFilterProperty(
+                            filter=self.image_repo.repository_name,
+                            filter_type="PREFIX_MATCH",
+                        )],
+                        destinations=[
+                            ecr.CfnReplicationConfiguration.ReplicationDestinationProperty(
+                                region=replica_region, 
+                                registry_id=core.Stack.of(self).account,
+                            )
+                            for replica_region in replica_regions
+                        ],
+                    )],
+                ),
+            )
+
         # Now make the ECS cluster, Task def, and Service
-        self.ecs_cluster = ecs.Cluster(self, "BackstageCluster", vpc=self.vpc)
+        # stages pick their mix of on demand and spot with a capacity provider strategy
+        self.ecs_cluster = ecs.Cluster(self, "BackstageCluster", 
+            vpc=self.vpc, 
+            # the app pipeline in the primary region deploys to other regions by name
+            cluster_name=core.Stack.of(self).stack_name if primary_region is not None else None,
+            container_insights=container_insights,
+            enable_fargate_capacity_providers=True,
+        )
 
         # lets create a named role so its easy to find and modify policies for
         # This is the role which enables the container access to AWS services.
         self.task_role = iam.Role(
             self,
             "fargate-task-role",
-            role_name='Backstage-Fargate-Task-Role',
+            # role names are global, so other regions get their own
+            role_name='Backstage-Fargate-Task-Role' if primary_region is None else f'Backstage-Fargate-Task-Role-{region}',
             assumed_by= iam.ServicePrincipal("ecs-tasks.amazonaws.com")
         )
 
+        # stage alarms publish to one topic. chatbot channel configurations cant be changed through 
+        # an imported arn, so the topic created for the CODESTAR_NOTIFY_ARN channel has to be added 
+        # to that channel once, or ALARM_TOPIC_ARN can name a topic the channel already has.
+        if alarm_topic_arn:
+            self.alarm_topic = sns.Topic.from_topic_arn(self, "alarm-topic", alarm_topic_arn)
+        elif codestar_notify_arn:
+            self.alarm_topic = sns.Topic(self, "alarm-topic", topic_name=f"{core.Stack.of(self).stack_name}-alarms")
+        else:
+            self.alarm_topic = None
+
+        # prebuilt techdocs are published to s3 by the app pipeline and read by backstage from there,
+        # the bucket stays private and the docs are served through backstage
+        self.techdocs_bucket = None
+        self.techdocs_root_path = 'api/techdocs/static/docs'
+        if techdocs_enabled and primary_region is not None:
+            # other regions read the docs from the primary bucket, which needs a fixed name to be found
+            if techdocs_bucket_name is not None:
+                self.techdocs_bucket = s3.Bucket.from_bucket_attributes(self, "techdocs-bucket", 
+                    bucket_name=techdocs_bucket_name, 
+                    region=primary_region,
+                )
+                self.techdocs_bucket.grant_read(self.task_role)
+        elif techdocs_enabled:
+            self.techdocs_bucket = s3.Bucket(
+                self, "techdocs-bucket",
+                bucket_name=techdocs_bucket_name,
+                block_public_access=s3.BlockPublicAccess.BLOCK_ALL,
+                encryption=s3.BucketEncryption.S3_MANAGED,
+                removal_policy=core.RemovalPolicy.RETAIN,
+            )
+            self.techdocs_bucket.grant_read(self.task_role)
+
+    def instance_props(self, instance_class: str = None, **kwargs) -> rds.InstanceProps:
+        '''
+            aurora instance props in the shared vpc and aurora security group, 
+            instance_class is the rds class without the 'db.' prefix eg. 'r6g.large' or 'serverless'
+            and defaults to a burstable t3.medium. kwargs are passed on to rds.InstanceProps 
+            eg. parameters or enable_performance_insights
+        '''
+        if instance_class is None:
+            instance_type = ec2.InstanceType.of(ec2.InstanceClass.BURSTABLE3, ec2.InstanceSize.MEDIUM)
+        else:
+            instance_type = ec2.InstanceType(instance_class)
+
+        return rds.InstanceProps(
+            vpc=self.vpc,
+            instance_type= instance_type,
+            vpc_subnets= ec2.SubnetSelection(subnet_type=ec2.SubnetType.PRIVATE),
+            security_groups=[self.aurora_sg],   
+            **kwargs
+        )
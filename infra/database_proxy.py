@@ -0,0 +1,58 @@
+
+from aws_cdk import (
+    core,
+    aws_rds as rds,
+    aws_secretsmanager as secrets,
+)
+from .common_resources import CommonResourceStack
+from .validation import as_int
+
+
+class DatabaseProxyStack(core.Construct):
+    '''
+        an rds proxy in front of the stage's aurora cluster, so scaling out tasks shares a pool of
+        db connections rather than each task opening its own to the writer. POSTGRES_HOST points at the proxy.
+
+        enabled
+        proxy
+    '''
+    def __init__(self, scope: core.Construct, id: str, props: dict, crs: CommonResourceStack,
+                 cluster: rds.DatabaseCluster, credentials: secrets.ISecret) -> None:
+        super().__init__(scope, id)
+
+        self.enabled = props.pop("DB_PROXY_ENABLED", False)
+        max_connections = int(props.pop("DB_PROXY_MAX_CONNECTIONS_PERCENT", 90))
+        idle_timeout = int(props.pop("DB_PROXY_IDLE_TIMEOUT", 1800))
+        borrow_timeout = int(props.pop("DB_PROXY_BORROW_TIMEOUT", 120))
+        require_tls = props.pop("DB_PROXY_REQUIRE_TLS", False)
+        self.proxy = None
+
+        if not self.enabled:
+            return
+
+        # the proxy name defaults to the construct id, which every stage shares
+        self.proxy = rds.DatabaseProxy(self, "PGProxy",
+            db_proxy_name=f"{core.Stack.of(self).stack_name}-{scope.node.id}",
+            proxy_target=rds.ProxyTarget.from_cluster(cluster),
+            secrets=[credentials],
+            vpc=crs.vpc,
+            security_groups=[crs.aurora_sg],
+            max_connections_percent=max_connections,
+            idle_client_timeout=core.Duration.seconds(idle_timeout),
+            borrow_timeout=core.Duration.seconds(borrow_timeout),
+            require_tls=require_tls,
+        )
+        props['POSTGRES_HOST'] = self.proxy.endpoint
+
+    @staticmethod
+    def validate(name: str, props: dict) -> None:
+        if not props.get("DB_PROXY_ENABLED", False):
+            return
+
+        if not 1 <= as_int(name, props, "DB_PROXY_MAX_CONNECTIONS_PERCENT", 90) <= 100:
+            raise ValueError(f"stage '{name}': DB_PROXY_MAX_CONNECTIONS_PERCENT must be between 1 and 100")
+        # rds proxy caps both of these at 8 hours and 5 minutes
+        if not 1 <= as_int(name, props, "DB_PROXY_IDLE_TIMEOUT", 1800) <= 28800:
+            raise ValueError(f"stage '{name}': DB_PROXY_IDLE_TIMEOUT must be between 1 and 28800 seconds")
+        if not 1 <= as_int(name, props, "DB_PROXY_BORROW_TIMEOUT", 120) <= 300:
+            raise ValueError(f"stage '{name}': DB_PROXY_BORROW_TIMEOUT must be between 1 and 300 seconds")
@@ -0,0 +1,93 @@
+
+from aws_cdk import (
+    core,
+    aws_ec2 as ec2,
+    aws_ecs as ecs,
+    aws_efs as efs,
+)
+from .common_resources import CommonResourceStack
+from .validation import as_int
+
+
+class EfsCacheStack(core.Construct):
+    '''
+        an efs cache shared by the stage's tasks, so cloned templates and downloaded data survive
+        deploys and scale events rather than each task fetching them again. the volume is added to
+        the task definition with mount() once the stage has one, EFS_CACHE_PATH goes to the container.
+
+        enabled
+        cache_fs
+        cache_access_point
+    '''
+    def __init__(self, scope: core.Construct, id: str, props: dict, crs: CommonResourceStack) -> None:
+        super().__init__(scope, id)
+
+        self.enabled = props.pop("EFS_CACHE_ENABLED", False)
+        self.cache_path = props.pop("EFS_CACHE_PATH", '/var/cache/backstage')
+        throughput_mode = props.pop("EFS_THROUGHPUT_MODE", 'BURSTING')
+        provisioned_throughput = props.pop("EFS_PROVISIONED_THROUGHPUT_MIBPS", None)
+        self.cache_fs = None
+        self.cache_access_point = None
+
+        if not self.enabled:
+            return
+
+        self.cache_fs = efs.FileSystem(self, "CacheFileSystem",
+            vpc=crs.vpc,
+            vpc_subnets=ec2.SubnetSelection(subnet_type=ec2.SubnetType.PRIVATE),
+            encrypted=True,
+            throughput_mode=efs.ThroughputMode.PROVISIONED if throughput_mode == 'PROVISIONED' else efs.ThroughputMode.BURSTING,
+            provisioned_throughput_per_second=core.Size.mebibytes(int(provisioned_throughput)) if throughput_mode == 'PROVISIONED' else None,
+            lifecycle_policy=efs.LifecyclePolicy.AFTER_14_DAYS,
+            # its a cache, nothing in it needs to outlive the stage
+            removal_policy=core.RemovalPolicy.DESTROY,
+        )
+        # cdk v1 has no elastic throughput mode so we set it on the cfn file system
+        if throughput_mode == 'ELASTIC':
+            self.cache_fs.node.default_child.add_property_override("ThroughputMode", "elastic")
+        self.cache_fs.connections.allow_default_port_from(crs.fargate_sg)
+
+        # the backstage image runs as the node user, uid/gid 1000
+        self.cache_access_point = self.cache_fs.add_access_point("CacheAccessPoint",
+            path="/backstage-cache",
+            create_acl=efs.Acl(owner_uid="1000", owner_gid="1000", permissions="755"),
+            posix_user=efs.PosixUser(uid="1000", gid="1000"),
+        )
+        self.cache_fs.grant(crs.task_role, "elasticfilesystem:ClientMount", "elasticfilesystem:ClientWrite")
+        # so the app config can point its caches and workspaces at the volume
+        props['EFS_CACHE_PATH'] = self.cache_path
+
+    def mount(self, task_definition: ecs.TaskDefinition) -> None:
+        if not self.enabled:
+            return
+
+        # through the access point and over tls with the task role
+        task_definition.add_volume(
+            name="efs-cache",
+            efs_volume_configuration=ecs.EfsVolumeConfiguration(
+                file_system_id=self.cache_fs.file_system_id,
+                transit_encryption="ENABLED",
+                authorization_config=ecs.AuthorizationConfig(
+                    access_point_id=self.cache_access_point.access_point_id,
+                    iam="ENABLED",
+                ),
+            ),
+        )
+        task_definition.default_container.add_mount_points(ecs.MountPoint(
+            container_path=self.cache_path,
+            source_volume="efs-cache",
+            read_only=False,
+        ))
+
+    @staticmethod
+    def validate(name: str, props: dict) -> None:
+        if not props.get("EFS_CACHE_ENABLED", False):
+            return
+
+        throughput_mode = props.get("EFS_THROUGHPUT_MODE", 'BURSTING')
+        if throughput_mode not in ('BURSTING', 'ELASTIC', 'PROVISIONED'):
+            raise ValueError(f"stage '{name}': EFS_THROUGHPUT_MODE must be 'BURSTING', 'ELASTIC' or 'PROVISIONED', got {throughput_mode!r}")
+        if throughput_mode == 'PROVISIONED' and not 1 <= as_int(name, props, "EFS_PROVISIONED_THROUGHPUT_MIBPS", 0) <= 3414:
+            raise ValueError(f"stage '{name}': PROVISIONED throughput needs EFS_PROVISIONED_THROUGHPUT_MIBPS between 1 and 3414")
+        if not str(props.get("EFS_CACHE_PATH", '/var/cache/backstage')).startswith('/'):
+            raise ValueError(f"stage '{name}': EFS_CACHE_PATH must be an absolute path")
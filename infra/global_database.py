@@ -0,0 +1,141 @@
+
+from aws_cdk import (
+    core,
+    aws_ec2 as ec2,
+    aws_iam as iam,
+    aws_rds as rds,
+)
+from .common_resources import CommonResourceStack
+
+
+class GlobalDatabaseStack(core.Construct):
+    '''
+        the aurora global database of a stage with more than one of REGIONS. the cluster in the primary
+        region is the writer, the clusters in the other regions join it as read only clusters which forward
+        writes to the primary. cdk v1 has no global database support, so this uses the cfn resources.
+        the primary stage calls join() with its cluster once it has one, the other regions build their
+        cluster with secondary_cluster(), which never sets master credentials, those come from the primary.
+
+        regions
+        enabled
+        primary
+        global_cluster_id
+        global_cluster
+        cfn_cluster
+        cfn_instances
+    '''
+    def __init__(self, scope: core.Construct, id: str, props: dict, primary_region: str = None) -> None:
+        super().__init__(scope, id)
+
+        # the first of REGIONS is the primary
+        self.regions = props.pop("REGIONS", [])
+        self.enabled = len(self.regions) > 1
+        self.primary = primary_region is None
+        self.global_cluster_id = f"{props.get('TAG_STACK_NAME', 'backstage')}-{scope.node.id}-global"
+        self.global_cluster = None
+        self.cfn_cluster = None
+        self.cfn_instances = []
+
+    def join(self, cluster: rds.DatabaseCluster) -> None:
+        if self.enabled and self.primary:
+            self.global_cluster = rds.CfnGlobalCluster(self, "PGGlobalCluster",
+                global_cluster_identifier=self.global_cluster_id,
+                source_db_cluster_identifier=cluster.cluster_identifier,
+            )
+
+    def secondary_cluster(self, crs: CommonResourceStack, engine: rds.IClusterEngine, instance_props: rds.InstanceProps, 
+                          instances: int, parameters: dict = None, monitoring_interval: int = 0, 
+                          cloudwatch_logs_exports: list = None) -> rds.IDatabaseCluster:
+        '''
+            the cluster of this region, with the same settings the primary stage gives its DatabaseCluster.
+            returns the cluster imported, so the stage can use it like the primary one.
+        '''
+        subnets = crs.vpc.select_subnets(subnet_type=ec2.SubnetType.PRIVATE)
+        subnet_group = rds.CfnDBSubnetGroup(self, "PGSubnets",
+            db_subnet_group_description=f"Subnets for {self.global_cluster_id} secondary database",
+            subnet_ids=subnets.subnet_ids,
+        )
+        if parameters:
+            cluster_parameter_group = rds.ParameterGroup(self, "PGClusterParameters", engine=engine, parameters=parameters)
+            cluster_parameter_group_name = cluster_parameter_group.bind_to_cluster().parameter_group_name
+        else:
+            cluster_parameter_group_name = f"default.{engine.parameter_group_family}"
+
+        self.cfn_cluster = rds.CfnDBCluster(self, "PGCluster",
+            engine=engine.engine_type,
+            engine_version=engine.engine_version.full_version,
+            global_cluster_identifier=self.global_cluster_id,
+            db_cluster_parameter_group_name=cluster_parameter_group_name,
+            db_subnet_group_name=subnet_group.ref,
+            vpc_security_group_ids=[crs.aurora_sg.security_group_id],
+            copy_tags_to_snapshot=True,
+            enable_cloudwatch_logs_exports=cloudwatch_logs_exports,
+        )
+        # cdk v1 doesnt know write forwarding yet
+        self.cfn_cluster.add_property_override("EnableGlobalWriteForwarding", True)
+        self.cfn_cluster.apply_removal_policy(core.RemovalPolicy.SNAPSHOT)
+
+        if instance_props.parameters:
+            instance_parameter_group = rds.ParameterGroup(self, "PGInstanceParameters", engine=engine, parameters=instance_props.parameters)
+            instance_parameter_group_name = instance_parameter_group.bind_to_instance().parameter_group_name
+        else:
+            instance_parameter_group_name = None
+        # the same enhanced monitoring role cdk creates for a DatabaseCluster
+        if monitoring_interval:
+            monitoring_role = iam.Role(self, "PGMonitoringRole",
+                assumed_by=iam.ServicePrincipal("monitoring.rds.amazonaws.com"),
+                managed_policies=[iam.ManagedPolicy.from_aws_managed_policy_name("service-role/AmazonRDSEnhancedMonitoringRole")],
+            )
+        retention_days = {
+            rds.PerformanceInsightRetention.DEFAULT: 7,
+            rds.PerformanceInsightRetention.LONG_TERM: 731,
+        }
+        for index in range(1, instances + 1):
+            instance = rds.CfnDBInstance(self, f"PGInstance{index}",
+                engine=engine.engine_type,
+                engine_version=engine.engine_version.full_version,
+                db_cluster_identifier=self.cfn_cluster.ref,
+                db_instance_class=f"db.{instance_props.instance_type.to_string()}",
+                db_subnet_group_name=subnet_group.ref,
+                db_parameter_group_name=instance_parameter_group_name,
+                publicly_accessible=False,
+                allow_major_version_upgrade=instance_props.allow_major_version_upgrade,
+                enable_performance_insights=instance_props.enable_performance_insights,
+                performance_insights_retention_period=retention_days.get(instance_props.performance_insight_retention),
+                monitoring_interval=monitoring_interval or None,
+                monitoring_role_arn=monitoring_role.role_arn if monitoring_interval else None,
+            )
+            instance.apply_removal_policy(core.RemovalPolicy.DESTROY)
+            # the instances need their nat routes to come up healthy
+            instance.node.add_dependency(subnets.internet_connectivity_established)
+            self.cfn_instances.append(instance)
+
+        return rds.DatabaseCluster.from_database_cluster_attributes(self, "PGDatabase",
+            cluster_identifier=self.cfn_cluster.ref,
+            cluster_endpoint_address=self.cfn_cluster.attr_endpoint_address,
+            reader_endpoint_address=self.cfn_cluster.attr_read_endpoint_address,
+            port=core.Token.as_number(self.cfn_cluster.attr_endpoint_port),
+            security_groups=[crs.aurora_sg],
+            instance_identifiers=[instance.ref for instance in self.cfn_instances],
+            instance_endpoint_addresses=[instance.attr_endpoint_address for instance in self.cfn_instances],
+            engine=engine,
+        )
+
+    @staticmethod
+    def validate(name: str, props: dict) -> None:
+        regions = props.get("REGIONS", [])
+        if regions:
+            if props.get("AWS_REGION", 'us-east-1') not in regions:
+                raise ValueError(f"stage '{name}': REGIONS must include the primary region AWS_REGION {props.get('AWS_REGION', 'us-east-1')!r}")
+            if len(set(regions)) != len(regions):
+                raise ValueError(f"stage '{name}': REGIONS can't repeat a region, got {regions}")
+        if len(regions) <= 1:
+            return
+
+        # aurora global databases dont run on burstable instances,
+        # and write forwarding for postgres needs 14.9, 15.4 or a later major version
+        if props.get("DB_SERVERLESS_MAX_CAPACITY") is None and str(props.get("DB_INSTANCE_CLASS", 't3.medium')).startswith('t'):
+            raise ValueError(f"stage '{name}': a global database needs a non burstable DB_INSTANCE_CLASS eg. 'r6g.large'")
+        version = tuple(int(part) for part in str(props.get("DB_ENGINE_VERSION", '10.14')).split('.'))
+        if version[0] < 14 or version < {14: (14, 9), 15: (15, 4)}.get(version[0], version):
+            raise ValueError(f"stage '{name}': more than one of REGIONS needs DB_ENGINE_VERSION 14.9, 15.4 or later for write forwarding")
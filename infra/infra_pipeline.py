@@ -10,7 +10,7 @@ from aws_cdk import (
 )
 
 class InfraPipelineStack(core.Stack):
-    def __init__(self, scope: core.Construct, id: str, stacks: list, props: dict, **kwargs) -> None:
+    def __init__(self, scope: core.Construct, id: str, stacks: list, props: dict, stack_regions: dict = None, template_buckets: dict = None, **kwargs) -> None:
         super().__init__(scope=scope, id=id, **kwargs)
 
         # github info for codepipeline
@@ -39,7 +39,9 @@ class InfraPipelineStack(core.Stack):
             "CodebuildProject", 
             project_name=id,
             build_spec=codebuild.BuildSpec.from_source_filename('./infra-buildspec.yml'),
-            environment=codebuild.BuildEnvironment(build_image=codebuild.LinuxBuildImage.STANDARD_5_0)
+            environment=codebuild.BuildEnvironment(build_image=codebuild.LinuxBuildImage.STANDARD_5_0),
+            # the buildspec keeps the cdk cli and python requirements in a local custom cache
+            cache=codebuild.Cache.local(codebuild.LocalCacheMode.CUSTOM),
         )
         
         # lookups needed by backstage stack have to have permissions added in order to synth
@@ -69,25 +71,88 @@ class InfraPipelineStack(core.Stack):
             actions=[synth_action]
         )
         
-        for stack in stacks:
-            change_set_name = f"{stack}-changeset"
+        # each stack deploys through codebuild, which skips the stack when its synthesized template
+        # hash matches the one recorded by its last successful deploy and the stack is in a complete state. 
+        # stacks is a list of stack names or lists of stack names, each entry is one deploy stage 
+        # in order, and the stacks in a list deploy in parallel.
+        # stacks in other regions are named in stack_regions with their region, and upload their templates
+        # to the bucket named for them in template_buckets, or deploy without one when there's none.
+        stack_regions = stack_regions or {}
+        template_buckets = template_buckets or {}
+        with open(r'./infra-deploy-buildspec.yml') as file:
+            deploy_spec = yaml.full_load(file)
+
+        deploy_project = codebuild.PipelineProject(
+            self,
+            "DeployProject",
+            project_name=f"{id}-deploy",
+            build_spec=codebuild.BuildSpec.from_object(deploy_spec),
+            environment=codebuild.BuildEnvironment(build_image=codebuild.LinuxBuildImage.STANDARD_5_0),
+        )
+        # cloudformation deploys each stack with a role of its own, like the change set actions did 
+        # with admin_permissions. codebuild can only pass a stack's role to cloudformation, 
+        # and only create change sets for a stack with that stacks role.
+        stack_names = [stack for group in stacks for stack in ([group] if isinstance(group, str) else group)]
+        self.deploy_roles = dict()
+        for stack in stack_names:
+            deploy_role = iam.Role(self, f"{stack}-DeployRole",
+                assumed_by=iam.ServicePrincipal("cloudformation.amazonaws.com"),
+            )
+            deploy_role.add_to_policy(iam.PolicyStatement(
+                resources=["*"],
+                actions=['*'],
+            ))
+            self.deploy_roles[stack] = deploy_role
+            deploy_project.add_to_role_policy(iam.PolicyStatement(
+                resources=[f"arn:aws:cloudformation:*:{self.account}:stack/{stack}/*"],
+                actions=['cloudformation:CreateChangeSet'],
+                conditions={"StringEquals": {"cloudformation:RoleArn": deploy_role.role_arn}},
+            ))
+            deploy_project.add_to_role_policy(iam.PolicyStatement(
+                resources=[deploy_role.role_arn],
+                actions=['iam:PassRole'],
+                conditions={"StringEquals": {"iam:PassedToService": "cloudformation.amazonaws.com"}},
+            ))
+        deploy_project.add_to_role_policy(iam.PolicyStatement(
+            resources=[f"arn:aws:cloudformation:*:{self.account}:stack/{stack}/*" for stack in stack_names],
+            actions=[
+                'cloudformation:DeleteChangeSet',
+                'cloudformation:DescribeChangeSet',
+                'cloudformation:ExecuteChangeSet',
+                'cloudformation:DescribeStacks',
+                'cloudformation:DescribeStackEvents',
+                'cloudformation:GetTemplateSummary',
+            ],
+        ))
+        deploy_project.add_to_role_policy(iam.PolicyStatement(
+            resources=[f"arn:aws:ssm:{self.region}:{self.account}:parameter/{id}/template-hash/*"],
+            actions=['ssm:GetParameter', 'ssm:PutParameter'],
+        ))
+        # the templates are uploaded next to the pipeline artifacts, or to the buckets in the other regions
+        pipeline.artifact_bucket.grant_read_write(deploy_project)
+        if template_buckets:
+            deploy_project.add_to_role_policy(iam.PolicyStatement(
+                resources=[f"arn:aws:s3:::{bucket}/template-deploys/*" for bucket in template_buckets.values()],
+                actions=['s3:PutObject', 's3:GetObject'],
+            ))
+
+        for index, group in enumerate(stacks):
+            group = [group] if isinstance(group, str) else list(group)
             pipeline.add_stage(
-                stage_name=f"Deploy-{stack}",
+                stage_name=f"Deploy-{group[0]}" if len(group) == 1 else f"Deploy-group-{index}",
                 actions=[
-                    actions.CloudFormationCreateReplaceChangeSetAction(
-                        action_name=f"Create-{stack}-ChangeSet",
-                        stack_name=stack,
-                        template_path=synth_output.at_path(f"{stack}.template.json"),
-                        admin_permissions=True,
-                        change_set_name=change_set_name,
-                        run_order=1
-                    ),
-                    actions.CloudFormationExecuteChangeSetAction(
-                        action_name=f"Exec-{stack}-ChangeSet",
-                        stack_name=stack,
-                        change_set_name=change_set_name,
-                        run_order=2
+                    actions.CodeBuildAction(
+                        action_name=f"Deploy-{stack}",
+                        project=deploy_project,
+                        input=synth_output,
+                        environment_variables=self.deploy_variables(
+                            id, stack, 
+                            stack_regions.get(stack, self.region), 
+                            self.deploy_roles[stack].role_arn,
+                            template_buckets.get(stack, None if stack in stack_regions else pipeline.artifact_bucket.bucket_name),
+                        ),
                     )
+                    for stack in group
                 ]
             )
         if codestar_notify_arn is not None:
@@ -97,3 +162,16 @@ class InfraPipelineStack(core.Stack):
                 slack_channel_configuration_arn=codestar_notify_arn,
             )
             pipe_exec_notify = pipeline.notify_on_execution_state_change("pipelinenotification", slack_channel)
+
+    @staticmethod
+    def deploy_variables(id: str, stack: str, region: str, role_arn: str, template_bucket: str = None) -> dict:
+        environment_variables = {
+            "STACK_NAME": codebuild.BuildEnvironmentVariable(value=stack),
+            "STACK_REGION": codebuild.BuildEnvironmentVariable(value=region),
+            "CFN_ROLE_ARN": codebuild.BuildEnvironmentVariable(value=role_arn),
+            "HASH_PARAMETER": codebuild.BuildEnvironmentVariable(value=f"/{id}/template-hash/{stack}"),
+        }
+        # cloudformation only reads templates from a bucket in the region of the stack
+        if template_bucket is not None:
+            environment_variables["ARTIFACT_BUCKET"] = codebuild.BuildEnvironmentVariable(value=template_bucket)
+        return environment_variables
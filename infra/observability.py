@@ -0,0 +1,182 @@
+
+from aws_cdk import (
+    core, 
+    aws_ecs as ecs,
+    aws_ecs_patterns as ecs_patterns,
+    aws_rds as rds,
+    aws_logs as logs,
+    aws_cloudwatch as cloudwatch,
+    aws_cloudwatch_actions as cw_actions,
+    aws_elasticloadbalancingv2 as elbv2,
+)
+from .common_resources import CommonResourceStack
+
+
+class ObservabilityStack(core.Construct):
+    '''
+        container logging, a dashboard and default alarms for a stage.
+        the log driver has to exist before the stage builds its task definition,
+        so the stage creates this construct first and calls monitor() once its service exists.
+
+        log_retention
+        log_group
+        log_driver
+        dashboard
+        alarms
+    '''
+    def __init__(self, scope: core.Construct, id: str, props: dict, crs: CommonResourceStack) -> None:
+        super().__init__(scope, id)
+
+        container_logging = props.pop("CONTAINER_LOGGING", False)
+        self.log_retention = props.pop("LOG_RETENTION", 'ONE_MONTH')
+        self.firelens_enabled = props.pop("FIRELENS_ENABLED", False)
+        firelens_options = props.pop("FIRELENS_OPTIONS", None)
+        self.firelens_image = props.pop("FIRELENS_IMAGE", "public.ecr.aws/aws-observability/aws-for-fluent-bit:stable")
+        self.dashboard_enabled = props.pop("DASHBOARD_ENABLED", False)
+        self.alarms_enabled = props.pop("ALARMS_ENABLED", False)
+        # default alarm thresholds
+        self.alarm_p95_latency = float(props.pop("ALARM_P95_LATENCY", 2))
+        self.alarm_5xx_count = int(props.pop("ALARM_5XX_COUNT", 10))
+        self.alarm_task_cpu = int(props.pop("ALARM_TASK_CPU", 85))
+        self.alarm_task_memory = int(props.pop("ALARM_TASK_MEMORY", 85))
+        self.alarm_db_cpu = int(props.pop("ALARM_DB_CPU", 85))
+
+        self.name = f"{core.Stack.of(self).stack_name}-{scope.node.id}"
+        self.crs = crs
+        self.log_group = None
+        self.log_driver = None
+        self.dashboard = None
+        self.alarms = []
+
+        if not container_logging:
+            return
+
+        self.log_group = logs.LogGroup(self, "LogGroup",
+            log_group_name=f"/ecs/{self.name}",
+            retention=getattr(logs.RetentionDays, self.log_retention),
+            removal_policy=core.RemovalPolicy.DESTROY,
+        )
+
+        if self.firelens_enabled:
+            # fluent bit ships the app logs, by default into the stage log group
+            if firelens_options is None:
+                firelens_options = {
+                    "Name": "cloudwatch_logs",
+                    "region": core.Stack.of(self).region,
+                    "log_group_name": self.log_group.log_group_name,
+                    "log_stream_prefix": "backstage/",
+                    "auto_create_group": "false",
+                }
+            self.log_driver = ecs.LogDrivers.firelens(options=firelens_options)
+            # fluent bit runs with the task role
+            self.log_group.grant_write(crs.task_role)
+        else:
+            self.log_driver = ecs.LogDrivers.aws_logs(stream_prefix="backstage", log_group=self.log_group)
+
+    def monitor(self, ecs_stack: ecs_patterns.ApplicationLoadBalancedFargateService, database: rds.DatabaseCluster, target_groups: list = None) -> None:
+        if self.firelens_enabled and self.log_driver is not None:
+            # the firelens sidecar lives in the task definition alongside the app container
+            ecs_stack.task_definition.add_firelens_log_router("log-router",
+                image=ecs.ContainerImage.from_registry(self.firelens_image),
+                firelens_config=ecs.FirelensConfig(type=ecs.FirelensLogRouterType.FLUENTBIT),
+                logging=ecs.LogDrivers.aws_logs(stream_prefix="firelens", log_group=self.log_group),
+                memory_reservation_mib=50,
+            )
+
+        load_balancer = ecs_stack.load_balancer
+        service = ecs_stack.service
+        one_minute = core.Duration.minutes(1)
+
+        latency = [
+            load_balancer.metric_target_response_time(statistic=stat, label=stat, period=one_minute)
+            for stat in ('p50', 'p95', 'p99')
+        ]
+        requests = load_balancer.metric_request_count(statistic='Sum', label='requests', period=one_minute)
+        target_5xx = load_balancer.metric_http_code_target(
+            elbv2.HttpCodeTarget.TARGET_5XX_COUNT, statistic='Sum', label='target 5xx', period=one_minute
+        )
+        elb_5xx = load_balancer.metric_http_code_elb(
+            elbv2.HttpCodeElb.ELB_5XX_COUNT, statistic='Sum', label='alb 5xx', period=one_minute
+        )
+        task_cpu = service.metric_cpu_utilization(label='cpu %', period=one_minute)
+        task_memory = service.metric_memory_utilization(label='memory %', period=one_minute)
+        # task counts come from container insights, so they show the autoscaling state
+        task_counts = [
+            cloudwatch.Metric(
+                namespace="ECS/ContainerInsights",
+                metric_name=metric_name,
+                dimensions_map={
+                    "ClusterName": self.crs.ecs_cluster.cluster_name,
+                    "ServiceName": service.service_name,
+                },
+                statistic='Average',
+                label=label,
+                period=one_minute,
+            )
+            for metric_name, label in (('DesiredTaskCount', 'desired'), ('RunningTaskCount', 'running'))
+        ]
+        # blue/green stages swap target groups on every deployment, so the live one is either of them
+        target_groups = target_groups or [ecs_stack.target_group]
+        if len(target_groups) > 1:
+            healthy_hosts = cloudwatch.MathExpression(
+                expression=" + ".join(f"tg{index}" for index in range(len(target_groups))),
+                using_metrics={
+                    f"tg{index}": target_group.metric_healthy_host_count(period=one_minute)
+                    for index, target_group in enumerate(target_groups)
+                },
+                label='healthy targets',
+                period=one_minute,
+            )
+        else:
+            healthy_hosts = target_groups[0].metric_healthy_host_count(label='healthy targets', period=one_minute)
+        db_connections = database.metric_database_connections(label='connections', period=one_minute)
+        db_cpu = database.metric_cpu_utilization(label='cpu %', period=one_minute)
+        db_latency = [
+            database.metric(metric_name, statistic='Average', label=label, period=one_minute)
+            for metric_name, label in (('ReadLatency', 'read'), ('WriteLatency', 'write'))
+        ]
+
+        if self.dashboard_enabled:
+            self.dashboard = cloudwatch.Dashboard(self, "Dashboard", dashboard_name=self.name)
+            self.dashboard.add_widgets(
+                cloudwatch.GraphWidget(title="ALB target response time (s)", left=latency, width=8),
+                cloudwatch.GraphWidget(title="Requests per minute", left=[requests], width=8),
+                cloudwatch.GraphWidget(title="5xx per minute", left=[target_5xx, elb_5xx], width=8),
+            )
+            self.dashboard.add_widgets(
+                cloudwatch.GraphWidget(title="Task cpu & memory (%)", left=[task_cpu, task_memory], width=8),
+                cloudwatch.GraphWidget(title="Task count", left=task_counts, right=[healthy_hosts], width=8),
+                cloudwatch.GraphWidget(title="Aurora connections & cpu", left=[db_connections], right=[db_cpu], width=8),
+            )
+            self.dashboard.add_widgets(
+                cloudwatch.GraphWidget(title="Aurora read & write latency (s)", left=db_latency, width=8),
+            )
+
+        if self.alarms_enabled:
+            alarms = [
+                ("LatencyAlarm", "p95 target response time", latency[1], self.alarm_p95_latency, 3),
+                ("ErrorAlarm", "target 5xx responses per minute", target_5xx, self.alarm_5xx_count, 3),
+                ("TaskCpuAlarm", "task cpu %", task_cpu, self.alarm_task_cpu, 5),
+                ("TaskMemoryAlarm", "task memory %", task_memory, self.alarm_task_memory, 5),
+                ("DatabaseCpuAlarm", "aurora cpu %", db_cpu, self.alarm_db_cpu, 5),
+            ]
+            for alarm_id, description, metric, threshold, periods in alarms:
+                alarm = cloudwatch.Alarm(self, alarm_id,
+                    alarm_description=f"{self.name} {description} above {threshold}",
+                    metric=metric,
+                    threshold=threshold,
+                    evaluation_periods=periods,
+                    treat_missing_data=cloudwatch.TreatMissingData.NOT_BREACHING,
+                )
+                # alarms go to the shared alarm topic, the topic has to be added to the slack channel by hand
+                if self.crs.alarm_topic is not None:
+                    alarm.add_alarm_action(cw_actions.SnsAction(self.crs.alarm_topic))
+                    alarm.add_ok_action(cw_actions.SnsAction(self.crs.alarm_topic))
+                self.alarms.append(alarm)
+
+    @staticmethod
+    def validate(name: str, props: dict) -> None:
+        if props.get("CONTAINER_LOGGING", False) or props.get("DB_LOG_EXPORTS", False):
+            log_retention = props.get("LOG_RETENTION", 'ONE_MONTH')
+            if log_retention not in logs.RetentionDays.__members__:
+                raise ValueError(f"stage '{name}': LOG_RETENTION must be a logs.RetentionDays name eg. 'ONE_MONTH', got {log_retention!r}")
@@ -0,0 +1,110 @@
+
+from aws_cdk import (
+    core,
+    aws_ec2 as ec2,
+    aws_ecs as ecs,
+    aws_elasticache as elasticache,
+    aws_secretsmanager as secrets,
+)
+from .common_resources import CommonResourceStack
+from .validation import as_int
+
+
+class RedisCacheStack(core.Construct):
+    '''
+        a redis cache shared by the stage's tasks, so they dont each warm their own in-memory cache.
+        REDIS_HOST, REDIS_PORT and REDIS_TLS go to the container, the auth token is in secret_mapping.
+
+        enabled
+        redis_sg
+        redis_subnet_group
+        redis_auth
+        redis
+        secret_mapping
+    '''
+    def __init__(self, scope: core.Construct, id: str, props: dict, crs: CommonResourceStack) -> None:
+        super().__init__(scope, id)
+
+        self.enabled = props.pop("REDIS_ENABLED", False)
+        node_type = props.pop("REDIS_NODE_TYPE", 'cache.t4g.small')
+        version = str(props.pop("REDIS_ENGINE_VERSION", '6.2'))
+        shards = int(props.pop("REDIS_SHARDS", 1))
+        replicas = int(props.pop("REDIS_REPLICAS", 1))
+        port = int(props.pop("REDIS_PORT", 6379))
+        name = scope.node.id
+        self.secret_mapping = dict()
+
+        if not self.enabled:
+            return
+
+        self.redis_sg = ec2.SecurityGroup(
+            self, "redis-sec-group",
+            description='Security group for Redis cache',
+            vpc=crs.vpc
+        )
+        self.redis_sg.add_ingress_rule(peer=crs.fargate_sg, connection=ec2.Port.tcp(port))
+
+        self.redis_subnet_group = elasticache.CfnSubnetGroup(
+            self, "RedisSubnetGroup",
+            description=f"{name} backstage redis subnets",
+            subnet_ids=crs.vpc.select_subnets(subnet_type=ec2.SubnetType.PRIVATE).subnet_ids,
+        )
+
+        # redis auth tokens dont allow most punctuation
+        self.redis_auth = secrets.Secret(
+            self, 'RedisAuthSecret',
+            secret_name= f"{name}-backstage-redis-auth",
+            generate_secret_string=secrets.SecretStringGenerator(
+                exclude_punctuation=True,
+                include_space=False,
+                password_length=64,
+            )
+        )
+        self.secret_mapping.update({'REDIS_PASSWORD': ecs.Secret.from_secrets_manager(self.redis_auth)})
+
+        # more than one shard needs cluster mode, which needs a cluster mode parameter group
+        cluster_mode = shards > 1
+        major = version.split('.')[0]
+        if not cluster_mode:
+            parameter_group = None
+        elif int(major) >= 7:
+            parameter_group = f"default.redis{major}.cluster.on"
+        else:
+            parameter_group = f"default.redis{major}.x.cluster.on"
+
+        self.redis = elasticache.CfnReplicationGroup(
+            self, "RedisCache",
+            replication_group_description=f"{name} backstage cache",
+            engine="redis",
+            engine_version=version,
+            cache_node_type=node_type,
+            cache_parameter_group_name=parameter_group,
+            num_node_groups=shards,
+            replicas_per_node_group=replicas,
+            automatic_failover_enabled=cluster_mode or replicas > 0,
+            multi_az_enabled=replicas > 0,
+            cache_subnet_group_name=self.redis_subnet_group.ref,
+            security_group_ids=[self.redis_sg.security_group_id],
+            port=port,
+            at_rest_encryption_enabled=True,
+            transit_encryption_enabled=True,
+            auth_token=self.redis_auth.secret_value.to_string(),
+        )
+
+        if cluster_mode:
+            props['REDIS_HOST'] = self.redis.attr_configuration_end_point_address
+            props['REDIS_PORT'] = self.redis.attr_configuration_end_point_port
+        else:
+            props['REDIS_HOST'] = self.redis.attr_primary_end_point_address
+            props['REDIS_PORT'] = self.redis.attr_primary_end_point_port
+        props['REDIS_TLS'] = 'true'
+
+    @staticmethod
+    def validate(name: str, props: dict) -> None:
+        if not props.get("REDIS_ENABLED", False):
+            return
+
+        if not 1 <= as_int(name, props, "REDIS_SHARDS", 1) <= 500:
+            raise ValueError(f"stage '{name}': REDIS_SHARDS must be between 1 and 500")
+        if not 0 <= as_int(name, props, "REDIS_REPLICAS", 1) <= 5:
+            raise ValueError(f"stage '{name}': REDIS_REPLICAS must be between 0 and 5")
@@ -0,0 +1,53 @@
+
+from aws_cdk import (
+    core,
+    aws_s3 as s3,
+)
+from .common_resources import CommonResourceStack
+from .stage_resources import StageResourceStack
+
+
+class BackstageRegionStack(core.Stack):
+    '''
+        the stages of a multi-region deployment in one of its other regions,
+        with their own vpc, cluster and services and aurora clusters which join the
+        global databases of the stages in the primary region.
+    '''
+    def __init__(self, scope: core.Construct, construct_id: str, props: dict, primary_region: str, **kwargs) -> None:
+        super().__init__(scope, construct_id, **kwargs)
+
+        self.primary_region = primary_region
+        self.crs = CommonResourceStack(self, "infra-common-resources", props, primary_region=primary_region)
+        self.stages = dict()
+
+    def add_stage(self, name: str, props: dict) -> StageResourceStack:
+        # the same stage in this region, settings which only make sense once or in one region are dropped
+        stage_props = {
+            **props,
+            'AWS_REGION': self.region,
+            # the proxy cant forward writes, and the load test runs against the shared fqdn from the primary
+            'DB_PROXY_ENABLED': False,
+            'LOAD_TEST_ENABLED': False,
+        }
+        # acm certs are regional, so this region generates its own
+        stage_props.pop('ACM_ARN', None)
+
+        srs = StageResourceStack(self, name, stage_props, self.crs, primary_region=self.primary_region)
+        self.stages[name] = srs
+        return srs
+
+
+class RegionArtifactStack(core.Stack):
+    '''
+        the bucket codepipeline replicates artifacts to for the actions it runs in this region,
+        and which cloudformation templates are uploaded to for deploys here.
+        it has to exist before the pipelines in the primary region, so it gets a stack of its own.
+    '''
+    def __init__(self, scope: core.Construct, construct_id: str, **kwargs) -> None:
+        super().__init__(scope, construct_id, **kwargs)
+
+        self.bucket = s3.Bucket(self, "ArtifactBucket",
+            bucket_name=core.PhysicalName.GENERATE_IF_NEEDED,
+            block_public_access=s3.BlockPublicAccess.BLOCK_ALL,
+            encryption=s3.BucketEncryption.S3_MANAGED,
+        )
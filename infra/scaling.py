@@ -0,0 +1,77 @@
+
+from aws_cdk import (
+    core,
+    aws_ecs as ecs,
+    aws_elasticloadbalancingv2 as elbv2,
+    aws_applicationautoscaling as appscaling,
+)
+from .validation import as_int
+
+
+class ScalingStack(core.Construct):
+    '''
+        task count autoscaling for a stage, target tracking on cpu and/or requests and scheduled windows.
+        a service with autoscaling is created without a task count, so the stage creates this construct
+        first and calls scale() once its service exists.
+
+        enabled
+        min_count
+        scaling
+    '''
+    def __init__(self, scope: core.Construct, id: str, props: dict) -> None:
+        super().__init__(scope, id)
+
+        self.min_count = int(props.pop("TASK_MIN_COUNT", 1))
+        self.max_count = int(props.pop("TASK_MAX_COUNT", self.min_count))
+        self.target_cpu = props.pop("SCALING_TARGET_CPU", None)
+        self.target_requests = props.pop("SCALING_TARGET_REQUESTS", None)
+        self.schedules = props.pop("SCALING_SCHEDULES", [])
+        # autoscaling is only wired up if the stage is allowed to change its task count
+        self.enabled = self.max_count > self.min_count or bool(self.schedules)
+        self.scaling = None
+
+    def scale(self, service: ecs.FargateService, target_group: elbv2.ApplicationTargetGroup) -> None:
+        if not self.enabled:
+            return
+
+        self.scaling = service.auto_scale_task_count(
+            min_capacity=self.min_count,
+            max_capacity=self.max_count
+        )
+        if self.target_cpu is not None:
+            self.scaling.scale_on_cpu_utilization("CpuScaling",
+                target_utilization_percent=int(self.target_cpu),
+            )
+        if self.target_requests is not None:
+            self.scaling.scale_on_request_count("RequestScaling",
+                requests_per_target=int(self.target_requests),
+                target_group=target_group,
+            )
+        # scheduled windows, eg scale up for business hours and back down at night
+        for schedule in self.schedules:
+            schedule_min = schedule.get('MIN_COUNT')
+            schedule_max = schedule.get('MAX_COUNT')
+            self.scaling.scale_on_schedule(schedule['NAME'],
+                schedule=appscaling.Schedule.expression(schedule['SCHEDULE']),
+                min_capacity=None if schedule_min is None else int(schedule_min),
+                max_capacity=None if schedule_max is None else int(schedule_max),
+            )
+
+    @staticmethod
+    def validate(name: str, props: dict) -> None:
+        min_count = as_int(name, props, "TASK_MIN_COUNT", 1)
+        max_count = as_int(name, props, "TASK_MAX_COUNT", min_count)
+        if min_count < 0 or max_count < min_count:
+            raise ValueError(f"stage '{name}': need 0 <= TASK_MIN_COUNT <= TASK_MAX_COUNT, got {min_count} and {max_count}")
+
+        if props.get("SCALING_TARGET_CPU") is not None and not 0 < as_int(name, props, "SCALING_TARGET_CPU", 0) <= 100:
+            raise ValueError(f"stage '{name}': SCALING_TARGET_CPU must be a percentage between 1 and 100")
+        if props.get("SCALING_TARGET_REQUESTS") is not None and as_int(name, props, "SCALING_TARGET_REQUESTS", 0) <= 0:
+            raise ValueError(f"stage '{name}': SCALING_TARGET_REQUESTS must be greater than 0")
+
+        for schedule in props.get("SCALING_SCHEDULES", []):
+            missing = {"NAME", "SCHEDULE"} - set(schedule)
+            if missing:
+                raise ValueError(f"stage '{name}': scaling schedule {schedule} is missing {sorted(missing)}")
+            if "MIN_COUNT" not in schedule and "MAX_COUNT" not in schedule:
+                raise ValueError(f"stage '{name}': scaling schedule {schedule['NAME']} needs MIN_COUNT and/or MAX_COUNT")
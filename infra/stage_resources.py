@@ -1,30 +1,137 @@
 
 import json
+import re
 from aws_cdk import (
     core, 
     aws_ecs as ecs,
     aws_ecs_patterns as ecs_patterns,
     aws_rds as rds,
+    aws_logs as logs,
     aws_secretsmanager as secrets,
     aws_certificatemanager as acm,
     aws_route53 as route53,
+    aws_route53_targets as targets,
+    aws_applicationautoscaling as appscaling,
 )
 from .common_resources import CommonResourceStack
+from .observability import ObservabilityStack
+from .scaling import ScalingStack
+from .blue_green import BlueGreenStack
+from .global_database import GlobalDatabaseStack
+from .database_proxy import DatabaseProxyStack
+from .redis_cache import RedisCacheStack
+from .efs_cache import EfsCacheStack
+from .cloudfront_distribution import CloudFrontStack
+from .validation import as_int
 
 class StageResourceStack(core.Construct):
-    def __init__(self, scope: core.Construct, id: str, props: dict, crs: CommonResourceStack) -> None:
+    '''
+        the resources for one stage in one region. a stage with more than one REGIONS is built 
+        once in the primary region and once per other region with primary_region set, the aurora 
+        cluster of the primary is the writer of a global database and the others join it as readers.
+
+        the stage and its features pop the settings they read from their own copy of props,
+        whatever is left, with the endpoints the features add, goes to the container as env vars.
+    '''
+    def __init__(self, scope: core.Construct, id: str, props: dict, crs: CommonResourceStack, primary_region: str = None) -> None:
         super().__init__(scope, id)
+        props = dict(props)
 
        # properties
         host_name = props.get("HOST_NAME", 'backstage')
         domain_name = props.get("DOMAIN_NAME", 'example.com')
         fqdn = f"{host_name}.{domain_name}"
         acm_arn = props.get("ACM_ARN", None)
+        # multi-region, the first region is the primary
+        region = core.Stack.of(self).region
+        # a stage in more than one region shares its database through an aurora global database
+        self.global_database = GlobalDatabaseStack(self, "GlobalDatabase", props, primary_region)
+        regions = self.global_database.regions
+        multi_region = len(regions) > 1
+        self.primary = primary_region is None
         container_port = props.get("CONTAINER_PORT", '7000')
         container_name = props.get("CONTAINER_NAME", 'backstage')
+        self.container_name = container_name
+        self.container_port = int(container_port)
         db_username = props.get("POSTGRES_USER", 'postgres')
+        # task sizing
+        task_cpu = int(props.pop("TASK_CPU", 512))
+        task_memory = int(props.pop("TASK_MEMORY", 2048))
+        cpu_architecture = props.pop("CPU_ARCHITECTURE", None)
+        capacity_strategy = props.pop("CAPACITY_PROVIDER_STRATEGY", None)
+        # the app pipeline builds these, the stage picks the image for its architecture
+        build_archs = props.pop("APP_BUILD_ARCHITECTURES", ["amd64"])
+        self.capacity_strategy = capacity_strategy
+        # task startup and shutdown
+        container_health_check_path = props.pop("CONTAINER_HEALTH_CHECK_PATH", None)
+        container_health_check_interval = int(props.pop("CONTAINER_HEALTH_CHECK_INTERVAL", 30))
+        container_health_check_start_period = int(props.pop("CONTAINER_HEALTH_CHECK_START_PERIOD", 60))
+        container_health_check_retries = int(props.pop("CONTAINER_HEALTH_CHECK_RETRIES", 3))
+        health_check_grace_period = props.pop("HEALTH_CHECK_GRACE_PERIOD", None)
+        ephemeral_storage = props.pop("EPHEMERAL_STORAGE_GIB", None)
+        stop_timeout = props.pop("STOP_TIMEOUT", None)
+        # aurora instances and read replicas
+        db_instance_count = int(props.pop("DB_INSTANCE_COUNT", 2))
+        db_instance_class = props.pop("DB_INSTANCE_CLASS", None)
+        db_serverless_min = props.pop("DB_SERVERLESS_MIN_CAPACITY", None)
+        db_serverless_max = props.pop("DB_SERVERLESS_MAX_CAPACITY", None)
+        db_replica_min = int(props.pop("DB_REPLICA_MIN_COUNT", 0))
+        db_replica_max = int(props.pop("DB_REPLICA_MAX_COUNT", 0))
+        db_replica_target_cpu = props.pop("DB_REPLICA_TARGET_CPU", None)
+        db_replica_target_conns = props.pop("DB_REPLICA_TARGET_CONNECTIONS", None)
+        # aurora engine, parameter groups and monitoring
+        db_engine_version = str(props.pop("DB_ENGINE_VERSION", '10.14'))
+        db_allow_major_upgrade = props.pop("DB_ALLOW_MAJOR_UPGRADE", False)
+        db_cluster_parameters = props.pop("DB_CLUSTER_PARAMETERS", {})
+        db_instance_parameters = props.pop("DB_INSTANCE_PARAMETERS", {})
+        db_pg_stat_statements = props.pop("DB_PG_STAT_STATEMENTS", False)
+        db_log_exports = props.pop("DB_LOG_EXPORTS", False)
+        db_performance_insights = props.pop("DB_PERFORMANCE_INSIGHTS", False)
+        db_performance_insights_retention = props.pop("DB_PERFORMANCE_INSIGHTS_RETENTION", 'DEFAULT')
+        db_monitoring_interval = int(props.pop("DB_MONITORING_INTERVAL", 0))
+        # load test after the deploy
+        load_test_enabled = props.pop("LOAD_TEST_ENABLED", False)
+        load_test_options = {
+            "--duration": props.pop("LOAD_TEST_DURATION", 60),
+            "--concurrency": props.pop("LOAD_TEST_CONCURRENCY", 10),
+            "--max-p95-ms": props.pop("LOAD_TEST_MAX_P95_MS", 1000),
+            "--max-p99-ms": props.pop("LOAD_TEST_MAX_P99_MS", None),
+            "--min-rps": props.pop("LOAD_TEST_MIN_RPS", None),
+            "--max-error-rate": props.pop("LOAD_TEST_MAX_ERROR_RATE", 0.01),
+        }
+        load_test_variables = props.pop("LOAD_TEST_VARIABLES", {})
+        # ALB and target group tuning, unset keys keep the elbv2 defaults
+        health_check_path = props.pop("HEALTH_CHECK_PATH", None)
+        health_check_interval = props.pop("HEALTH_CHECK_INTERVAL", None)
+        health_check_timeout = props.pop("HEALTH_CHECK_TIMEOUT", None)
+        health_check_healthy = props.pop("HEALTH_CHECK_HEALTHY_THRESHOLD", None)
+        health_check_unhealthy = props.pop("HEALTH_CHECK_UNHEALTHY_THRESHOLD", None)
+        deregistration_delay = props.pop("DEREGISTRATION_DELAY", None)
+        slow_start = props.pop("SLOW_START", None)
+        alb_idle_timeout = props.pop("ALB_IDLE_TIMEOUT", None)
+        alb_http2 = props.pop("ALB_HTTP2", None)
+        lb_algorithm = props.pop("LB_ALGORITHM", None)
+
+        # the features which change how the service is created come first, the rest are added as the stage is built
+        self.scaling = ScalingStack(self, "Scaling", props)
+        self.blue_green = BlueGreenStack(self, "BlueGreen", props)
+        self.deploy_mode = self.blue_green.deploy_mode
+        self.cloudfront = CloudFrontStack(self, "CloudFront", props)
+        # with cloudfront the ALB moves to its own origin name and cloudfront takes the fqdn
+        alb_fqdn = self.cloudfront.origin_fqdn if self.cloudfront.enabled else fqdn
 
         self.secret_mapping = dict()
+
+        # the app pipeline load tests the stage on its public name
+        self.fqdn = fqdn
+        if load_test_enabled:
+            self.load_test_args = " ".join(
+                [f"{option} {value}" for option, value in load_test_options.items() if value is not None] +
+                [f"--var {key}={value}" for key, value in load_test_variables.items()]
+            )
+        else:
+            self.load_test_args = None
+        self.load_test_token_arn = props.pop("LOAD_TEST_TOKEN_ARN", None)
         # secretmgr info for github token
         github_token_secret_name = props.get("GITHUB_TOKEN_SECRET_NAME", None)
         # secretmgr info for auth to github users
@@ -78,12 +185,16 @@ class StageResourceStack(core.Construct):
         if acm_arn is None:
             self.cert = acm.Certificate(self, "Certificate",
                 domain_name=fqdn,
+                subject_alternative_names=[self.cloudfront.origin_fqdn] if self.cloudfront.enabled else None,
                 validation=acm.CertificateValidation.from_dns(self.hosted_zone)
             )
         # this one pulls in a prexisiting
         else:
             self.cert = acm.Certificate.from_certificate_arn(self, 'Certificate', acm_arn)
 
+        # logging has to be set up before the task definition and the aurora log group
+        self.observability = ObservabilityStack(self, "Observability", props, crs)
+
         # generate the json string for the secret with the .env username set
         secret_string = secrets.SecretStringGenerator(
                 secret_string_template=json.dumps({"username": db_username}),
@@ -93,51 +204,450 @@ class StageResourceStack(core.Construct):
             )
 
         # generate and store password and username
-        self.aurora_creds = secrets.Secret(
-            self, 'AuroraCredentialsSecret', 
-            secret_name= f"{id}-backstage-db-auth",
-            generate_secret_string=secret_string
-        )
+        # other regions of a global database share the credentials through secret replicas of the same name
+        if self.primary:
+            self.aurora_creds = secrets.Secret(
+                self, 'AuroraCredentialsSecret', 
+                secret_name= f"{id}-backstage-db-auth",
+                generate_secret_string=secret_string,
+                replica_regions=[secrets.ReplicaRegion(region=replica) for replica in regions if replica != region] or None,
+            )
+        else:
+            self.aurora_creds = secrets.Secret.from_secret_name_v2(self, 'AuroraCredentialsSecret', f"{id}-backstage-db-auth")
 
         # replace the .env pg passwd generated one to share between ECS and Aurora
         # props['POSTGRES_PASSWORD'] = aurora_creds.secret_value_from_json('password').to_string()
         self.secret_mapping.update({'POSTGRES_PASSWORD': ecs.Secret.from_secrets_manager(self.aurora_creds, field='password')})
 
-        self.aurora_pg = rds.DatabaseCluster(
-            self, "PGDatabase",
-            engine=rds.DatabaseClusterEngine.aurora_postgres(version=rds.AuroraPostgresEngineVersion.VER_10_14),
-            credentials=rds.Credentials.from_secret(self.aurora_creds), 
-            instance_props= crs.aurora_instance,
-            #subnet_group=db_subnet_group,
+        # serverless v2 instances use the 'db.serverless' class and scale within the capacity range
+        if db_serverless_max is not None:
+            db_instance_class = 'serverless'
+
+        # the engine version is the full aurora postgres version eg. '13.7', the major version picks 
+        # the parameter group family. versions before 10 have a two part major version eg. '9.6'
+        db_major_version = '.'.join(db_engine_version.split('.')[:2 if db_engine_version.startswith('9.') else 1])
+        db_engine = rds.DatabaseClusterEngine.aurora_postgres(
+            version=rds.AuroraPostgresEngineVersion.of(db_engine_version, db_major_version)
         )
 
+        # parameter values have to be strings in the generated parameter groups
+        cluster_parameters = {key: str(value) for key, value in db_cluster_parameters.items()}
+        instance_parameters = {key: str(value) for key, value in db_instance_parameters.items()}
+        # pg_stat_statements has to be preloaded to collect per query stats
+        if db_pg_stat_statements:
+            libraries = [lib for lib in cluster_parameters.get('shared_preload_libraries', '').split(',') if lib]
+            if 'pg_stat_statements' not in libraries:
+                libraries.append('pg_stat_statements')
+            cluster_parameters['shared_preload_libraries'] = ','.join(libraries)
+            cluster_parameters.setdefault('pg_stat_statements.track', 'all')
+
+        instance_options = dict(
+            allow_major_version_upgrade=db_allow_major_upgrade,
+            parameters=instance_parameters or None,
+        )
+        if db_performance_insights:
+            instance_options.update(
+                enable_performance_insights=True,
+                performance_insight_retention=getattr(rds.PerformanceInsightRetention, db_performance_insights_retention),
+            )
+
+        instance_props = crs.instance_props(db_instance_class, **instance_options)
+        # the postgres log carries the slow queries from log_min_duration_statement
+        cloudwatch_logs_exports = ['postgresql'] if db_log_exports else None
+        if self.primary:
+            self.aurora_pg = rds.DatabaseCluster(
+                self, "PGDatabase",
+                engine=db_engine,
+                credentials=rds.Credentials.from_secret(self.aurora_creds), 
+                instance_props= instance_props,
+                instances=db_instance_count,
+                parameters=cluster_parameters or None,
+                # enhanced monitoring, cdk creates the monitoring role
+                monitoring_interval=core.Duration.seconds(db_monitoring_interval) if db_monitoring_interval else None,
+                cloudwatch_logs_exports=cloudwatch_logs_exports,
+                #subnet_group=db_subnet_group,
+            )
+            cfn_cluster = self.aurora_pg.node.default_child
+            cfn_instances = [child for child in self.aurora_pg.node.children if isinstance(child, rds.CfnDBInstance)]
+            # the primary cluster starts the global database
+            self.global_database.join(self.aurora_pg)
+        else:
+            # secondary clusters of a global database get their credentials from the primary,
+            # so they are built from the cfn resources which dont need master credentials
+            self.aurora_pg = self.global_database.secondary_cluster(crs, db_engine, instance_props, db_instance_count,
+                parameters=cluster_parameters or None,
+                monitoring_interval=db_monitoring_interval,
+                cloudwatch_logs_exports=cloudwatch_logs_exports,
+            )
+            cfn_cluster = self.global_database.cfn_cluster
+            cfn_instances = self.global_database.cfn_instances
+
+        # the log group rds exports to, created here so it gets a retention without the 
+        # log retention lambda, which is an asset the pipeline doesnt publish.
+        # the instances write the logs, so they wait for the group rather than rds creating it.
+        if db_log_exports:
+            self.db_log_group = logs.LogGroup(self, "PGLogGroup",
+                log_group_name=f"/aws/rds/cluster/{self.aurora_pg.cluster_identifier}/postgresql",
+                retention=getattr(logs.RetentionDays, self.observability.log_retention),
+                removal_policy=core.RemovalPolicy.DESTROY,
+            )
+            for instance in cfn_instances:
+                instance.node.add_dependency(self.db_log_group)
+
+        # a major version upgrade has to be allowed on the cluster as well as the instances
+        if db_allow_major_upgrade:
+            cfn_cluster.add_property_override("AllowMajorVersionUpgrade", True)
+
+        # cdk v1 has no serverless v2 support so we set the capacity range on the cfn cluster
+        if db_serverless_max is not None:
+            cfn_cluster.add_property_override("ServerlessV2ScalingConfiguration", {
+                "MinCapacity": float(db_serverless_min if db_serverless_min is not None else 0.5),
+                "MaxCapacity": float(db_serverless_max),
+            })
+
+        # aurora auto scaling adds and removes reader instances on top of the ones above
+        if db_replica_max > 0:
+            self.db_replica_scaling = appscaling.ScalableTarget(
+                self, "PGReplicaScaling",
+                service_namespace=appscaling.ServiceNamespace.RDS,
+                resource_id=f"cluster:{self.aurora_pg.cluster_identifier}",
+                scalable_dimension="rds:cluster:ReadReplicaCount",
+                min_capacity=db_replica_min,
+                max_capacity=db_replica_max,
+            )
+            if db_replica_target_cpu is not None:
+                self.db_replica_scaling.scale_to_track_metric("ReplicaCpuScaling",
+                    target_value=float(db_replica_target_cpu),
+                    predefined_metric=appscaling.PredefinedMetric.RDS_READER_AVERAGE_CPU_UTILIZATION,
+                )
+            if db_replica_target_conns is not None:
+                self.db_replica_scaling.scale_to_track_metric("ReplicaConnectionScaling",
+                    target_value=float(db_replica_target_conns),
+                    predefined_metric=appscaling.PredefinedMetric.RDS_READER_AVERAGE_DATABASE_CONNECTIONS,
+                )
+
         # set envar for DB hostname as generated by CFN
-        props['POSTGRES_HOST'] = self.aurora_pg.cluster_endpoint.hostname
+        # a secondary cluster has no writer, its readers forward writes to the primary region
+        if self.primary:
+            props['POSTGRES_HOST'] = self.aurora_pg.cluster_endpoint.hostname
+        else:
+            props['POSTGRES_HOST'] = self.aurora_pg.cluster_read_endpoint.hostname
+        # the reader endpoint balances across replicas, so the app can send reads there
+        props['POSTGRES_READER_HOST'] = self.aurora_pg.cluster_read_endpoint.hostname
+
+        # pool the db connections of all tasks through an rds proxy
+        self.db_proxy = DatabaseProxyStack(self, "DatabaseProxy", props, crs, self.aurora_pg, self.aurora_creds)
+
+        # a shared redis cache, its auth token goes to the container as a secret
+        self.redis = RedisCacheStack(self, "Redis", props, crs)
+        self.secret_mapping.update(self.redis.secret_mapping)
+
+        # tell backstage where the prebuilt techdocs live
+        if crs.techdocs_bucket is not None:
+            props['TECHDOCS_S3_BUCKET_NAME'] = crs.techdocs_bucket.bucket_name
+            props['TECHDOCS_S3_ROOT_PATH'] = crs.techdocs_root_path
+            # other regions read the bucket in the primary region
+            props['TECHDOCS_S3_REGION'] = crs.techdocs_bucket.env.region
+
+        # a shared efs cache volume, mounted once the task definition exists
+        self.efs_cache = EfsCacheStack(self, "EfsCache", props, crs)
 
         # this builds the backstage container on deploy and pushes to ECR
-        self.ecs_task_options = ecs_patterns.ApplicationLoadBalancedTaskImageOptions(
-            image = ecs.ContainerImage.from_ecr_repository(crs.image_repo),
-            container_port=int(container_port),
-            environment = props, # pass in the env vars
-            container_name=container_name,
-            secrets = self.secret_mapping,
-            task_role = crs.task_role,
-            enable_logging=False
+        # the settings left in props are the apps, values that arent strings go in as json eg. true or [1, 2]
+        environment = {
+            key: value if isinstance(value, str) else json.dumps(value)
+            for key, value in props.items() if value is not None
+        }
+
+        # run on graviton if asked, the image needs to be built for the architecture.
+        # cdk v1 patterns take no runtime platform, so we build the task definition ourselves.
+        if cpu_architecture is not None:
+            runtime_platform = ecs.RuntimePlatform(
+                cpu_architecture=getattr(ecs.CpuArchitecture, cpu_architecture),
+                operating_system_family=ecs.OperatingSystemFamily.LINUX,
+            )
+        else:
+            runtime_platform = None
+
+        # multi-arch builds push a 'latest' manifest and a 'latest-<arch>' image per architecture,
+        # tasks start from the image for their own architecture until the pipeline deploys a build.
+        task_arch = {"X86_64": "amd64", "ARM64": "arm64"}[cpu_architecture or "X86_64"]
+        image_tag = f"latest-{task_arch}" if len(build_archs) > 1 else "latest"
+
+        self.task_definition = ecs.FargateTaskDefinition(self, "TaskDefinition",
+            cpu=task_cpu,               # Default is 256
+            memory_limit_mib=task_memory, # Default is 512
+            runtime_platform=runtime_platform, # Default is X86_64 linux
+            task_role=crs.task_role,
+        )
+        self.task_definition.add_container(container_name,
+            image=ecs.ContainerImage.from_ecr_repository(crs.image_repo, tag=image_tag),
+            port_mappings=[ecs.PortMapping(container_port=int(container_port))],
+            environment=environment, # pass in the env vars
+            secrets=self.secret_mapping,
+            logging=self.observability.log_driver, # None unless CONTAINER_LOGGING is on
         )
 
         # Easiest way to stand up mult-tier ECS app is with an ecs_pattern,  we are making it HTTPS
         # and accessible on a DNS name. We give ECS the Security Group for fargate
         self.ecs_stack = ecs_patterns.ApplicationLoadBalancedFargateService(self, "BackstageService",
             cluster=crs.ecs_cluster,        # Required
-            cpu=512,                    # Default is 256
-            desired_count=1,            # Default is 1
-            memory_limit_mib=2048,      # Default is 512
+            # with autoscaling the task count is left out of the template, so an update doesnt 
+            # reset a scaled out service to TASK_MIN_COUNT. needs removeDefaultDesiredCount in cdk.json.
+            desired_count=None if self.scaling.enabled else self.scaling.min_count,
             public_load_balancer=True, # Default is False
             security_groups=[crs.fargate_sg], # put the task/cluster in the group we created
-            task_image_options= self.ecs_task_options,
+            task_definition=self.task_definition,
             certificate=self.cert, #specifiying the cert enables https
             redirect_http=True,
-            domain_name = fqdn,
-            domain_zone = self.hosted_zone,
+            # multi-region stages get a latency record per region below instead
+            domain_name = None if multi_region else alb_fqdn,
+            domain_zone = None if multi_region else self.hosted_zone,
+            # the app pipeline deploys to the other regions by name
+            service_name = None if self.primary else f"{container_name}-{id}",
+            open_listener = not self.cloudfront.enabled, # cloudfront only ingress is added below
             enable_ecs_managed_tags = True,
-        ) 
\ No newline at end of file
+            deployment_controller = self.blue_green.deployment_controller,
+            # how long a new task has before failing ALB health checks count against it
+            health_check_grace_period = core.Duration.seconds(int(health_check_grace_period)) if health_check_grace_period is not None else None,
+        )
+
+        # route53 answers with the region closest to the user, and stops answering with a region whose
+        # ALB has no healthy targets. cdk v1 records have no routing policies so we set them on the cfn record.
+        if multi_region:
+            latency_record = route53.ARecord(self, "LatencyAliasRecord",
+                zone=self.hosted_zone,
+                record_name=alb_fqdn,
+                target=route53.RecordTarget.from_alias(targets.LoadBalancerTarget(self.ecs_stack.load_balancer)),
+            )
+            latency_record.node.default_child.add_property_override("SetIdentifier", region)
+            latency_record.node.default_child.add_property_override("Region", region)
+            latency_record.node.default_child.add_property_override("AliasTarget.EvaluateTargetHealth", True)
+
+        # cdk v1 patterns dont expose these task settings so we set them on the cfn task definition,
+        # the app container is the first container definition.
+        cfn_task_definition = self.ecs_stack.task_definition.node.default_child
+        # ecs marks the task healthy as soon as the backend answers, the image has node but not curl
+        if container_health_check_path is not None:
+            health_check_url = f"http://localhost:{container_port}{container_health_check_path}"
+            cfn_task_definition.add_property_override("ContainerDefinitions.0.HealthCheck", {
+                "Command": ["CMD", "node", "-e", 
+                    f"require('http').get('{health_check_url}', r => process.exit(r.statusCode < 400 ? 0 : 1)).on('error', () => process.exit(1))"
+                ],
+                "Interval": container_health_check_interval,
+                "Timeout": 5,
+                "Retries": container_health_check_retries,
+                "StartPeriod": container_health_check_start_period,
+            })
+        # seconds between SIGTERM and SIGKILL when a task is stopped, the fargate default is 30
+        if stop_timeout is not None:
+            cfn_task_definition.add_property_override("ContainerDefinitions.0.StopTimeout", int(stop_timeout))
+        # fargate gives 20GiB by default, large images unpack into the same space
+        if ephemeral_storage is not None:
+            cfn_task_definition.add_property_override("EphemeralStorage", {"SizeInGiB": int(ephemeral_storage)})
+
+        # cdk v1 patterns cant take a capacity provider strategy so we set it on the cfn service,
+        # a service with a strategy must not have a launch type.
+        # codedeploy applies the strategy of blue/green stages (see app_pipeline).
+        if capacity_strategy and not self.blue_green.enabled:
+            cfn_service = self.ecs_stack.service.node.default_child
+            cfn_service.add_property_override("CapacityProviderStrategy", [
+                {
+                    "CapacityProvider": strategy['CAPACITY_PROVIDER'],
+                    "Base": int(strategy.get('BASE', 0)),
+                    "Weight": int(strategy.get('WEIGHT', 1)),
+                }
+                for strategy in capacity_strategy
+            ])
+            cfn_service.add_deletion_override("Properties.LaunchType")
+            # the providers have to be associated with the cluster before the service uses them
+            self.ecs_stack.service.node.add_dependency(crs.ecs_cluster)
+
+        self.efs_cache.mount(self.ecs_stack.task_definition)
+
+        # blue/green needs a second target group, a test listener and a codedeploy deployment group
+        self.blue_green.attach(self.ecs_stack, crs, self.cert, self.container_port, open_listener=not self.cloudfront.enabled)
+        self.deployment_group = self.blue_green.deployment_group
+
+        # the same tuning applies to the blue and green target groups so traffic 
+        # behaves the same whichever one is live
+        target_groups = [self.ecs_stack.target_group]
+        if self.blue_green.enabled:
+            target_groups.append(self.blue_green.green_target_group)
+        # only the tuned settings are passed, the rest keep the elbv2 defaults
+        health_check = dict(
+            path=health_check_path,
+            interval=core.Duration.seconds(int(health_check_interval)) if health_check_interval is not None else None,
+            timeout=core.Duration.seconds(int(health_check_timeout)) if health_check_timeout is not None else None,
+            healthy_threshold_count=int(health_check_healthy) if health_check_healthy is not None else None,
+            unhealthy_threshold_count=int(health_check_unhealthy) if health_check_unhealthy is not None else None,
+        )
+        health_check = {key: value for key, value in health_check.items() if value is not None}
+        for target_group in target_groups:
+            if health_check:
+                target_group.configure_health_check(**health_check)
+            # draining waits this long for in flight requests before a task is stopped on deploys and scale in
+            if deregistration_delay is not None:
+                target_group.set_attribute("deregistration_delay.timeout_seconds", str(int(deregistration_delay)))
+            # ramp traffic up to new tasks while node warms up
+            if slow_start is not None:
+                target_group.set_attribute("slow_start.duration_seconds", str(int(slow_start)))
+            if lb_algorithm is not None:
+                target_group.set_attribute("load_balancing.algorithm.type", lb_algorithm)
+
+        # long running requests like the scaffolder need more than the 60s idle timeout
+        if alb_idle_timeout is not None:
+            self.ecs_stack.load_balancer.set_attribute("idle_timeout.timeout_seconds", str(int(alb_idle_timeout)))
+        if alb_http2 is not None:
+            self.ecs_stack.load_balancer.set_attribute("routing.http2.enabled", "true" if alb_http2 else "false")
+
+        # autoscaling on the task count
+        self.scaling.scale(self.ecs_stack.service, self.ecs_stack.target_group)
+
+        # dashboard and alarms for the stage
+        self.observability.monitor(self.ecs_stack, self.aurora_pg, target_groups)
+
+        # cloudfront serves and caches the static bundles at the edge and passes the rest through to the ALB
+        self.cloudfront.distribute(self.ecs_stack, self.hosted_zone, self.cert, primary=self.primary)
+
+    @staticmethod
+    def validate(name: str, props: dict) -> None:
+        # fail at synth rather than half way through a cloudformation deploy
+        # if the settings for a stage dont make sense. the features check their own settings below.
+        cpu = as_int(name, props, "TASK_CPU", 512)
+        memory = as_int(name, props, "TASK_MEMORY", 2048)
+
+        # valid fargate cpu/memory pairings
+        fargate_memory = {
+            256: [512, 1024, 2048],
+            512: list(range(1024, 4096 + 1, 1024)),
+            1024: list(range(2048, 8192 + 1, 1024)),
+            2048: list(range(4096, 16384 + 1, 1024)),
+            4096: list(range(8192, 30720 + 1, 1024)),
+        }
+        if cpu not in fargate_memory:
+            raise ValueError(f"stage '{name}': TASK_CPU must be one of {sorted(fargate_memory)}, got {cpu}")
+        if memory not in fargate_memory[cpu]:
+            raise ValueError(f"stage '{name}': TASK_MEMORY {memory} is not valid for TASK_CPU {cpu}")
+
+        # the stage architecture has to be one the app pipeline builds an image for
+        architectures = {"X86_64": "amd64", "ARM64": "arm64"}
+        cpu_architecture = props.get("CPU_ARCHITECTURE", "X86_64")
+        if cpu_architecture not in architectures:
+            raise ValueError(f"stage '{name}': CPU_ARCHITECTURE must be one of {sorted(architectures)}, got {cpu_architecture!r}")
+        if architectures[cpu_architecture] not in props.get("APP_BUILD_ARCHITECTURES", ["amd64"]):
+            raise ValueError(f"stage '{name}': CPU_ARCHITECTURE {cpu_architecture} needs '{architectures[cpu_architecture]}' in APP_BUILD_ARCHITECTURES")
+
+        capacity_strategy = props.get("CAPACITY_PROVIDER_STRATEGY", None) or []
+        for strategy in capacity_strategy:
+            if strategy.get('CAPACITY_PROVIDER') not in ('FARGATE', 'FARGATE_SPOT'):
+                raise ValueError(f"stage '{name}': CAPACITY_PROVIDER must be 'FARGATE' or 'FARGATE_SPOT', got {strategy.get('CAPACITY_PROVIDER')!r}")
+            if int(strategy.get('BASE', 0)) < 0 or int(strategy.get('WEIGHT', 1)) < 0:
+                raise ValueError(f"stage '{name}': capacity provider BASE and WEIGHT can't be negative")
+        # ecs allows a base on only one provider, and some weight has to place the tasks above it
+        if len([strategy for strategy in capacity_strategy if int(strategy.get('BASE', 0)) > 0]) > 1:
+            raise ValueError(f"stage '{name}': only one CAPACITY_PROVIDER_STRATEGY entry can have a BASE")
+        if capacity_strategy and not any(int(strategy.get('WEIGHT', 1)) > 0 for strategy in capacity_strategy):
+            raise ValueError(f"stage '{name}': at least one CAPACITY_PROVIDER_STRATEGY entry needs a WEIGHT above 0")
+
+        if as_int(name, props, "DB_INSTANCE_COUNT", 2) < 1:
+            raise ValueError(f"stage '{name}': DB_INSTANCE_COUNT must be at least 1")
+        db_engine_version = str(props.get("DB_ENGINE_VERSION", '10.14'))
+        if not re.fullmatch(r"\d+(\.\d+){1,2}", db_engine_version):
+            raise ValueError(f"stage '{name}': DB_ENGINE_VERSION must be a full aurora postgres version eg. '13.7', got {db_engine_version!r}")
+        # clusters deployed before DB_ENGINE_VERSION existed run the 10.14 default, moving off its major version 
+        # is a major upgrade, which cloudformation fails or replaces the cluster for unless it is allowed.
+        if db_engine_version.split('.')[0] != '10' and not props.get("DB_ALLOW_MAJOR_UPGRADE", False):
+            raise ValueError(
+                f"stage '{name}': DB_ENGINE_VERSION {db_engine_version} is a major version change from the 10.14 default, "
+                "set DB_ALLOW_MAJOR_UPGRADE: True after following the upgrade steps in docs/settings.md"
+            )
+        if props.get("DB_SERVERLESS_MAX_CAPACITY") is not None:
+            try:
+                serverless_min = float(props.get("DB_SERVERLESS_MIN_CAPACITY", 0.5))
+                serverless_max = float(props["DB_SERVERLESS_MAX_CAPACITY"])
+            except (TypeError, ValueError):
+                raise ValueError(f"stage '{name}': DB_SERVERLESS_MIN/MAX_CAPACITY must be numbers of ACUs")
+            if not 0.5 <= serverless_min <= serverless_max <= 128:
+                raise ValueError(f"stage '{name}': need 0.5 <= DB_SERVERLESS_MIN_CAPACITY <= DB_SERVERLESS_MAX_CAPACITY <= 128")
+            # serverless v2 came to aurora postgres with these minor versions
+            serverless_versions = {13: (13, 6), 14: (14, 3), 15: (15, 2)}
+            version = tuple(int(part) for part in db_engine_version.split('.'))
+            if version[0] < 13 or version < serverless_versions.get(version[0], version):
+                raise ValueError(f"stage '{name}': Serverless v2 needs DB_ENGINE_VERSION 13.6, 14.3, 15.2 or later, got {db_engine_version!r}")
+        replica_min = as_int(name, props, "DB_REPLICA_MIN_COUNT", 0)
+        replica_max = as_int(name, props, "DB_REPLICA_MAX_COUNT", 0)
+        if replica_max > 0:
+            # aurora allows 15 replicas per cluster
+            if not 0 <= replica_min <= replica_max <= 15:
+                raise ValueError(f"stage '{name}': need 0 <= DB_REPLICA_MIN_COUNT <= DB_REPLICA_MAX_COUNT <= 15")
+            if props.get("DB_REPLICA_TARGET_CPU") is None and props.get("DB_REPLICA_TARGET_CONNECTIONS") is None:
+                raise ValueError(f"stage '{name}': replica scaling needs DB_REPLICA_TARGET_CPU and/or DB_REPLICA_TARGET_CONNECTIONS")
+        for key in ("DB_CLUSTER_PARAMETERS", "DB_INSTANCE_PARAMETERS"):
+            if not isinstance(props.get(key, {}), dict):
+                raise ValueError(f"stage '{name}': {key} must be a mapping of parameter names to values")
+        # rds only accepts these enhanced monitoring intervals
+        if as_int(name, props, "DB_MONITORING_INTERVAL", 0) not in (0, 1, 5, 10, 15, 30, 60):
+            raise ValueError(f"stage '{name}': DB_MONITORING_INTERVAL must be one of 0, 1, 5, 10, 15, 30 or 60 seconds")
+        if props.get("DB_PERFORMANCE_INSIGHTS_RETENTION", 'DEFAULT') not in ('DEFAULT', 'LONG_TERM'):
+            raise ValueError(f"stage '{name}': DB_PERFORMANCE_INSIGHTS_RETENTION must be 'DEFAULT' or 'LONG_TERM'")
+
+        for key, low, high in (
+            ("HEALTH_CHECK_INTERVAL", 5, 300),
+            ("HEALTH_CHECK_TIMEOUT", 2, 120),
+            ("HEALTH_CHECK_HEALTHY_THRESHOLD", 2, 10),
+            ("HEALTH_CHECK_UNHEALTHY_THRESHOLD", 2, 10),
+            ("DEREGISTRATION_DELAY", 0, 3600),
+            ("SLOW_START", 30, 900),
+            ("ALB_IDLE_TIMEOUT", 1, 4000),
+        ):
+            if props.get(key) is not None and not low <= as_int(name, props, key, 0) <= high:
+                raise ValueError(f"stage '{name}': {key} must be between {low} and {high} seconds")
+        if props.get("HEALTH_CHECK_TIMEOUT") is not None and props.get("HEALTH_CHECK_INTERVAL") is not None:
+            if as_int(name, props, "HEALTH_CHECK_TIMEOUT", 0) >= as_int(name, props, "HEALTH_CHECK_INTERVAL", 0):
+                raise ValueError(f"stage '{name}': HEALTH_CHECK_TIMEOUT must be less than HEALTH_CHECK_INTERVAL")
+        # a quoted 'false' would be truthy, so the switch has to be a yaml bool
+        if props.get("ALB_HTTP2") is not None and not isinstance(props["ALB_HTTP2"], bool):
+            raise ValueError(f"stage '{name}': ALB_HTTP2 must be True or False, got {props['ALB_HTTP2']!r}")
+        lb_algorithm = props.get("LB_ALGORITHM")
+        if lb_algorithm not in (None, 'round_robin', 'least_outstanding_requests'):
+            raise ValueError(f"stage '{name}': LB_ALGORITHM must be 'round_robin' or 'least_outstanding_requests', got {lb_algorithm!r}")
+        # target groups dont support slow start together with least outstanding requests
+        if lb_algorithm == 'least_outstanding_requests' and props.get("SLOW_START") is not None:
+            raise ValueError(f"stage '{name}': SLOW_START can't be used with LB_ALGORITHM 'least_outstanding_requests'")
+
+        if props.get("HEALTH_CHECK_GRACE_PERIOD") is not None and not 0 <= as_int(name, props, "HEALTH_CHECK_GRACE_PERIOD", 0) <= 2147483647:
+            raise ValueError(f"stage '{name}': HEALTH_CHECK_GRACE_PERIOD must be a positive number of seconds")
+        if props.get("EPHEMERAL_STORAGE_GIB") is not None and not 21 <= as_int(name, props, "EPHEMERAL_STORAGE_GIB", 0) <= 200:
+            raise ValueError(f"stage '{name}': EPHEMERAL_STORAGE_GIB must be between 21 and 200")
+        if props.get("STOP_TIMEOUT") is not None and not 2 <= as_int(name, props, "STOP_TIMEOUT", 0) <= 120:
+            raise ValueError(f"stage '{name}': STOP_TIMEOUT must be between 2 and 120 seconds")
+        if props.get("CONTAINER_HEALTH_CHECK_PATH") is not None:
+            if not str(props["CONTAINER_HEALTH_CHECK_PATH"]).startswith('/'):
+                raise ValueError(f"stage '{name}': CONTAINER_HEALTH_CHECK_PATH must start with '/'")
+            # ecs limits for container health checks
+            if not 5 <= as_int(name, props, "CONTAINER_HEALTH_CHECK_INTERVAL", 30) <= 300:
+                raise ValueError(f"stage '{name}': CONTAINER_HEALTH_CHECK_INTERVAL must be between 5 and 300 seconds")
+            if not 0 <= as_int(name, props, "CONTAINER_HEALTH_CHECK_START_PERIOD", 60) <= 300:
+                raise ValueError(f"stage '{name}': CONTAINER_HEALTH_CHECK_START_PERIOD must be between 0 and 300 seconds")
+            if not 1 <= as_int(name, props, "CONTAINER_HEALTH_CHECK_RETRIES", 3) <= 10:
+                raise ValueError(f"stage '{name}': CONTAINER_HEALTH_CHECK_RETRIES must be between 1 and 10")
+
+        if props.get("LOAD_TEST_ENABLED", False):
+            if not props.get("GITHUB_INFRA_REPO"):
+                raise ValueError(f"stage '{name}': load tests run from the infra repo, GITHUB_INFRA_REPO is required")
+            if not 1 <= as_int(name, props, "LOAD_TEST_DURATION", 60) <= 1500:
+                raise ValueError(f"stage '{name}': LOAD_TEST_DURATION must be between 1 and 1500 seconds")
+            if not 1 <= as_int(name, props, "LOAD_TEST_CONCURRENCY", 10) <= 200:
+                raise ValueError(f"stage '{name}': LOAD_TEST_CONCURRENCY must be between 1 and 200")
+            for key in ("LOAD_TEST_MAX_P95_MS", "LOAD_TEST_MAX_P99_MS", "LOAD_TEST_MIN_RPS", "LOAD_TEST_MAX_ERROR_RATE"):
+                if props.get(key) is not None and (isinstance(props[key], bool) or not isinstance(props[key], (int, float)) or props[key] < 0):
+                    raise ValueError(f"stage '{name}': {key} must be a positive number, got {props[key]!r}")
+            # the variables are passed to the runner on its command line
+            for key, value in props.get("LOAD_TEST_VARIABLES", {}).items():
+                if any(char.isspace() for char in f"{key}{value}"):
+                    raise ValueError(f"stage '{name}': LOAD_TEST_VARIABLES can't contain whitespace, got {key}={value!r}")
+
+        for feature in (ScalingStack, BlueGreenStack, GlobalDatabaseStack, DatabaseProxyStack, RedisCacheStack, 
+                        EfsCacheStack, CloudFrontStack, ObservabilityStack):
+            feature.validate(name, props)
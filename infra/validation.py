@@ -0,0 +1,10 @@
+
+
+def as_int(name: str, props: dict, key: str, default) -> int:
+    '''
+        a whole number setting of stage name, yaml settings can come in quoted
+    '''
+    try:
+        return int(props.get(key, default))
+    except (TypeError, ValueError):
+        raise ValueError(f"stage '{name}': {key} must be a whole number, got {props.get(key)!r}")
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+'''
+    Load test runner for a deployed backstage stage.
+
+    Replays the weighted requests of a scenario file against a target for a fixed duration
+    with a number of concurrent clients, and fails when the latency, throughput or error rate
+    thresholds are breached. Only uses the standard library so it runs on any codebuild image.
+
+    Records overall and per request:
+        - request count, errors and error rate
+        - p50/p95/p99 latency in milliseconds
+        - requests per second
+
+    usage:
+        python loadtest/runner.py --target https://backstage.example.com --duration 60 --concurrency 10 \
+            --max-p95-ms 1000 --output results.json --metrics-file metrics.json --stage prod
+
+        # locally, against the stand-in server
+        python loadtest/runner.py --standin --duration 10
+
+    A bearer token for the backstage backend can be passed in the LOAD_TEST_TOKEN env var.
+    Exits with BREACH_EXIT_CODE when a threshold is breached, so a breach can be told apart from a crash.
+'''
+import argparse
+import json
+import math
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIO = os.path.join(REPO_ROOT, 'loadtest', 'scenario.json')
+METRIC_NAMESPACE = 'Backstage/LoadTest'
+# python exits with 1 on an unhandled error and argparse with 2
+BREACH_EXIT_CODE = 3
+
+
+def load_scenario(path: str, overrides: dict) -> list:
+    '''
+        the scenario requests with their path variables filled in,
+        each request repeated by its weight so the clients can just cycle through them
+    '''
+    with open(path) as scenario_file:
+        scenario = json.load(scenario_file)
+    variables = {**scenario.get('variables', {}), **overrides}
+    requests = []
+    for request in scenario['requests']:
+        request = {**request, 'path': request['path'].format(**variables)}
+        requests += [request] * int(request.get('weight', 1))
+    return requests
+
+
+def percentile(latencies: list, pct: float) -> float:
+    # nearest rank on the sorted latencies
+    if not latencies:
+        return 0.0
+    rank = max(math.ceil(pct / 100 * len(latencies)), 1)
+    return round(latencies[rank - 1], 1)
+
+
+def summarize(samples: list, seconds: float) -> dict:
+    latencies = sorted(latency for _, latency, _ in samples)
+    errors = sum(1 for _, _, ok in samples if not ok)
+    return {
+        'requests': len(samples),
+        'errors': errors,
+        'error_rate': round(errors / len(samples), 4) if samples else 0.0,
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'rps': round(len(samples) / seconds, 2) if seconds else 0.0,
+    }
+
+
+def client(target: str, requests: list, offset: int, deadline: float, headers: dict, timeout: float) -> list:
+    # each client starts at a different point of the scenario so the mix is even from the start
+    samples = []
+    index = offset
+    while time.monotonic() < deadline:
+        request = requests[index % len(requests)]
+        index += 1
+        http_request = urllib.request.Request(
+            target + request['path'], method=request.get('method', 'GET'), headers=headers
+        )
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(http_request, timeout=timeout) as response:
+                response.read()
+                ok = response.status < 400
+        except urllib.error.HTTPError as error:
+            ok = error.code < 400
+        except (urllib.error.URLError, OSError):
+            ok = False
+        samples.append((request['name'], (time.perf_counter() - start) * 1000, ok))
+    return samples
+
+
+def run(target: str, requests: list, duration: int, concurrency: int, warmup: int, timeout: float) -> dict:
+    headers = {'Accept': 'application/json'}
+    if os.environ.get('LOAD_TEST_TOKEN'):
+        headers['Authorization'] = f"Bearer {os.environ['LOAD_TEST_TOKEN']}"
+    target = target.rstrip('/')
+
+    # warm the tasks and caches up before anything is measured
+    if warmup > 0:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            deadline = time.monotonic() + warmup
+            list(pool.map(lambda offset: client(target, requests, offset, deadline, headers, timeout), range(concurrency)))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        start = time.monotonic()
+        deadline = start + duration
+        runs = pool.map(lambda offset: client(target, requests, offset, deadline, headers, timeout), range(concurrency))
+        samples = [sample for samples in runs for sample in samples]
+        seconds = time.monotonic() - start
+
+    names = sorted({name for name, _, _ in samples})
+    return {
+        'target': target,
+        'duration_seconds': round(seconds, 1),
+        'concurrency': concurrency,
+        'overall': summarize(samples, seconds),
+        'requests': {name: summarize([sample for sample in samples if sample[0] == name], seconds) for name in names},
+    }
+
+
+def breaches(overall: dict, max_p95: float = None, max_p99: float = None, min_rps: float = None, max_error_rate: float = None) -> list:
+    found = []
+    if max_p95 is not None and overall['p95_ms'] > max_p95:
+        found.append(f"p95 {overall['p95_ms']}ms is over {max_p95}ms")
+    if max_p99 is not None and overall['p99_ms'] > max_p99:
+        found.append(f"p99 {overall['p99_ms']}ms is over {max_p99}ms")
+    if min_rps is not None and overall['rps'] < min_rps:
+        found.append(f"{overall['rps']} requests per second is under {min_rps}")
+    if max_error_rate is not None and overall['error_rate'] > max_error_rate:
+        found.append(f"error rate {overall['error_rate']} is over {max_error_rate}")
+    return found
+
+
+def metric_data(results: dict, stage: str) -> dict:
+    # the input for `aws cloudwatch put-metric-data --cli-input-json`
+    overall = results['overall']
+    dimensions = [{'Name': 'Stage', 'Value': stage}]
+    metrics = [
+        ('LatencyP50', overall['p50_ms'], 'Milliseconds'),
+        ('LatencyP95', overall['p95_ms'], 'Milliseconds'),
+        ('LatencyP99', overall['p99_ms'], 'Milliseconds'),
+        ('RequestsPerSecond', overall['rps'], 'Count/Second'),
+        ('ErrorRate', overall['error_rate'] * 100, 'Percent'),
+    ]
+    return {
+        'Namespace': METRIC_NAMESPACE,
+        'MetricData': [
+            {'MetricName': name, 'Dimensions': dimensions, 'Value': value, 'Unit': unit}
+            for name, value, unit in metrics
+        ],
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target', help='base url of the stage eg. https://backstage.example.com')
+    parser.add_argument('--standin', action='store_true', help='start the stand-in server and run against it')
+    parser.add_argument('--scenario', default=SCENARIO, help='scenario json file')
+    parser.add_argument('--var', action='append', default=[], metavar='KEY=VALUE', help='override a scenario variable')
+    parser.add_argument('--duration', type=int, default=60, help='seconds to measure for')
+    parser.add_argument('--warmup', type=int, default=10, help='seconds of unmeasured load first')
+    parser.add_argument('--concurrency', type=int, default=10, help='concurrent clients')
+    parser.add_argument('--timeout', type=float, default=30, help='request timeout in seconds')
+    parser.add_argument('--max-p95-ms', type=float, help='fail when the overall p95 is higher')
+    parser.add_argument('--max-p99-ms', type=float, help='fail when the overall p99 is higher')
+    parser.add_argument('--min-rps', type=float, help='fail when fewer requests per second are served')
+    parser.add_argument('--max-error-rate', type=float, help='fail when a larger fraction of requests fail eg. 0.01')
+    parser.add_argument('--output', help='write the results as json to this file')
+    parser.add_argument('--metrics-file', help='write cloudwatch metric data for the results to this file')
+    parser.add_argument('--stage', default='local', help='stage name for the metric dimension')
+    args = parser.parse_args()
+
+    if args.standin:
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import standin_server
+        server = standin_server.make_server(port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        args.target = f"http://127.0.0.1:{server.server_address[1]}"
+    if not args.target:
+        parser.error('one of --target or --standin is required')
+
+    if any('=' not in var for var in args.var):
+        parser.error(f"--var takes KEY=VALUE, got {[var for var in args.var if '=' not in var]}")
+    overrides = dict(var.split('=', 1) for var in args.var)
+    requests = load_scenario(args.scenario, overrides)
+    results = run(args.target, requests, args.duration, args.concurrency, args.warmup, args.timeout)
+    results['breaches'] = breaches(results['overall'], args.max_p95_ms, args.max_p99_ms, args.min_rps, args.max_error_rate)
+
+    for name, summary in [('overall', results['overall'])] + list(results['requests'].items()):
+        print(f"{name:>12}: {summary['requests']:>6} requests, {summary['error_rate'] * 100:>6.2f}% errors, "
+              f"p50 {summary['p50_ms']:>7.1f}ms, p95 {summary['p95_ms']:>7.1f}ms, p99 {summary['p99_ms']:>7.1f}ms, "
+              f"{summary['rps']:>7.2f} rps")
+
+    if args.output:
+        with open(args.output, 'w') as out_file:
+            json.dump(results, out_file, indent=2)
+    if args.metrics_file:
+        with open(args.metrics_file, 'w') as out_file:
+            json.dump(metric_data(results, args.stage), out_file, indent=2)
+
+    if results['breaches']:
+        for breach in results['breaches']:
+            print(f"SLO breach: {breach}", file=sys.stderr)
+        sys.exit(BREACH_EXIT_CODE)
+
+
+if __name__ == '__main__':
+    main()
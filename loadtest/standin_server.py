@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+'''
+    Stand-in for the backstage backend, to try out load test scenarios locally.
+
+    Answers every GET with a small json body after a random delay, and 404s for
+    paths under /missing so error handling can be checked too.
+
+    usage:
+        python loadtest/standin_server.py --port 7007 --delay-ms 20 --jitter-ms 30
+        python loadtest/runner.py --target http://127.0.0.1:7007 --duration 10
+'''
+import argparse
+import json
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def make_server(port: int = 7007, delay_ms: float = 20, jitter_ms: float = 30) -> ThreadingHTTPServer:
+
+    class StandinHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            time.sleep((delay_ms + random.uniform(0, jitter_ms)) / 1000)
+            status = 404 if self.path.startswith('/missing') else 200
+            body = json.dumps({'path': self.path, 'items': []}).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # keep the runner output readable
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), StandinHandler)
+    server.daemon_threads = True
+    return server
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=7007)
+    parser.add_argument('--delay-ms', type=float, default=20, help='base response time')
+    parser.add_argument('--jitter-ms', type=float, default=30, help='random extra response time')
+    args = parser.parse_args()
+
+    server = make_server(args.port, args.delay_ms, args.jitter_ms)
+    print(f"stand-in backstage on http://127.0.0.1:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+'''
+    Write template-hashes.json into a cloud assembly directory, 
+    a map of stack name to the sha256 of its synthesized template.
+    The infra pipeline deploy actions use it to skip stacks whose template hasnt changed.
+
+    usage:
+        python3 scripts/template_hashes.py cdk.out
+'''
+import glob
+import hashlib
+import json
+import os
+import sys
+
+SUFFIX = '.template.json'
+
+
+def template_hashes(outdir: str) -> dict:
+    hashes = dict()
+    for template in sorted(glob.glob(os.path.join(outdir, f"*{SUFFIX}"))):
+        with open(template, 'rb') as template_file:
+            hashes[os.path.basename(template)[:-len(SUFFIX)]] = hashlib.sha256(template_file.read()).hexdigest()
+    return hashes
+
+
+if __name__ == '__main__':
+    outdir = sys.argv[1] if len(sys.argv) > 1 else 'cdk.out'
+    with open(os.path.join(outdir, 'template-hashes.json'), 'w') as manifest:
+        json.dump(template_hashes(outdir), manifest, indent=2, sort_keys=True)
@@ -0,0 +1,58 @@
+import json
+import os
+import sys
+import tempfile
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from aws_cdk import core
+from infra.app_builder import build_app
+from tests.synth_fixture import fixture_config, lookup_context
+
+
+def resources(template: dict, resource_type: str) -> dict:
+    return {
+        logical_id: resource
+        for logical_id, resource in template['Resources'].items()
+        if resource['Type'] == resource_type
+    }
+
+
+def container_environment(template: dict) -> dict:
+    (task_definition,) = resources(template, 'AWS::ECS::TaskDefinition').values()
+    container = task_definition['Properties']['ContainerDefinitions'][0]
+    return {variable['Name']: variable['Value'] for variable in container.get('Environment', [])}
+
+
+@pytest.fixture
+def config():
+    '''
+        a fresh copy of the single stage benchmark fixture, tests change its `bench0` stage
+    '''
+    return fixture_config(1)
+
+
+@pytest.fixture
+def synth(monkeypatch):
+    '''
+        synthesizes a config offline with the cdk.json context and returns the templates by stack name
+    '''
+    # the app reads the buildspecs relative to the repo root
+    monkeypatch.chdir(REPO_ROOT)
+
+    def synth_config(config: dict) -> dict:
+        with open(os.path.join(REPO_ROOT, 'cdk.json')) as cdk_file:
+            context = json.load(cdk_file).get('context', {})
+        context.update(lookup_context(config))
+        with tempfile.TemporaryDirectory() as outdir:
+            assembly = build_app(config, core.App(outdir=outdir, context=context)).synth()
+            templates = dict()
+            for stack in assembly.stacks:
+                with open(stack.template_full_path) as template_file:
+                    templates[stack.stack_name] = json.load(template_file)
+        return templates
+
+    return synth_config
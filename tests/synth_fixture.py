@@ -0,0 +1,49 @@
+'''
+    builds the benchmark fixture config and answers its lookups offline,
+    shared by the tests and the synth benchmark.
+'''
+import copy
+import os
+
+import yaml
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURE = os.path.join(REPO_ROOT, 'benchmarks', 'fixture-config.yaml')
+
+
+def fixture_config(stage_count: int, fixture: str = FIXTURE) -> dict:
+    # copy the fixture stage stage_count times, each with its own host name
+    with open(fixture) as conf_file:
+        config = yaml.full_load(conf_file)
+    (name, stage), = config['stages'].items()
+    config['stages'] = dict()
+    for index in range(stage_count):
+        stage_copy = copy.deepcopy(stage)
+        stage_copy['HOST_NAME'] = f"{stage.get('HOST_NAME', name)}-{index}"
+        config['stages'][f"{name}{index}"] = stage_copy
+    return config
+
+
+def lookup_context(config: dict) -> dict:
+    '''
+        context values for every lookup the app makes, keyed the way cdk keys them in cdk.context.json,
+        so synth never needs credentials.
+    '''
+    common = config['common']
+    account = common.get('AWS_ACCOUNT')
+    regions = {common.get('AWS_REGION', 'us-east-1')}
+    domains = set()
+    for stage in config['stages'].values():
+        props = {**common, **stage}
+        domains.add(props.get('DOMAIN_NAME', 'example.com'))
+        regions.update(props.get('REGIONS', []))
+
+    context = dict()
+    for region in sorted(regions):
+        context[f"availability-zones:account={account}:region={region}"] = [f"{region}{az}" for az in 'abc']
+        for domain in sorted(domains):
+            context[f"hosted-zone:account={account}:domainName={domain}:region={region}"] = {
+                "Id": "/hostedzone/Z0000000000000000000",
+                "Name": f"{domain}.",
+            }
+    return context
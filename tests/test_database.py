@@ -0,0 +1,120 @@
+import pytest
+
+from conftest import resources
+
+
+def stage_template(synth, config: dict, **stage) -> dict:
+    config['stages']['bench0'].update(stage)
+    return synth(config)[config['common']['TAG_STACK_NAME']]
+
+
+def only(template: dict, resource_type: str) -> dict:
+    (resource,) = resources(template, resource_type).values()
+    return resource
+
+
+def test_parameter_groups(synth, config):
+    template = stage_template(synth, config,
+        DB_ENGINE_VERSION='13.7',
+        DB_ALLOW_MAJOR_UPGRADE=True,
+        DB_CLUSTER_PARAMETERS={'log_min_duration_statement': 500},
+        DB_INSTANCE_PARAMETERS={'work_mem': 16384},
+    )
+    cluster_group = only(template, 'AWS::RDS::DBClusterParameterGroup')['Properties']
+    instance_group = only(template, 'AWS::RDS::DBParameterGroup')['Properties']
+    # the family follows the engine major version
+    assert cluster_group['Family'] == instance_group['Family'] == 'aurora-postgresql13'
+    assert cluster_group['Parameters'] == {'log_min_duration_statement': '500'}
+    assert instance_group['Parameters'] == {'work_mem': '16384'}
+    assert 'shared_preload_libraries' not in cluster_group['Parameters']
+
+
+def test_major_upgrade_needs_allow_flag(synth, config):
+    with pytest.raises(ValueError, match='DB_ALLOW_MAJOR_UPGRADE'):
+        stage_template(synth, config, DB_ENGINE_VERSION='13.7')
+
+
+def test_pg_stat_statements(synth, config):
+    template = stage_template(synth, config, DB_ENGINE_VERSION='14.9', DB_ALLOW_MAJOR_UPGRADE=True, DB_PG_STAT_STATEMENTS=True)
+    (group_id, cluster_group), = resources(template, 'AWS::RDS::DBClusterParameterGroup').items()
+    assert cluster_group['Properties']['Family'] == 'aurora-postgresql14'
+    assert 'pg_stat_statements' in cluster_group['Properties']['Parameters']['shared_preload_libraries'].split(',')
+    cluster = only(template, 'AWS::RDS::DBCluster')
+    assert cluster['Properties']['DBClusterParameterGroupName'] == {'Ref': group_id}
+
+
+def test_replica_autoscaling(synth, config):
+    template = stage_template(synth, config,
+        DB_REPLICA_MIN_COUNT=0, DB_REPLICA_MAX_COUNT=3, DB_REPLICA_TARGET_CPU=60,
+    )
+    (target_id, target), = [
+        (logical_id, target) for logical_id, target in resources(template, 'AWS::ApplicationAutoScaling::ScalableTarget').items()
+        if target['Properties']['ServiceNamespace'] == 'rds'
+    ]
+    assert target['Properties']['ScalableDimension'] == 'rds:cluster:ReadReplicaCount'
+    assert (target['Properties']['MinCapacity'], target['Properties']['MaxCapacity']) == (0, 3)
+    (policy,) = [
+        policy['Properties'] for policy in resources(template, 'AWS::ApplicationAutoScaling::ScalingPolicy').values()
+        if policy['Properties']['ScalingTargetId'] == {'Ref': target_id}
+    ]
+    tracking = policy['TargetTrackingScalingPolicyConfiguration']
+    assert tracking['PredefinedMetricSpecification']['PredefinedMetricType'] == 'RDSReaderAverageCPUUtilization'
+    assert tracking['TargetValue'] == 60
+
+
+def test_log_exports(synth, config):
+    template = stage_template(synth, config, DB_LOG_EXPORTS=True)
+    (cluster_id, cluster), = resources(template, 'AWS::RDS::DBCluster').items()
+    assert cluster['Properties']['EnableCloudwatchLogsExports'] == ['postgresql']
+    # retention is set on a plain log group the instances wait for, not with a lambda backed construct
+    (log_group_id, log_group), = [
+        (logical_id, log_group) for logical_id, log_group in resources(template, 'AWS::Logs::LogGroup').items()
+        if logical_id.startswith('bench0PGLogGroup')
+    ]
+    assert log_group['Properties']['LogGroupName']['Fn::Join'][1] == ['/aws/rds/cluster/', {'Ref': cluster_id}, '/postgresql']
+    for instance in resources(template, 'AWS::RDS::DBInstance').values():
+        assert log_group_id in instance['DependsOn']
+    assert resources(template, 'AWS::Lambda::Function') == {}
+
+
+def test_log_exports_off_by_default(synth, config):
+    template = stage_template(synth, config)
+    cluster = only(template, 'AWS::RDS::DBCluster')
+    assert 'EnableCloudwatchLogsExports' not in cluster['Properties']
+    assert not any(logical_id.startswith('bench0PGLogGroup') for logical_id in resources(template, 'AWS::Logs::LogGroup'))
+
+
+def global_templates(synth, config: dict, **stage) -> tuple:
+    config['stages']['bench0'].update({
+        'REGIONS': ['us-east-1', 'us-west-2'],
+        'DB_INSTANCE_CLASS': 'r6g.large',
+        'DB_ENGINE_VERSION': '14.9',
+        'DB_ALLOW_MAJOR_UPGRADE': True,
+        **stage,
+    })
+    stack_name = config['common']['TAG_STACK_NAME']
+    templates = synth(config)
+    return templates[stack_name], templates[f"{stack_name}-us-west-2"]
+
+
+def test_secondary_cluster_has_no_master_credentials(synth, config):
+    primary, secondary = global_templates(synth, config, DB_CLUSTER_PARAMETERS={'log_min_duration_statement': 500}, DB_LOG_EXPORTS=True)
+    assert only(primary, 'AWS::RDS::GlobalCluster')['Properties']['GlobalClusterIdentifier'] == 'backstage-bench-bench0-global'
+    cluster = only(secondary, 'AWS::RDS::DBCluster')['Properties']
+    assert 'MasterUsername' not in cluster and 'MasterUserPassword' not in cluster
+    assert cluster['GlobalClusterIdentifier'] == 'backstage-bench-bench0-global'
+    assert cluster['EnableGlobalWriteForwarding'] is True
+    # the secondary gets the same settings the primary cluster does
+    assert cluster['EngineVersion'] == only(primary, 'AWS::RDS::DBCluster')['Properties']['EngineVersion']
+    assert cluster['EnableCloudwatchLogsExports'] == ['postgresql']
+    assert only(secondary, 'AWS::RDS::DBClusterParameterGroup')['Properties']['Parameters'] == {'log_min_duration_statement': '500'}
+    instances = resources(secondary, 'AWS::RDS::DBInstance').values()
+    assert [instance['Properties']['DBInstanceClass'] for instance in instances] == ['db.r6g.large', 'db.r6g.large']
+    assert all('PGLogGroup' in ''.join(instance['DependsOn']) for instance in instances)
+
+
+def test_image_replication_is_limited_to_the_backstage_repo(synth, config):
+    primary, _ = global_templates(synth, config)
+    (rule,) = only(primary, 'AWS::ECR::ReplicationConfiguration')['Properties']['ReplicationConfiguration']['Rules']
+    assert rule['RepositoryFilters'] == [{'Filter': config['common']['ECR_REPO_NAME'], 'FilterType': 'PREFIX_MATCH'}]
+    assert [destination['Region'] for destination in rule['Destinations']] == ['us-west-2']
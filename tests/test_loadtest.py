@@ -0,0 +1,93 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from conftest import REPO_ROOT
+
+sys.path.insert(0, os.path.join(REPO_ROOT, 'loadtest'))
+import runner
+import standin_server
+
+RUNNER = os.path.join(REPO_ROOT, 'loadtest', 'runner.py')
+
+
+@pytest.fixture
+def standin():
+    '''
+        the stand-in backstage backend on a free port, yields its base url
+    '''
+    server = standin_server.make_server(port=0, delay_ms=1, jitter_ms=1)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def run_runner(*args: str) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, RUNNER, *args], capture_output=True, text=True)
+
+
+def test_percentile_is_the_nearest_rank():
+    latencies = [float(latency) for latency in range(1, 101)]
+    assert runner.percentile(latencies, 50) == 50.0
+    assert runner.percentile(latencies, 95) == 95.0
+    assert runner.percentile(latencies, 99) == 99.0
+    assert runner.percentile([12.34], 99) == 12.3
+    assert runner.percentile([], 95) == 0.0
+
+
+def test_breaches():
+    overall = {'p95_ms': 900.0, 'p99_ms': 1500.0, 'rps': 20.0, 'error_rate': 0.02}
+    assert runner.breaches(overall) == []
+    assert runner.breaches(overall, max_p95=1000, max_p99=2000, min_rps=10, max_error_rate=0.05) == []
+    assert runner.breaches(overall, max_p95=800, max_p99=1000, min_rps=50, max_error_rate=0.01) == [
+        'p95 900.0ms is over 800ms',
+        'p99 1500.0ms is over 1000ms',
+        '20.0 requests per second is under 50',
+        'error rate 0.02 is over 0.01',
+    ]
+
+
+def test_metric_data_payload():
+    results = {'overall': {'p50_ms': 10.0, 'p95_ms': 20.0, 'p99_ms': 30.0, 'rps': 40.0, 'error_rate': 0.05}}
+    payload = runner.metric_data(results, 'prod')
+    assert payload['Namespace'] == 'Backstage/LoadTest'
+    assert [(metric['MetricName'], metric['Value'], metric['Unit']) for metric in payload['MetricData']] == [
+        ('LatencyP50', 10.0, 'Milliseconds'),
+        ('LatencyP95', 20.0, 'Milliseconds'),
+        ('LatencyP99', 30.0, 'Milliseconds'),
+        ('RequestsPerSecond', 40.0, 'Count/Second'),
+        ('ErrorRate', 5.0, 'Percent'),
+    ]
+    assert all(metric['Dimensions'] == [{'Name': 'Stage', 'Value': 'prod'}] for metric in payload['MetricData'])
+
+
+def test_run_against_the_standin(standin):
+    requests = runner.load_scenario(runner.SCENARIO, {'name': 'backstage'})
+    results = runner.run(standin, requests, duration=1, concurrency=2, warmup=0, timeout=5)
+    assert results['overall']['requests'] > 0
+    assert results['overall']['errors'] == 0
+    assert set(results['requests']) == {request['name'] for request in requests}
+
+
+def test_breach_exits_with_the_breach_code(standin, tmp_path):
+    metrics = tmp_path / 'metrics.json'
+    result = run_runner('--target', standin, '--duration', '1', '--warmup', '0', '--concurrency', '1',
+                        '--min-rps', '1000000', '--metrics-file', str(metrics))
+    assert result.returncode == runner.BREACH_EXIT_CODE
+    assert 'SLO breach' in result.stderr
+    # the results of a breached run are still published
+    with open(metrics) as metrics_file:
+        assert json.load(metrics_file)['Namespace'] == 'Backstage/LoadTest'
+
+
+def test_var_without_a_value_is_a_usage_error(tmp_path):
+    metrics = tmp_path / 'metrics.json'
+    result = run_runner('--target', 'http://127.0.0.1:1', '--var', 'name', '--metrics-file', str(metrics))
+    assert result.returncode == 2
+    assert '--var takes KEY=VALUE' in result.stderr
+    assert not metrics.exists()
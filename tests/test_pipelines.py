@@ -0,0 +1,274 @@
+import copy
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+import yaml
+
+from conftest import REPO_ROOT, resources
+
+
+def pipeline_stages(template: dict, pipeline_name: str) -> list:
+    '''
+        the stages of a pipeline as (stage name, [(run order, action name), ...]) in pipeline order
+    '''
+    (pipeline,) = [
+        pipeline['Properties'] for pipeline in resources(template, 'AWS::CodePipeline::Pipeline').values()
+        if pipeline['Properties']['Name'] == pipeline_name
+    ]
+    return [
+        (stage['Name'], sorted((action.get('RunOrder', 1), action['Name']) for action in stage['Actions']))
+        for stage in pipeline['Stages']
+    ]
+
+
+def wave_config(config: dict) -> dict:
+    # a test stage on its own, then a rolling and a blue/green prod in one wave behind an approval
+    stage = config['stages'].pop('bench0')
+    config['stages'] = {
+        'test': {**copy.deepcopy(stage), 'HOST_NAME': 'test'},
+        'prod': {**copy.deepcopy(stage), 'HOST_NAME': 'prod', 'STAGE_WAVE': 1, 'STAGE_APPROVAL': True,
+                 'DEPLOY_MODE': 'blue_green'},
+        'prod2': {**copy.deepcopy(stage), 'HOST_NAME': 'prod2', 'STAGE_WAVE': 1},
+    }
+    return config
+
+
+def test_app_pipeline_order(synth, config):
+    templates = synth(wave_config(config))
+    stages = pipeline_stages(templates[config['common']['TAG_STACK_NAME']], 'backstage-app-pipeline')
+    assert [name for name, _ in stages] == ['Source', 'Build', 'test-deploy', 'wave-1-deploy']
+    assert stages[2][1] == [(1, 'test-deploy')]
+    # the approval gates the whole wave, the blue/green stage prepares its appspec before deploying
+    assert stages[3][1] == [
+        (1, 'wave-1-stage-approval'),
+        (2, 'prod-prepare'),
+        (2, 'prod2-deploy'),
+        (3, 'prod-deploy'),
+    ]
+
+
+def test_infra_pipeline_order(synth, config):
+    stack_name = config['common']['TAG_STACK_NAME']
+    templates = synth(config)
+    stages = pipeline_stages(templates[f"{stack_name}-pipeline"], f"{stack_name}-pipeline")
+    # the pipeline updates itself before it deploys the backstage stack
+    assert stages == [
+        ('Source', [(1, 'Github-Source')]),
+        ('Synth', [(1, 'Synth')]),
+        (f"Deploy-{stack_name}-pipeline", [(1, f"Deploy-{stack_name}-pipeline")]),
+        (f"Deploy-{stack_name}", [(1, f"Deploy-{stack_name}")]),
+    ]
+
+
+def test_secondary_regions_deploy_after_primary(synth, config):
+    config['stages']['bench0'].update({
+        'REGIONS': ['us-east-1', 'us-west-2'],
+        'DB_INSTANCE_CLASS': 'r6g.large',
+        'DB_ENGINE_VERSION': '14.9',
+        'DB_ALLOW_MAJOR_UPGRADE': True,
+    })
+    templates = synth(config)
+    stages = pipeline_stages(templates[config['common']['TAG_STACK_NAME']], 'backstage-app-pipeline')
+    # the primary region runs the migrations, write forwarding doesnt forward them
+    assert stages[-1] == ('bench0-deploy', [(1, 'bench0-deploy'), (2, 'bench0-us-west-2-deploy')])
+
+
+def test_infra_deploys_pass_a_role_per_stack(synth, config):
+    stack_name = config['common']['TAG_STACK_NAME']
+    template = synth(config)[f"{stack_name}-pipeline"]
+    deploy_roles = {
+        logical_id for logical_id, role in resources(template, 'AWS::IAM::Role').items()
+        if role['Properties']['AssumeRolePolicyDocument']['Statement'][0]['Principal'] == {'Service': 'cloudformation.amazonaws.com'}
+    }
+    assert len(deploy_roles) == 2
+    assert not any(role['Properties'].get('ManagedPolicyArns') for role in resources(template, 'AWS::IAM::Role').values())
+    (project,) = [
+        project for project in resources(template, 'AWS::CodeBuild::Project').values()
+        if project['Properties']['Name'] == f"{stack_name}-pipeline-deploy"
+    ]
+    project_role = project['Properties']['ServiceRole']['Fn::GetAtt'][0]
+    (policy,) = [
+        policy['Properties']['PolicyDocument']['Statement'] for policy in resources(template, 'AWS::IAM::Policy').values()
+        if policy['Properties']['Roles'] == [{'Ref': project_role}]
+    ]
+    # codebuild can pass each role to cloudformation, and create change sets for a stack with its own role only
+    passed = [statement for statement in policy if statement['Action'] == 'iam:PassRole']
+    assert {statement['Resource']['Fn::GetAtt'][0] for statement in passed} == deploy_roles
+    assert all(statement['Condition'] == {'StringEquals': {'iam:PassedToService': 'cloudformation.amazonaws.com'}} for statement in passed)
+    change_sets = [statement for statement in policy if statement['Action'] == 'cloudformation:CreateChangeSet']
+    assert {statement['Condition']['StringEquals']['cloudformation:RoleArn']['Fn::GetAtt'][0] for statement in change_sets} == deploy_roles
+
+
+def app_build_project(template: dict, project_name: str = 'backstage-app-pipeline') -> dict:
+    (project,) = [
+        project['Properties'] for project in resources(template, 'AWS::CodeBuild::Project').values()
+        if project['Properties']['Name'] == project_name
+    ]
+    return project
+
+
+def test_buildkit_local_cache_is_a_custom_cache_path(synth, config):
+    config['common'].update({'APP_BUILD_CACHE_MODE': 'buildkit', 'APP_BUILD_LOCAL_CACHE': True})
+    template = synth(config)[config['common']['TAG_STACK_NAME']]
+    project = app_build_project(template)
+    # the buildx builder doesnt see the docker layer cache, its local cache is kept as a custom path
+    assert project['Cache']['Modes'] == ['LOCAL_DOCKER_LAYER_CACHE', 'LOCAL_SOURCE_CACHE', 'LOCAL_CUSTOM_CACHE']
+    assert '/root/.buildkit-cache/**/*' in project['Source']['BuildSpec']
+    (pipeline,) = resources(template, 'AWS::CodePipeline::Pipeline').values()
+    (build,) = [action for stage in pipeline['Properties']['Stages'] for action in stage['Actions'] if action['Name'] == 'Docker-Build']
+    # the variables are joined with the repository uri token, so the literal parts are searched
+    environment = ''.join(part for part in build['Configuration']['EnvironmentVariables']['Fn::Join'][1] if isinstance(part, str))
+    assert '{"name":"LOCAL_CACHE","type":"PLAINTEXT","value":"1"}' in environment
+
+
+def app_pipeline_action(template: dict, action_name: str) -> dict:
+    (pipeline,) = [
+        pipeline['Properties'] for pipeline in resources(template, 'AWS::CodePipeline::Pipeline').values()
+        if pipeline['Properties']['Name'] == 'backstage-app-pipeline'
+    ]
+    (action,) = [action for stage in pipeline['Stages'] for action in stage['Actions'] if action['Name'] == action_name]
+    return action
+
+
+def test_build_caching_defaults(synth, config):
+    project = app_build_project(synth(config)[config['common']['TAG_STACK_NAME']])
+    assert project['Cache'] == {'Type': 'NO_CACHE'}
+    assert project['Environment']['ComputeType'] == 'BUILD_GENERAL1_SMALL'
+    assert project['Environment']['Image'] == 'aws/codebuild/standard:5.0'
+    # the pulled latest image carries the cache metadata buildkit needs to reuse its layers
+    assert 'BUILDKIT_INLINE_CACHE=1' in project['Source']['BuildSpec']
+
+
+def test_build_image_and_compute(synth, config):
+    config['common'].update({'APP_BUILD_IMAGE': 'aws/codebuild/standard:7.0', 'APP_BUILD_COMPUTE': 'LARGE'})
+    project = app_build_project(synth(config)[config['common']['TAG_STACK_NAME']])
+    assert project['Environment']['Image'] == 'aws/codebuild/standard:7.0'
+    assert project['Environment']['ComputeType'] == 'BUILD_GENERAL1_LARGE'
+    assert project['Environment']['PrivilegedMode'] is True
+
+
+def test_build_cache_mode_is_checked(synth, config):
+    config['common']['APP_BUILD_CACHE_MODE'] = 'registry'
+    with pytest.raises(ValueError, match='APP_BUILD_CACHE_MODE'):
+        synth(config)
+
+
+def test_multi_arch_builds_merge_into_a_manifest(synth, config):
+    config['common']['APP_BUILD_ARCHITECTURES'] = ['amd64', 'arm64']
+    template = synth(config)[config['common']['TAG_STACK_NAME']]
+    amd64 = app_build_project(template, 'backstage-app-pipeline-amd64')
+    arm64 = app_build_project(template, 'backstage-app-pipeline-arm64')
+    assert (amd64['Environment']['Type'], arm64['Environment']['Type']) == ('LINUX_CONTAINER', 'ARM_CONTAINER')
+    assert arm64['Environment']['Image'] == 'aws/codebuild/amazonlinux2-aarch64-standard:3.0'
+    stages = pipeline_stages(template, 'backstage-app-pipeline')
+    assert stages[1:3] == [
+        ('Build', [(1, 'Docker-Build-amd64'), (1, 'Docker-Build-arm64')]),
+        ('Manifest', [(1, 'Docker-Manifest')]),
+    ]
+    # the per arch builds only push images, the deploy reads the image files the manifest step writes
+    assert 'OutputArtifacts' not in app_pipeline_action(template, 'Docker-Build-arm64')
+    manifest_output = app_pipeline_action(template, 'Docker-Manifest')['OutputArtifacts']
+    assert app_pipeline_action(template, 'bench0-deploy')['InputArtifacts'] == manifest_output
+
+
+def test_soci_index_runs_before_the_deploys(synth, config):
+    config['common'].update({'APP_BUILD_SOCI_INDEX': True, 'APP_BUILD_SOCI_VERSION': '0.5.0'})
+    template = synth(config)[config['common']['TAG_STACK_NAME']]
+    stages = pipeline_stages(template, 'backstage-app-pipeline')
+    assert [name for name, _ in stages] == ['Source', 'Build', 'Index', 'bench0-deploy']
+    action = app_pipeline_action(template, 'Soci-Index')
+    assert action['InputArtifacts'] == app_pipeline_action(template, 'Docker-Build')['OutputArtifacts']
+    environment = {variable['name']: variable['value'] for variable in json.loads(action['Configuration']['EnvironmentVariables'])}
+    assert environment['SOCI_VERSION'] == '0.5.0'
+    assert environment['ARCHITECTURES'] == 'amd64'
+
+
+def test_techdocs_publish_runs_alongside_the_build(synth, config):
+    config['common'].update({'TECHDOCS_BUCKET_ENABLED': True, 'TECHDOCS_PUBLISH_ENABLED': True})
+    template = synth(config)[config['common']['TAG_STACK_NAME']]
+    stages = dict(pipeline_stages(template, 'backstage-app-pipeline'))
+    assert stages['Build'] == [(1, 'Docker-Build'), (1, 'Techdocs-Publish')]
+    (bucket_id,) = [logical_id for logical_id in resources(template, 'AWS::S3::Bucket') if 'techdocs' in logical_id]
+    project = app_build_project(template, 'backstage-techdocs-publish')
+    project_role = project['ServiceRole']['Fn::GetAtt'][0]
+    actions = [
+        action for policy in resources(template, 'AWS::IAM::Policy').values()
+        if policy['Properties']['Roles'] == [{'Ref': project_role}]
+        for statement in policy['Properties']['PolicyDocument']['Statement']
+        if {'Fn::GetAtt': [bucket_id, 'Arn']} in (statement['Resource'] if isinstance(statement['Resource'], list) else [statement['Resource']])
+        for action in statement['Action']
+    ]
+    assert 's3:PutObject' in actions
+
+
+def test_techdocs_publish_needs_the_bucket(synth, config):
+    config['common']['TECHDOCS_PUBLISH_ENABLED'] = True
+    stages = dict(pipeline_stages(synth(config)[config['common']['TAG_STACK_NAME']], 'backstage-app-pipeline'))
+    assert stages['Build'] == [(1, 'Docker-Build')]
+
+
+def test_blue_green_prepare_action(synth, config):
+    config['stages']['bench0'].update({
+        'DEPLOY_MODE': 'blue_green',
+        'CAPACITY_PROVIDER_STRATEGY': [{'CAPACITY_PROVIDER': 'FARGATE', 'BASE': 1}, {'CAPACITY_PROVIDER': 'FARGATE_SPOT', 'WEIGHT': 3}],
+    })
+    template = synth(config)[config['common']['TAG_STACK_NAME']]
+    prepare = app_pipeline_action(template, 'bench0-prepare')
+    environment = {variable['name']: variable['value'] for variable in json.loads(prepare['Configuration']['EnvironmentVariables'])}
+    (task_definition,) = resources(template, 'AWS::ECS::TaskDefinition').values()
+    assert environment['TASK_FAMILY'] == task_definition['Properties']['Family']
+    assert (environment['CONTAINER_NAME'], environment['CONTAINER_PORT']) == ('backstage', '7000')
+    assert json.loads(environment['CAPACITY_PROVIDER_STRATEGY']) == [
+        {'CapacityProvider': 'FARGATE', 'Base': 1, 'Weight': 1},
+        {'CapacityProvider': 'FARGATE_SPOT', 'Base': 0, 'Weight': 3},
+    ]
+    deploy = app_pipeline_action(template, 'bench0-deploy')
+    assert deploy['ActionTypeId']['Provider'] == 'CodeDeployToECS'
+    assert deploy['InputArtifacts'] == prepare['OutputArtifacts']
+    assert (deploy['Configuration']['TaskDefinitionTemplatePath'], deploy['Configuration']['AppSpecTemplatePath']) == ('taskdef.json', 'appspec.yaml')
+    assert deploy['Configuration']['Image1ContainerName'] == 'IMAGE1_NAME'
+
+
+def prepare_script() -> str:
+    # the python the blue/green buildspec runs on the registered task definition
+    with open(os.path.join(REPO_ROOT, 'bluegreen-buildspec.yml')) as spec_file:
+        commands = yaml.safe_load(spec_file)['phases']['build']['commands']
+    (command,) = [command for command in commands if "<<'PY'" in command]
+    return command.split("<<'PY'\n", 1)[1].rsplit('PY', 1)[0]
+
+
+def test_blue_green_taskdef_and_appspec(tmp_path):
+    registered = {
+        'taskDefinitionArn': 'arn:aws:ecs:us-east-1:123456789012:task-definition/bench:3',
+        'revision': 3,
+        'status': 'ACTIVE',
+        'requiresAttributes': [],
+        'compatibilities': ['EC2', 'FARGATE'],
+        'registeredAt': '2024-01-01T00:00:00Z',
+        'registeredBy': 'arn:aws:iam::123456789012:role/deploy',
+        'family': 'bench',
+        'containerDefinitions': [
+            {'name': 'backstage', 'image': '123456789012.dkr.ecr.us-east-1.amazonaws.com/backstage:latest'},
+            {'name': 'log-router', 'image': 'public.ecr.aws/aws-observability/aws-for-fluent-bit:stable'},
+        ],
+    }
+    (tmp_path / 'registered-taskdef.json').write_text(json.dumps(registered))
+    strategy = [{'CapacityProvider': 'FARGATE_SPOT', 'Base': 0, 'Weight': 1}]
+    subprocess.run(
+        [sys.executable, '-c', prepare_script()], cwd=tmp_path, check=True,
+        env={**os.environ, 'CONTAINER_NAME': 'backstage', 'CONTAINER_PORT': '7000', 'CAPACITY_PROVIDER_STRATEGY': json.dumps(strategy)},
+    )
+    taskdef = json.loads((tmp_path / 'taskdef.json').read_text())
+    # codedeploy registers the template again, so the read only fields are gone
+    assert set(taskdef) == {'family', 'containerDefinitions'}
+    assert [container['image'] for container in taskdef['containerDefinitions']] == [
+        '<IMAGE1_NAME>', 'public.ecr.aws/aws-observability/aws-for-fluent-bit:stable',
+    ]
+    (target,) = yaml.safe_load((tmp_path / 'appspec.yaml').read_text())['Resources']
+    properties = target['TargetService']['Properties']
+    assert properties['TaskDefinition'] == '<TASK_DEFINITION>'
+    assert properties['LoadBalancerInfo'] == {'ContainerName': 'backstage', 'ContainerPort': 7000}
+    assert properties['CapacityProviderStrategy'] == strategy
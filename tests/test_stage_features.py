@@ -0,0 +1,280 @@
+import copy
+
+import pytest
+
+from conftest import container_environment, resources
+
+
+def stage_template(synth, config: dict, **stage) -> dict:
+    config['stages']['bench0'].update(stage)
+    return synth(config)[config['common']['TAG_STACK_NAME']]
+
+
+def only(template: dict, resource_type: str) -> dict:
+    (resource,) = resources(template, resource_type).values()
+    return resource['Properties']
+
+
+def ingress_sources(template: dict, group_id: str, port: int) -> list:
+    return [
+        ingress['Properties'].get('SourceSecurityGroupId') or ingress['Properties'].get('SourcePrefixListId')
+        for ingress in resources(template, 'AWS::EC2::SecurityGroupIngress').values()
+        if ingress['Properties']['GroupId'] == {'Fn::GetAtt': [group_id, 'GroupId']} and ingress['Properties']['FromPort'] == port
+    ]
+
+
+def app_container(template: dict) -> dict:
+    return only(template, 'AWS::ECS::TaskDefinition')['ContainerDefinitions'][0]
+
+
+def test_database_proxy(synth, config):
+    template = stage_template(synth, config, DB_PROXY_ENABLED=True, DB_PROXY_REQUIRE_TLS=True, DB_PROXY_MAX_CONNECTIONS_PERCENT=50)
+    (proxy_id, proxy), = resources(template, 'AWS::RDS::DBProxy').items()
+    assert proxy['Properties']['DBProxyName'] == 'backstage-bench-bench0'
+    assert proxy['Properties']['RequireTLS'] is True
+    pool = only(template, 'AWS::RDS::DBProxyTargetGroup')['ConnectionPoolConfigurationInfo']
+    assert pool['MaxConnectionsPercent'] == 50
+    # the app connects through the proxy, reads still go to the reader endpoint
+    environment = container_environment(template)
+    assert environment['POSTGRES_HOST'] == {'Fn::GetAtt': [proxy_id, 'Endpoint']}
+    assert environment['POSTGRES_READER_HOST']['Fn::GetAtt'][1] == 'ReadEndpoint.Address'
+
+
+def test_database_proxy_names_are_unique_per_stage(synth, config):
+    stage = config['stages']['bench0']
+    stage['DB_PROXY_ENABLED'] = True
+    config['stages']['bench1'] = {**copy.deepcopy(stage), 'HOST_NAME': 'bench-1'}
+    template = synth(config)[config['common']['TAG_STACK_NAME']]
+    names = [proxy['Properties']['DBProxyName'] for proxy in resources(template, 'AWS::RDS::DBProxy').values()]
+    assert sorted(names) == ['backstage-bench-bench0', 'backstage-bench-bench1']
+
+
+def test_redis_cache(synth, config):
+    template = stage_template(synth, config, REDIS_ENABLED=True)
+    (redis_id, redis), = resources(template, 'AWS::ElastiCache::ReplicationGroup').items()
+    redis = redis['Properties']
+    assert (redis['NumNodeGroups'], redis['ReplicasPerNodeGroup']) == (1, 1)
+    assert redis['TransitEncryptionEnabled'] and redis['AtRestEncryptionEnabled']
+    assert 'CacheParameterGroupName' not in redis
+    environment = container_environment(template)
+    assert environment['REDIS_HOST'] == {'Fn::GetAtt': [redis_id, 'PrimaryEndPoint.Address']}
+    assert environment['REDIS_TLS'] == 'true'
+    assert 'REDIS_PASSWORD' in [secret['Name'] for secret in app_container(template)['Secrets']]
+    # only the tasks can reach the cache
+    (redis_sg,) = [group['Fn::GetAtt'][0] for group in redis['SecurityGroupIds']]
+    assert ingress_sources(template, redis_sg, 6379) == [{'Fn::GetAtt': ['infracommonresourcesfargatesecgroupDE4852EB', 'GroupId']}]
+
+
+def test_redis_cluster_mode(synth, config):
+    template = stage_template(synth, config, REDIS_ENABLED=True, REDIS_SHARDS=2)
+    (redis_id, redis), = resources(template, 'AWS::ElastiCache::ReplicationGroup').items()
+    assert redis['Properties']['CacheParameterGroupName'] == 'default.redis6.x.cluster.on'
+    assert container_environment(template)['REDIS_HOST'] == {'Fn::GetAtt': [redis_id, 'ConfigurationEndPoint.Address']}
+
+
+def test_cloudfront_behaviors(synth, config):
+    template = stage_template(synth, config,
+        CLOUDFRONT_ENABLED=True,
+        CLOUDFRONT_PREFIX_LIST_ID='pl-3b927c52',
+        CLOUDFRONT_STATIC_PATHS=['/static/*', '/assets/*'],
+        CLOUDFRONT_STATIC_TTL_DAYS=30,
+    )
+    distribution = only(template, 'AWS::CloudFront::Distribution')['DistributionConfig']
+    assert distribution['Aliases'] == ['bench-0.backstage.example.com']
+    assert distribution['PriceClass'] == 'PriceClass_100'
+    assert [origin['DomainName'] for origin in distribution['Origins']] == ['bench-0-origin.backstage.example.com']
+    (static_policy_id,) = resources(template, 'AWS::CloudFront::CachePolicy')
+    static_policy = only(template, 'AWS::CloudFront::CachePolicy')['CachePolicyConfig']
+    assert static_policy['DefaultTTL'] == 30 * 24 * 60 * 60
+    behaviors = {behavior['PathPattern']: behavior for behavior in distribution['CacheBehaviors']}
+    assert list(behaviors) == ['/static/*', '/assets/*', '/api/*']
+    for path in ('/static/*', '/assets/*'):
+        assert behaviors[path]['CachePolicyId'] == {'Ref': static_policy_id}
+        assert behaviors[path]['AllowedMethods'] == ['GET', 'HEAD']
+    # the managed CachingDisabled policy for the api and the default behavior
+    caching_disabled = '4135ea2d-6df8-44a3-9df3-4b5a84be39ad'
+    assert behaviors['/api/*']['CachePolicyId'] == caching_disabled
+    assert distribution['DefaultCacheBehavior']['CachePolicyId'] == caching_disabled
+    # the ALB only takes https from cloudfront
+    alb_sg = only(template, 'AWS::ElasticLoadBalancingV2::LoadBalancer')['SecurityGroups'][0]['Fn::GetAtt'][0]
+    assert 'SecurityGroupIngress' not in resources(template, 'AWS::EC2::SecurityGroup')[alb_sg]['Properties']
+    assert ingress_sources(template, alb_sg, 443) == ['pl-3b927c52']
+    records = {
+        (record['Properties']['Name'], record['Properties']['Type']) for record in resources(template, 'AWS::Route53::RecordSet').values()
+    }
+    assert {
+        ('bench-0.backstage.example.com.', 'A'),
+        ('bench-0.backstage.example.com.', 'AAAA'),
+        ('bench-0-origin.backstage.example.com.', 'A'),
+    } <= records
+
+
+def test_cloudfront_rejects_a_cert_outside_us_east_1(synth, config):
+    with pytest.raises(ValueError, match='us-east-1 cert'):
+        stage_template(synth, config,
+            CLOUDFRONT_ENABLED=True,
+            CLOUDFRONT_PREFIX_LIST_ID='pl-3b927c52',
+            ACM_ARN='arn:aws:acm:eu-west-1:123456789012:certificate/00000000-0000-0000-0000-000000000000',
+        )
+
+
+def test_techdocs_bucket(synth, config):
+    config['common']['TECHDOCS_BUCKET_ENABLED'] = True
+    template = stage_template(synth, config)
+    (bucket_id,) = [logical_id for logical_id in resources(template, 'AWS::S3::Bucket') if 'techdocs' in logical_id]
+    environment = container_environment(template)
+    assert environment['TECHDOCS_S3_BUCKET_NAME'] == {'Ref': bucket_id}
+    assert environment['TECHDOCS_S3_ROOT_PATH'] == 'api/techdocs/static/docs'
+    # the tasks read the docs, only the publish action writes them
+    task_role = only(template, 'AWS::ECS::TaskDefinition')['TaskRoleArn']['Fn::GetAtt'][0]
+    statements = [
+        statement for policy in resources(template, 'AWS::IAM::Policy').values()
+        if {'Ref': task_role} in policy['Properties']['Roles']
+        for statement in policy['Properties']['PolicyDocument']['Statement']
+        if {'Fn::GetAtt': [bucket_id, 'Arn']} in statement['Resource']
+    ]
+    assert [statement['Action'] for statement in statements] == [['s3:GetObject*', 's3:GetBucket*', 's3:List*']]
+
+
+def test_graviton_tasks_run_the_arm_image(synth, config):
+    config['common']['APP_BUILD_ARCHITECTURES'] = ['amd64', 'arm64']
+    template = stage_template(synth, config, CPU_ARCHITECTURE='ARM64')
+    task_definition = only(template, 'AWS::ECS::TaskDefinition')
+    assert task_definition['RuntimePlatform'] == {'CpuArchitecture': 'ARM64', 'OperatingSystemFamily': 'LINUX'}
+    assert app_container(template)['Image']['Fn::Join'][1][-1].endswith(':latest-arm64')
+
+
+def test_single_architecture_runs_latest(synth, config):
+    template = stage_template(synth, config)
+    assert 'RuntimePlatform' not in only(template, 'AWS::ECS::TaskDefinition')
+    assert app_container(template)['Image']['Fn::Join'][1][-1].endswith(':latest')
+
+
+def test_graviton_needs_an_arm_build(synth, config):
+    with pytest.raises(ValueError, match='APP_BUILD_ARCHITECTURES'):
+        stage_template(synth, config, CPU_ARCHITECTURE='ARM64')
+
+
+def test_container_logging_dashboard_and_alarms(synth, config):
+    config['common'].update({'CONTAINER_INSIGHTS': True, 'ALARM_TOPIC_ARN': 'arn:aws:sns:us-east-1:123456789012:alarms'})
+    template = stage_template(synth, config,
+        CONTAINER_LOGGING=True, LOG_RETENTION='ONE_WEEK', DASHBOARD_ENABLED=True, ALARMS_ENABLED=True, ALARM_TASK_CPU=70,
+    )
+    (log_group_id, log_group), = resources(template, 'AWS::Logs::LogGroup').items()
+    assert log_group['Properties']['LogGroupName'] == '/ecs/backstage-bench-bench0'
+    assert log_group['Properties']['RetentionInDays'] == 7
+    log_configuration = app_container(template)['LogConfiguration']
+    assert log_configuration['LogDriver'] == 'awslogs'
+    assert log_configuration['Options']['awslogs-group'] == {'Ref': log_group_id}
+    assert only(template, 'AWS::ECS::Cluster')['ClusterSettings'] == [{'Name': 'containerInsights', 'Value': 'enabled'}]
+    assert only(template, 'AWS::CloudWatch::Dashboard')['DashboardName'] == 'backstage-bench-bench0'
+    alarms = [alarm['Properties'] for alarm in resources(template, 'AWS::CloudWatch::Alarm').values()]
+    assert sorted(alarm['Threshold'] for alarm in alarms) == [2, 10, 70, 85, 85]
+    assert all(alarm['AlarmActions'] == ['arn:aws:sns:us-east-1:123456789012:alarms'] for alarm in alarms)
+
+
+def test_firelens_log_router(synth, config):
+    template = stage_template(synth, config, CONTAINER_LOGGING=True, FIRELENS_ENABLED=True)
+    containers = only(template, 'AWS::ECS::TaskDefinition')['ContainerDefinitions']
+    assert [container['Name'] for container in containers] == ['backstage', 'log-router']
+    assert containers[0]['LogConfiguration']['LogDriver'] == 'awsfirelens'
+    assert containers[1]['FirelensConfiguration'] == {'Type': 'fluentbit'}
+    assert containers[1]['LogConfiguration']['LogDriver'] == 'awslogs'
+
+
+def test_no_logging_by_default(synth, config):
+    template = stage_template(synth, config)
+    assert 'LogConfiguration' not in app_container(template)
+    for resource_type in ('AWS::Logs::LogGroup', 'AWS::CloudWatch::Dashboard', 'AWS::CloudWatch::Alarm'):
+        assert resources(template, resource_type) == {}
+
+
+def test_capacity_provider_strategy(synth, config):
+    template = stage_template(synth, config, CAPACITY_PROVIDER_STRATEGY=[
+        {'CAPACITY_PROVIDER': 'FARGATE', 'BASE': 1},
+        {'CAPACITY_PROVIDER': 'FARGATE_SPOT', 'WEIGHT': 3},
+    ])
+    service = only(template, 'AWS::ECS::Service')
+    assert service['CapacityProviderStrategy'] == [
+        {'CapacityProvider': 'FARGATE', 'Base': 1, 'Weight': 1},
+        {'CapacityProvider': 'FARGATE_SPOT', 'Base': 0, 'Weight': 3},
+    ]
+    assert 'LaunchType' not in service
+    assert only(template, 'AWS::ECS::ClusterCapacityProviderAssociations')['CapacityProviders'] == ['FARGATE', 'FARGATE_SPOT']
+
+
+def test_capacity_provider_strategy_has_one_base(synth, config):
+    with pytest.raises(ValueError, match='only one CAPACITY_PROVIDER_STRATEGY entry can have a BASE'):
+        stage_template(synth, config, CAPACITY_PROVIDER_STRATEGY=[
+            {'CAPACITY_PROVIDER': 'FARGATE', 'BASE': 1},
+            {'CAPACITY_PROVIDER': 'FARGATE_SPOT', 'BASE': 1},
+        ])
+
+
+def test_task_startup_settings(synth, config):
+    template = stage_template(synth, config,
+        CONTAINER_HEALTH_CHECK_PATH='/healthcheck',
+        CONTAINER_HEALTH_CHECK_START_PERIOD=90,
+        HEALTH_CHECK_GRACE_PERIOD=120,
+        EPHEMERAL_STORAGE_GIB=30,
+        STOP_TIMEOUT=60,
+    )
+    container = app_container(template)
+    health_check = container['HealthCheck']
+    assert health_check['Command'][:3] == ['CMD', 'node', '-e']
+    assert 'http://localhost:7000/healthcheck' in health_check['Command'][3]
+    assert (health_check['Interval'], health_check['Retries'], health_check['StartPeriod']) == (30, 3, 90)
+    assert container['StopTimeout'] == 60
+    assert only(template, 'AWS::ECS::TaskDefinition')['EphemeralStorage'] == {'SizeInGiB': 30}
+    assert only(template, 'AWS::ECS::Service')['HealthCheckGracePeriodSeconds'] == 120
+
+
+def test_efs_cache(synth, config):
+    template = stage_template(synth, config, EFS_CACHE_ENABLED=True, EFS_THROUGHPUT_MODE='ELASTIC', EFS_CACHE_PATH='/mnt/cache')
+    (file_system_id, file_system), = resources(template, 'AWS::EFS::FileSystem').items()
+    assert file_system['Properties']['Encrypted'] is True
+    assert file_system['Properties']['ThroughputMode'] == 'elastic'
+    assert file_system['DeletionPolicy'] == 'Delete'
+    (access_point_id, access_point), = resources(template, 'AWS::EFS::AccessPoint').items()
+    assert access_point['Properties']['PosixUser'] == {'Gid': '1000', 'Uid': '1000'}
+    (volume,) = only(template, 'AWS::ECS::TaskDefinition')['Volumes']
+    assert volume == {
+        'Name': 'efs-cache',
+        'EFSVolumeConfiguration': {
+            'FilesystemId': {'Ref': file_system_id},
+            'TransitEncryption': 'ENABLED',
+            'AuthorizationConfig': {'AccessPointId': {'Ref': access_point_id}, 'IAM': 'ENABLED'},
+        },
+    }
+    container = app_container(template)
+    assert container['MountPoints'] == [{'ContainerPath': '/mnt/cache', 'ReadOnly': False, 'SourceVolume': 'efs-cache'}]
+    assert container_environment(template)['EFS_CACHE_PATH'] == '/mnt/cache'
+    (efs_sg,) = [group_id for group_id in resources(template, 'AWS::EC2::SecurityGroup') if 'EfsCache' in group_id]
+    assert ingress_sources(template, efs_sg, 2049) == [{'Fn::GetAtt': ['infracommonresourcesfargatesecgroupDE4852EB', 'GroupId']}]
+
+
+def test_efs_provisioned_throughput_needs_a_rate(synth, config):
+    with pytest.raises(ValueError, match='EFS_PROVISIONED_THROUGHPUT_MIBPS'):
+        stage_template(synth, config, EFS_CACHE_ENABLED=True, EFS_THROUGHPUT_MODE='PROVISIONED')
+
+
+def test_blue_green_service(synth, config):
+    template = stage_template(synth, config,
+        DEPLOY_MODE='blue_green',
+        CAPACITY_PROVIDER_STRATEGY=[{'CAPACITY_PROVIDER': 'FARGATE_SPOT', 'WEIGHT': 1}],
+    )
+    service = only(template, 'AWS::ECS::Service')
+    assert service['DeploymentController'] == {'Type': 'CODE_DEPLOY'}
+    # the service points at the family, new revisions are rolled out by codedeploy
+    assert service['TaskDefinition'] == only(template, 'AWS::ECS::TaskDefinition')['Family']
+    # and codedeploy applies the strategy, cloudformation cant change it
+    assert service['LaunchType'] == 'FARGATE'
+    assert 'CapacityProviderStrategy' not in service
+    deployment_group = only(template, 'AWS::CodeDeploy::DeploymentGroup')
+    assert deployment_group['DeploymentGroupName'] == 'backstage-bench-bench0'
+    assert deployment_group['DeploymentStyle'] == {'DeploymentOption': 'WITH_TRAFFIC_CONTROL', 'DeploymentType': 'BLUE_GREEN'}
+    (target_groups,) = deployment_group['LoadBalancerInfo']['TargetGroupPairInfoList']
+    assert len(target_groups['TargetGroups']) == 2
+    (test_listener_id,) = [listener['Ref'] for listener in target_groups['TestTrafficRoute']['ListenerArns']]
+    assert resources(template, 'AWS::ElasticLoadBalancingV2::Listener')[test_listener_id]['Properties']['Port'] == 9443
+    assert len(deployment_group['AlarmConfiguration']['Alarms']) == 2
@@ -0,0 +1,142 @@
+import pytest
+
+from conftest import container_environment, resources
+
+
+def stage_template(synth, config: dict) -> dict:
+    return synth(config)[config['common']['TAG_STACK_NAME']]
+
+
+def service_scaling(template: dict) -> tuple:
+    targets = [
+        target['Properties'] for target in resources(template, 'AWS::ApplicationAutoScaling::ScalableTarget').values()
+        if target['Properties']['ScalableDimension'] == 'ecs:service:DesiredCount'
+    ]
+    policies = {
+        policy['Properties']['PolicyName']: policy['Properties']['TargetTrackingScalingPolicyConfiguration']
+        for policy in resources(template, 'AWS::ApplicationAutoScaling::ScalingPolicy').values()
+        if policy['Properties']['PolicyType'] == 'TargetTrackingScaling'
+    }
+    return targets, policies
+
+
+def test_cpu_scaling(synth, config):
+    targets, policies = service_scaling(stage_template(synth, config))
+    assert [(target['MinCapacity'], target['MaxCapacity']) for target in targets] == [(1, 4)]
+    assert len(policies) == 1
+    (policy,) = policies.values()
+    assert policy['PredefinedMetricSpecification']['PredefinedMetricType'] == 'ECSServiceAverageCPUUtilization'
+    assert policy['TargetValue'] == 60
+
+
+def test_request_scaling(synth, config):
+    config['stages']['bench0']['SCALING_TARGET_REQUESTS'] = 500
+    _, policies = service_scaling(stage_template(synth, config))
+    metrics = {
+        policy['PredefinedMetricSpecification']['PredefinedMetricType']: policy['TargetValue']
+        for policy in policies.values()
+    }
+    assert metrics == {'ECSServiceAverageCPUUtilization': 60, 'ALBRequestCountPerTarget': 500}
+
+
+def test_fixed_task_count_has_no_scaling(synth, config):
+    config['stages']['bench0']['TASK_MAX_COUNT'] = 1
+    targets, policies = service_scaling(stage_template(synth, config))
+    assert targets == [] and policies == {}
+
+
+def test_scheduled_scaling(synth, config):
+    config['stages']['bench0']['SCALING_SCHEDULES'] = [
+        {'NAME': 'business-hours', 'SCHEDULE': 'cron(0 7 ? * MON-FRI *)', 'MIN_COUNT': 2},
+    ]
+    (target,), _ = service_scaling(stage_template(synth, config))
+    (action,) = target['ScheduledActions']
+    assert action['Schedule'] == 'cron(0 7 ? * MON-FRI *)'
+    assert action['ScalableTargetAction'] == {'MinCapacity': 2}
+
+
+def test_blue_green_rejects_request_scaling(synth, config):
+    config['stages']['bench0'].update({'DEPLOY_MODE': 'blue_green', 'SCALING_TARGET_REQUESTS': 500})
+    with pytest.raises(ValueError, match='SCALING_TARGET_REQUESTS'):
+        synth(config)
+
+
+def test_alb_http2_must_be_a_bool(synth, config):
+    config['stages']['bench0']['ALB_HTTP2'] = 'false'
+    with pytest.raises(ValueError, match='ALB_HTTP2'):
+        synth(config)
+
+
+def test_vpc_rejects_no_nat_gateways(synth, config):
+    config['common'].update({'NAT_GATEWAYS': 0, 'VPC_ENDPOINTS': True})
+    with pytest.raises(ValueError, match='NAT_GATEWAYS'):
+        synth(config)
+
+
+def test_environment_leaves_out_the_settings_cdk_reads(synth, config):
+    config['common'].update({'VPC_ENDPOINTS': True, 'APP_BUILD_CACHE_MODE': 'buildkit', 'CONTAINER_INSIGHTS': True})
+    config['stages']['bench0'].update({
+        'APP_BASE_URL': 'https://bench.backstage.example.com',
+        'APP_FEATURE_FLAGS': {'search': True},
+        'APP_READ_ONLY': False,
+        'APP_ORIGINS': ['https://a.example.com'],
+        'EFS_CACHE_ENABLED': True,
+        'EFS_CACHE_PATH': '/var/cache/backstage',
+        'DB_INSTANCE_COUNT': 1,
+        'ALB_IDLE_TIMEOUT': 120,
+        'CPU_ARCHITECTURE': 'X86_64',
+        'GITHUB_APP_CLIENT_ID': 'abc123',
+        'REDIS_KEY_PREFIX': 'backstage',
+        'LOG_RETENTION': 'ONE_WEEK',
+    })
+    environment = container_environment(stage_template(synth, config))
+    # app settings and the baseline settings are passed through, values that arent strings as json
+    assert environment['APP_BASE_URL'] == 'https://bench.backstage.example.com'
+    assert environment['APP_FEATURE_FLAGS'] == '{"search": true}'
+    assert environment['APP_READ_ONLY'] == 'false'
+    assert environment['APP_ORIGINS'] == '["https://a.example.com"]'
+    assert environment['POSTGRES_DB'] == 'backstage'
+    for key in ('AWS_ACCOUNT', 'TAG_STACK_NAME', 'ECR_REPO_NAME', 'DOCKERFILE', 'GITHUB_ORG', 'CODESTAR_CONN_ARN',
+                'GITHUB_APP_CLIENT_ID', 'REDIS_KEY_PREFIX'):
+        assert key in environment
+    # the values the features generate for the app
+    assert environment['EFS_CACHE_PATH'] == '/var/cache/backstage'
+    assert 'POSTGRES_READER_HOST' in environment
+    # the settings the stage, its features, the common resources and the app pipeline read are not
+    for key in ('EFS_CACHE_ENABLED', 'TASK_MIN_COUNT', 'TASK_MAX_COUNT', 'SCALING_TARGET_CPU', 'DB_INSTANCE_COUNT', 'ALB_IDLE_TIMEOUT',
+                'CPU_ARCHITECTURE', 'LOG_RETENTION', 'VPC_ENDPOINTS', 'APP_BUILD_CACHE_MODE', 'CONTAINER_INSIGHTS'):
+        assert key not in environment
+
+
+def test_environment_has_no_redis_settings_without_redis(synth, config):
+    config['stages']['bench0'].update({'REDIS_PORT': 6380, 'EFS_CACHE_PATH': '/var/cache/backstage'})
+    environment = container_environment(stage_template(synth, config))
+    for key in ('REDIS_HOST', 'REDIS_PORT', 'REDIS_TLS', 'EFS_CACHE_PATH'):
+        assert key not in environment
+
+
+def test_autoscaled_service_has_no_desired_count(synth, config):
+    (service,) = resources(stage_template(synth, config), 'AWS::ECS::Service').values()
+    assert 'DesiredCount' not in service['Properties']
+
+
+def test_fixed_task_count_sets_desired_count(synth, config):
+    config['stages']['bench0'].update({'TASK_MIN_COUNT': 2, 'TASK_MAX_COUNT': 2})
+    (service,) = resources(stage_template(synth, config), 'AWS::ECS::Service').values()
+    assert service['Properties']['DesiredCount'] == 2
+
+
+def test_cloudfront_keeps_the_techdocs_bucket_private(synth, config):
+    config['common']['TECHDOCS_BUCKET_ENABLED'] = True
+    config['stages']['bench0'].update({'CLOUDFRONT_ENABLED': True, 'CLOUDFRONT_PREFIX_LIST_ID': 'pl-3b927c52'})
+    template = stage_template(synth, config)
+    (distribution,) = resources(template, 'AWS::CloudFront::Distribution').values()
+    distribution = distribution['Properties']['DistributionConfig']
+    assert [origin.get('S3OriginConfig') for origin in distribution['Origins']] == [None]
+    assert sorted(behavior['PathPattern'] for behavior in distribution['CacheBehaviors']) == ['/api/*', '/static/*']
+    assert resources(template, 'AWS::CloudFront::CloudFrontOriginAccessIdentity') == {}
+    (techdocs_bucket,) = [logical_id for logical_id in resources(template, 'AWS::S3::Bucket') if 'techdocs' in logical_id]
+    assert not any(
+        policy['Properties']['Bucket'] == {'Ref': techdocs_bucket}
+        for policy in resources(template, 'AWS::S3::BucketPolicy').values()
+    )
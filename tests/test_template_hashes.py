@@ -0,0 +1,49 @@
+import hashlib
+import json
+import os
+import subprocess
+import sys
+
+from conftest import REPO_ROOT
+
+sys.path.insert(0, os.path.join(REPO_ROOT, 'scripts'))
+from template_hashes import template_hashes
+
+SCRIPT = os.path.join(REPO_ROOT, 'scripts', 'template_hashes.py')
+
+
+def write(path, content: bytes) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as out_file:
+        out_file.write(content)
+
+
+def test_hashes_each_template_by_stack_name(tmp_path):
+    write(tmp_path / 'backstage.template.json', b'{"Resources": {}}')
+    write(tmp_path / 'backstage-pipeline.template.json', b'{"Resources": {"a": 1}}')
+    assert template_hashes(str(tmp_path)) == {
+        'backstage': hashlib.sha256(b'{"Resources": {}}').hexdigest(),
+        'backstage-pipeline': hashlib.sha256(b'{"Resources": {"a": 1}}').hexdigest(),
+    }
+
+
+def test_ignores_everything_but_templates(tmp_path):
+    write(tmp_path / 'backstage.template.json', b'{}')
+    write(tmp_path / 'manifest.json', b'{}')
+    write(tmp_path / 'backstage.assets.json', b'{}')
+    write(tmp_path / 'asset.abc123' / 'nested.template.json', b'{}')
+    assert list(template_hashes(str(tmp_path))) == ['backstage']
+
+
+def test_hash_changes_with_the_template(tmp_path):
+    write(tmp_path / 'backstage.template.json', b'{"Resources": {}}')
+    before = template_hashes(str(tmp_path))
+    write(tmp_path / 'backstage.template.json', b'{"Resources": {} }')
+    assert template_hashes(str(tmp_path)) != before
+
+
+def test_writes_the_manifest_into_the_assembly(tmp_path):
+    write(tmp_path / 'backstage.template.json', b'{}')
+    subprocess.run([sys.executable, SCRIPT, str(tmp_path)], check=True)
+    with open(tmp_path / 'template-hashes.json') as manifest:
+        assert json.load(manifest) == {'backstage': hashlib.sha256(b'{}').hexdigest()}